@@ -4,6 +4,7 @@ import dotenv from 'dotenv'
 import rateLimit from 'express-rate-limit'
 import pkg from 'pg';
 import cors from 'cors'
+import crypto from 'crypto'
 const { Pool } = pkg;
 
 dotenv.config()
@@ -33,6 +34,17 @@ const pool = new Pool({
 });
 await pool.connect().then(c => c.release()) // szybki healthcheck
 
+// Shared secret of the MQTT bridge, only the bridge may assert a fingerprint match
+const BRIDGE_TOKEN = process.env.BRIDGE_TOKEN || "";
+
+function fromBridge(req) {
+  const token = req.get("X-Bridge-Token");
+  if (!BRIDGE_TOKEN || !token) return false;
+  const expected = Buffer.from(BRIDGE_TOKEN);
+  const received = Buffer.from(token);
+  return expected.length === received.length && crypto.timingSafeEqual(expected, received);
+}
+
 const ENROLL_WINDOW_MS = 30_000;
 let enrollOpenUntil = 0;
 
@@ -141,10 +153,12 @@ app.post("/access-check", async (req, res) => {
       return res.json({ status: "ok", mode: "enroll" });
     }
 
-    if (normalizedType === "fingerprint") {
+    // Raw eigenvalues can't be looked up, the MQTT bridge matches them 1:N (templateMatcher.py)
+    // and sends the identifier of the enrolled template with matched: true and its X-Bridge-Token
+    if (normalizedType === "fingerprint" && (req.body.matched !== true || !fromBridge(req))) {
       return res.json({
         status: "deny",
-        reason: "fingerprint_not_supported_yet",
+        reason: "fingerprint_not_matched",
       });
     }
 
@@ -130,6 +130,34 @@ async function sendEmailWithQR(toEmail, qrBuffer, valid_from, valid_until, usage
  * @returns {Object} JSON z polami:
  *  - TODO
  */
+/**
+ * Podpisany token QR weryfikowany na urządzeniu (format opisany w rpi-zero/camera_module/qrToken.py):
+ * DQ1.<base64url(treść)>.<base64url(podpis)>, treść: alg u8, valid_from u32, valid_until u32, code 16 B, drzwi (UTF-8, po przecinku).
+ * Klucz HMAC z QR_TOKEN_KEY albo klucz prywatny Ed25519 (PEM) z QR_TOKEN_PRIVATE_KEY. Bez klucza zwraca null.
+ */
+const QR_TOKEN_ALG_HMAC_SHA256 = 1;
+const QR_TOKEN_ALG_ED25519 = 2;
+
+function signQrToken(code, validFrom, validUntil, doors = []) {
+  const privateKey = process.env.QR_TOKEN_PRIVATE_KEY;
+  const hmacKey = process.env.QR_TOKEN_KEY;
+  if (!privateKey && !hmacKey) return null;
+
+  const doorBytes = Buffer.from(doors.join(','), 'utf8');
+  const body = Buffer.alloc(25 + doorBytes.length);
+  body.writeUInt8(privateKey ? QR_TOKEN_ALG_ED25519 : QR_TOKEN_ALG_HMAC_SHA256, 0);
+  body.writeUInt32BE(Math.floor(Date.parse(validFrom) / 1000), 1);
+  body.writeUInt32BE(Math.floor(Date.parse(validUntil) / 1000), 5);
+  Buffer.from(code, 'hex').copy(body, 9);
+  doorBytes.copy(body, 25);
+
+  const signed = Buffer.concat([Buffer.from('DQ1'), body]);
+  const signature = privateKey
+    ? crypto.sign(null, signed, crypto.createPrivateKey(privateKey))
+    : crypto.createHmac('sha256', hmacKey).update(signed).digest().subarray(0, 16);
+  return `DQ1.${body.toString('base64url')}.${signature.toString('base64url')}`;
+}
+
 const toUTCISOString = (dateString) => {
   if (!dateString) return null;
   const d = new Date(dateString);
@@ -143,7 +171,7 @@ app.post('/qrcode_generation', apiLimiter, async (req, res) => {
       return res.status(400).json({ error: "valid_until is required" });
     }
 
-    const { recipient_info, email, valid_from, valid_until, usage_limit = 1, credential_id, metadata = {}, issued_by } = req.body;
+    const { recipient_info, email, valid_from, valid_until, usage_limit = 1, credential_id, metadata = {}, issued_by, doors = [] } = req.body;
     console.log(metadata)
 
     // Generate token
@@ -164,8 +192,8 @@ app.post('/qrcode_generation', apiLimiter, async (req, res) => {
     // Save QR to database
     const saved = await createQR(qrPayload);
 
-    // Generate QR codes
-    const stringData = JSON.stringify({ token });
+    // Generate QR codes, signed tokens let the doors reject forged, foreign and expired codes offline
+    const stringData = signQrToken(token, qrPayload.valid_from, qrPayload.valid_until, doors) || JSON.stringify({ token });
     const qrTerminal = await QRCode.toString(stringData, { type: "terminal" });
     console.log(qrTerminal);
 
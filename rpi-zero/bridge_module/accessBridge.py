@@ -0,0 +1,373 @@
+"""
+accessBridge.py
+
+Bridge between the door controllers on MQTT and the access service (POST /access-check).
+- subscribes through an MQTT v5 shared subscription ($share/<group>/...), so any
+  number of bridge instances split the request stream between them,
+- network thread only hands messages to the event loop, a bounded queue sits in
+  front of the workers and drops the overflow (the door times out and falls back
+  to its decision cache) instead of piling up requests nobody waits for anymore,
+- identical checks in flight at the same time (same door, type and credential)
+  share one access service round trip,
+- checks go out over a pool of keep-alive HTTP connections (httpPool.py),
+- with a fingerprint TemplateMatcher, fingerprint eigenvalues are matched 1:N here
+  and the access service gets the enrolled identifier, unknown fingers are denied
+  without a round trip (the service only trusts the match with the BRIDGE_TOKEN header),
+- decisions are published to the request's ResponseTopic with its CorrelationData,
+  JSON requests get JSON decisions and binary envelope requests binary ones.
+
+Run `python -m bridge_module.accessBridge --env_path .env` from rpi-zero.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import ssl
+import time
+
+import paho.mqtt.client as mqtt
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
+
+from bridge_module.httpPool import KeepAliveHTTPPool, HTTPError, DEFAULT_POOL_SIZE, DEFAULT_TIMEOUT
+from mqtt_module.wireFormat import (BINARY_CONTENT_TYPE, BINARY_TOPIC_SUFFIX, WireFormatError,
+                                    decode_request, encode_decision)
+from telemetry_module.latencyTrace import Tracer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REQUEST_TOPIC = "access/door/+/request"
+DEFAULT_SHARE_GROUP = "access-bridge"
+DEFAULT_SERVICE_URL = "http://127.0.0.1:4001/access-check"
+DEFAULT_QOS = 1
+DEFAULT_QUEUE_SIZE = 4096
+DEFAULT_MAX_QUEUE_AGE = 5.0  # seconds, matches the door's response timeout, older requests are dropped
+DEFAULT_STATS_INTERVAL = 60  # seconds between stats log lines
+# Shared secret proving to the access service that `matched` comes from the bridge, not from any HTTP client
+SERVICE_TOKEN_HEADER = "X-Bridge-Token"
+
+# Stages recorded in the bridge's Tracer
+STAGE_QUEUED = "bridge_queue"  # message arrival -> picked up by a worker
+STAGE_CHECK = "access_check"  # access service round trip
+STAGE_TOTAL = "bridge_total"  # message arrival -> decision published
+STAGE_MATCH = "fingerprint_match"  # 1:N template search
+
+
+class BridgeRequest:
+    """One access request taken off MQTT."""
+
+    __slots__ = ("door_id", "cred_type", "data", "request_id", "response_topic", "correlation", "binary", "received_ns",
+                 "matched")
+
+    def __init__(self, door_id, cred_type, data, request_id, response_topic, correlation, binary, received_ns,
+                 matched=False):
+        self.door_id = door_id
+        self.cred_type = cred_type
+        self.data = data
+        self.request_id = request_id
+        self.response_topic = response_topic
+        self.correlation = correlation
+        self.binary = binary
+        self.received_ns = received_ns
+        self.matched = matched  # fingerprint data replaced by the identifier of the matched template
+
+    def check_body(self) -> dict:
+        """Body of POST /access-check, credentials encoded as in the JSON request."""
+        data = self.data
+        if isinstance(data, (bytes, bytearray)):
+            data = base64.b64encode(data).decode("ascii")
+        body = {"door_id": self.door_id, "type": self.cred_type, "data": data}
+        if self.matched:
+            body["matched"] = True
+        return body
+
+
+def topic_door_id(topic: str):
+    """<door> segment of access/door/<door>/request[/bin]."""
+    parts = topic.split("/")
+    return parts[2] if len(parts) >= 4 else None
+
+
+def decision_topic(topic: str) -> str:
+    """Decision topic of a request topic, for requests without a ResponseTopic."""
+    if topic.endswith(BINARY_TOPIC_SUFFIX):
+        topic = topic[:-len(BINARY_TOPIC_SUFFIX)]
+    return topic.rsplit("/", 1)[0] + "/decision"
+
+
+def parse_request(msg, received_ns: int = None) -> BridgeRequest:
+    """BridgeRequest from a JSON or binary envelope request message, raises ValueError when malformed."""
+    properties = getattr(msg, "properties", None)
+    binary = (getattr(properties, "ContentType", None) == BINARY_CONTENT_TYPE
+              or msg.topic.endswith(BINARY_TOPIC_SUFFIX))
+    if binary:
+        body = decode_request(bytes(msg.payload))
+    else:
+        body = json.loads(msg.payload)
+        if not isinstance(body, dict) or "type" not in body or "data" not in body:
+            raise ValueError("Request without type / data")
+
+    correlation = getattr(properties, "CorrelationData", None)
+    request_id = body.get("request_id")
+    if request_id is None and correlation:
+        request_id = correlation.decode("ascii")
+    return BridgeRequest(door_id=body.get("door_id") or topic_door_id(msg.topic),
+                         cred_type=body["type"],
+                         data=body["data"],
+                         request_id=request_id,
+                         response_topic=getattr(properties, "ResponseTopic", None) or decision_topic(msg.topic),
+                         correlation=correlation,
+                         binary=binary,
+                         received_ns=received_ns if received_ns is not None else time.monotonic_ns())
+
+
+class AccessBridge:
+
+    def __init__(self, mqttc, service_url: str = DEFAULT_SERVICE_URL,
+                 share_group: str = DEFAULT_SHARE_GROUP,
+                 request_topic: str = DEFAULT_REQUEST_TOPIC,
+                 qos: int = DEFAULT_QOS,
+                 connections: int = DEFAULT_POOL_SIZE,
+                 queue_size: int = DEFAULT_QUEUE_SIZE,
+                 max_queue_age: float = DEFAULT_MAX_QUEUE_AGE,
+                 http_timeout: float = DEFAULT_TIMEOUT,
+                 tracer: Tracer = None,
+                 matcher=None,
+                 service_token: str = None):
+        self.mqttc = mqttc  # paho Client (MQTT v5) or FakeBroker client
+        self.matcher = matcher  # optional fingerprint TemplateMatcher
+        if matcher is not None and not service_token:
+            logger.warning("No BRIDGE_TOKEN set, the access service will deny matched fingerprints")
+        headers = {SERVICE_TOKEN_HEADER: service_token} if service_token else None
+        self.http = KeepAliveHTTPPool(service_url, size=connections, timeout=http_timeout, headers=headers)
+        self.qos = qos
+        self.connections = connections
+        self.max_queue_age_ns = int(max_queue_age * 1e9)
+        self.tracer = tracer if tracer is not None else Tracer()
+
+        topics = [request_topic, request_topic + BINARY_TOPIC_SUFFIX]
+        self.subscriptions = [f"$share/{share_group}/{topic}" if share_group else topic for topic in topics]
+
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._loop = None
+        self._in_flight = {}  # (door, type, credential) -> Future of the access service status
+        self.stats = {"received": 0, "dropped": 0, "expired": 0, "malformed": 0, "checks": 0,
+                      "coalesced": 0, "service_errors": 0, "decisions": 0, "queue_high_water": 0,
+                      "fingerprint_matched": 0, "fingerprint_unmatched": 0}
+
+    def start(self, loop: asyncio.AbstractEventLoop = None):
+        """Route incoming requests to `loop` and subscribe, call before (re)connecting the client."""
+        self._loop = loop or asyncio.get_running_loop()
+        self.mqttc.on_message = self._on_message
+        self.mqttc.on_connect = self._on_connect
+        if self.mqttc.is_connected():
+            self._subscribe()
+
+    def _on_connect(self, client, userdata, flags, reason_code, properties):
+        if reason_code.is_failure:
+            logger.error(f"Failed to connect: {reason_code}")
+            return
+        # Shared subscriptions don't survive a new session, subscribe on every connect
+        self._subscribe()
+
+    def _subscribe(self):
+        for topic in self.subscriptions:
+            self.mqttc.subscribe(topic, self.qos)
+            logger.info(f"Subscribed to {topic}")
+
+    def _on_message(self, client, userdata, msg):
+        # Network thread: no parsing here, it has to keep up with the whole request stream
+        self._loop.call_soon_threadsafe(self._enqueue, msg, time.monotonic_ns())
+
+    def _enqueue(self, msg, received_ns: int):
+        self.stats["received"] += 1
+        try:
+            self._queue.put_nowait((msg, received_ns))
+        except asyncio.QueueFull:
+            self.stats["dropped"] += 1
+            return
+        depth = self._queue.qsize()
+        if depth > self.stats["queue_high_water"]:
+            self.stats["queue_high_water"] = depth
+
+    async def run(self, stats_interval: float = DEFAULT_STATS_INTERVAL):
+        if self._loop is None:
+            self.start()
+        workers = [asyncio.create_task(self._worker()) for _ in range(self.connections)]
+        try:
+            while True:
+                await asyncio.sleep(stats_interval)
+                logger.info(f"Bridge stats: {self.getStats()}")
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            await self.http.close()
+
+    async def _worker(self):
+        while True:
+            msg, received_ns = await self._queue.get()
+            try:
+                await self._handle(msg, received_ns)
+            except Exception:
+                logger.exception("Failed to handle access request")
+            finally:
+                self._queue.task_done()
+
+    async def _handle(self, msg, received_ns: int):
+        picked_ns = time.monotonic_ns()
+        self.tracer.record(STAGE_QUEUED, picked_ns - received_ns)
+        if picked_ns - received_ns > self.max_queue_age_ns:
+            # The door has already given up on this one
+            self.stats["expired"] += 1
+            return
+        try:
+            request = parse_request(msg, received_ns)
+        except (ValueError, WireFormatError) as e:
+            self.stats["malformed"] += 1
+            logger.warning(f"Malformed request on {msg.topic}: {e}")
+            return
+
+        if self.matcher is not None and request.cred_type == "fingerprint":
+            try:
+                matched = await self._identify(request)
+            except ValueError as e:
+                self.stats["malformed"] += 1
+                logger.warning(f"Malformed fingerprint from door {request.door_id}: {e}")
+                return
+            if not matched:
+                denied = self._loop.create_future()
+                denied.set_result("deny")
+                self._reply(request, denied)
+                return
+
+        key = (request.door_id, request.cred_type, request.data if not isinstance(request.data, bytearray) else bytes(request.data))
+        pending = self._in_flight.get(key)
+        if pending is not None:
+            # Same credential at the same door already being checked (re-reads, retries), reuse its answer
+            self.stats["coalesced"] += 1
+            pending.add_done_callback(lambda future: self._reply(request, future))
+            return
+
+        future = self._loop.create_future()
+        self._in_flight[key] = future
+        try:
+            future.set_result(await self._check(request))
+        except HTTPError as e:
+            self.stats["service_errors"] += 1
+            logger.warning(f"Access check for door {request.door_id} failed: {e}")
+        finally:
+            if not future.done():
+                future.set_result(None)
+            del self._in_flight[key]
+        self._reply(request, future)
+
+    async def _identify(self, request: BridgeRequest) -> bool:
+        """Replace the fingerprint eigenvalues of `request` by the matched identifier, False for unknown fingers."""
+        data = request.data
+        if isinstance(data, str):
+            data = base64.b64decode(data)
+        start = time.monotonic_ns()
+        # NumPy drops the GIL for the bulk of the scan, the event loop keeps serving other requests
+        result = await self._loop.run_in_executor(None, self.matcher.match, bytes(data))
+        self.tracer.record(STAGE_MATCH, time.monotonic_ns() - start)
+        if result is None:
+            self.stats["fingerprint_unmatched"] += 1
+            return False
+        self.stats["fingerprint_matched"] += 1
+        request.data = result.identifier
+        request.matched = True
+        return True
+
+    async def _check(self, request: BridgeRequest):
+        start = time.monotonic_ns()
+        self.stats["checks"] += 1
+        status, body = await self.http.post_json(request.check_body())
+        self.tracer.record(STAGE_CHECK, time.monotonic_ns() - start)
+        if not isinstance(body, dict) or "status" not in body:
+            raise HTTPError(f"HTTP {status} without a decision")
+        return body["status"]
+
+    def _reply(self, request: BridgeRequest, future: asyncio.Future):
+        status = future.result()
+        if status is None:
+            # No decision from the service: stay silent, the door falls back to its cache after its timeout
+            return
+
+        properties = Properties(PacketTypes.PUBLISH)
+        if request.correlation:
+            properties.CorrelationData = request.correlation
+        if request.binary:
+            properties.ContentType = BINARY_CONTENT_TYPE
+            payload = encode_decision(status == "allow", request.request_id or "")
+        else:
+            decision = {"status": status}
+            if request.request_id is not None:
+                decision["request_id"] = request.request_id
+            payload = json.dumps(decision)
+
+        # QoS 1 publish is queued by the client, the worker doesn't wait for the acknowledgement
+        self.mqttc.publish(request.response_topic, payload, qos=self.qos, properties=properties)
+        self.stats["decisions"] += 1
+        self.tracer.record(STAGE_TOTAL, time.monotonic_ns() - request.received_ns)
+
+    def getStats(self) -> dict:
+        stats = dict(self.stats)
+        stats["queue_depth"] = self._queue.qsize()
+        stats["in_flight"] = len(self._in_flight)
+        stats["http"] = dict(self.http.stats, idle=self.http.idle())
+        if self.matcher is not None:
+            stats["templates"] = self.matcher.getStats()
+        stats["latency_us"] = {name: histogram["quantiles"]
+                               for name, histogram in self.tracer.snapshot().items() if histogram["count"]}
+        return stats
+
+
+def create_client(user: str, password: str, cafile: str = None, client_id: str = ""):
+    # MQTT v5 is needed for shared subscriptions and response-topic / correlation-data properties
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=client_id, protocol=mqtt.MQTTv5)
+    client.username_pw_set(user, password)
+    if cafile:
+        client.tls_set(ca_certs=cafile, tls_version=ssl.PROTOCOL_TLSv1_2)
+        client.tls_insecure_set(True)
+    return client
+
+
+async def serve(bridge: AccessBridge, host: str, port: int, stats_interval: float):
+    bridge.start()
+    bridge.mqttc.connect(host, port)
+    bridge.mqttc.loop_start()
+    try:
+        await bridge.run(stats_interval)
+    finally:
+        bridge.mqttc.loop_stop()
+        bridge.mqttc.disconnect()
+
+
+if __name__ == "__main__":
+    import dotenv
+
+    parser = argparse.ArgumentParser(description="MQTT to access service bridge")
+    parser.add_argument("--env_path", type=str, default=".env", help="Path to environment (default: .env)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    secrets = dotenv.dotenv_values(args.env_path)
+
+    client = create_client(secrets.get('MQTT_USER'), secrets.get('MQTT_PASSWORD'), secrets.get('MQTT_CAFILE'))
+    matcher = None
+    if secrets.get('FINGERPRINT_TEMPLATES'):
+        from fingerprint_module.templateMatcher import TemplateMatcher, DEFAULT_MAX_DISTANCE
+        matcher = TemplateMatcher(secrets['FINGERPRINT_TEMPLATES'],
+                                  max_distance=float(secrets.get('FINGERPRINT_MAX_DISTANCE') or DEFAULT_MAX_DISTANCE))
+    bridge = AccessBridge(client,
+                          service_url=secrets.get('ACCESS_SERVICE_URL') or DEFAULT_SERVICE_URL,
+                          share_group=secrets.get('BRIDGE_SHARE_GROUP') or DEFAULT_SHARE_GROUP,
+                          qos=int(secrets.get('MQTT_QOS') or DEFAULT_QOS),
+                          connections=int(secrets.get('BRIDGE_CONNECTIONS') or DEFAULT_POOL_SIZE),
+                          queue_size=int(secrets.get('BRIDGE_QUEUE_SIZE') or DEFAULT_QUEUE_SIZE),
+                          matcher=matcher,
+                          service_token=secrets.get('BRIDGE_TOKEN'))
+    asyncio.run(serve(bridge, secrets['MQTT_HOST'], int(secrets['MQTT_PORT']),
+                      float(secrets.get('BRIDGE_STATS_INTERVAL') or DEFAULT_STATS_INTERVAL)))
@@ -0,0 +1,158 @@
+"""
+httpPool.py
+
+Minimal asyncio HTTP/1.1 client for JSON POSTs to a single host over a pool of
+keep-alive connections. At most `size` requests are in flight, every connection
+carries one request at a time and goes back to the pool after the response, so
+steady traffic reuses the same sockets instead of paying a TCP (and TLS)
+handshake per request.
+"""
+import asyncio
+import json
+import logging
+import ssl
+import urllib.parse
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 16
+DEFAULT_TIMEOUT = 3.0  # seconds for one request, connecting included
+
+
+class HTTPError(Exception):
+    pass
+
+
+class _Connection:
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+
+    def close(self):
+        self.writer.close()
+
+
+class KeepAliveHTTPPool:
+
+    def __init__(self, url: str, size: int = DEFAULT_POOL_SIZE, timeout: float = DEFAULT_TIMEOUT,
+                 ssl_context: ssl.SSLContext = None, headers: dict = None):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ("http", "https"):
+            raise ValueError(f"Unsupported URL scheme {parts.scheme}")
+        self.url = url
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == "https" else 80)
+        self.path = parts.path or "/"
+        if parts.query:
+            self.path += "?" + parts.query
+        self.ssl = (ssl_context or ssl.create_default_context()) if parts.scheme == "https" else None
+        self.size = size
+        self.timeout = timeout
+        self._host_header = parts.netloc
+        self._extra_headers = "".join(f"{name}: {value}\r\n" for name, value in (headers or {}).items())
+        self._idle = []  # LIFO, the most recently used connection is the least likely to be closed by the server
+        self._slots = asyncio.Semaphore(size)
+        self.stats = {"requests": 0, "opened": 0, "reused": 0, "errors": 0}
+
+    async def post_json(self, body: dict, path: str = None) -> tuple:
+        """POST `body` as JSON, returns (HTTP status, decoded JSON body)."""
+        payload = json.dumps(body, separators=(",", ":")).encode("utf-8")
+        head = (f"POST {path or self.path} HTTP/1.1\r\n"
+                f"Host: {self._host_header}\r\n"
+                "Content-Type: application/json\r\n"
+                f"{self._extra_headers}"
+                f"Content-Length: {len(payload)}\r\n"
+                "Connection: keep-alive\r\n\r\n").encode("latin-1")
+
+        async with self._slots:
+            self.stats["requests"] += 1
+            # One retry when a pooled connection turns out to be closed by the server (idle keep-alive timeout)
+            for attempt in range(2):
+                connection = self._idle.pop() if self._idle else None
+                reused = connection is not None
+                try:
+                    async with asyncio.timeout(self.timeout):
+                        if connection is None:
+                            connection = await self._open()
+                        status, keep_alive, raw = await self._roundtrip(connection, head + payload)
+                except (OSError, asyncio.IncompleteReadError, HTTPError) as e:
+                    if connection is not None:
+                        connection.close()
+                    if reused and attempt == 0:
+                        logger.debug(f"Pooled connection to {self.host}:{self.port} was closed, retrying: {e}")
+                        continue
+                    self.stats["errors"] += 1
+                    raise HTTPError(f"POST {self.url} failed: {e}") from e
+                except asyncio.TimeoutError as e:
+                    if connection is not None:
+                        connection.close()
+                    self.stats["errors"] += 1
+                    raise HTTPError(f"POST {self.url} timed out after {self.timeout} s") from e
+
+                if reused:
+                    self.stats["reused"] += 1
+                if keep_alive:
+                    self._idle.append(connection)
+                else:
+                    connection.close()
+                break
+
+        try:
+            return status, json.loads(raw) if raw else None
+        except ValueError as e:
+            raise HTTPError(f"Response from {self.url} is not JSON: {raw[:64]!r}") from e
+
+    async def _open(self) -> _Connection:
+        reader, writer = await asyncio.open_connection(self.host, self.port, ssl=self.ssl)
+        self.stats["opened"] += 1
+        return _Connection(reader, writer)
+
+    @staticmethod
+    async def _roundtrip(connection: _Connection, request: bytes) -> tuple:
+        connection.writer.write(request)
+        await connection.writer.drain()
+
+        reader = connection.reader
+        status_line = await reader.readline()
+        if not status_line:
+            raise HTTPError("Connection closed before the response")
+        try:
+            version, status = status_line.decode("latin-1").split(None, 2)[:2]
+            status = int(status)
+        except ValueError:
+            raise HTTPError(f"Malformed status line {status_line!r}")
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    await reader.readline()
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            body = b"".join(chunks)
+        elif "content-length" in headers:
+            body = await reader.readexactly(int(headers["content-length"]))
+        else:
+            body = await reader.read()
+            keep_alive = False
+        return status, keep_alive, body
+
+    def idle(self) -> int:
+        return len(self._idle)
+
+    async def close(self):
+        while self._idle:
+            connection = self._idle.pop()
+            connection.close()
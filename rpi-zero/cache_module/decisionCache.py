@@ -0,0 +1,312 @@
+"""
+decisionCache.py
+
+On-device cache of access decisions.
+Keeps a bounded LRU/TTL store of credential hashes together with their
+allow windows per door. The store is filled from signed allowlist updates
+published on retained MQTT topics and from decisions returned online.
+It is used when the broker doesn't answer in time.
+
+Deltas are published (retained) on the door's cache sync topic, the latest full
+snapshot (retained) on <sync topic>/snapshot. A device that boots or missed a
+delta gets both retained messages, applies the snapshot and then every delta
+waiting on top of it, whatever order they arrive in. When a delta still doesn't
+fit, the cache asks for a new snapshot on <sync topic>/resync
+({"door": "main", "version": 41}).
+
+The updates are produced by whoever administers the allowlist and holds
+CACHE_SYNC_KEY (signUpdate() below), the backend doesn't publish them.
+`python -m cache_module.decisionCache` signs a full snapshot for mosquitto_pub -r.
+
+Allowlist update format (JSON):
+{
+  "version": 42,            # monotonically increasing
+  "base": 41,               # version the delta applies on top of (ignored for full updates)
+  "full": false,            # full snapshot replaces the whole allowlist, learned allows included
+  "door": "main",
+  "upserts": [{"credential": "<sha256 hex>", "windows": [[valid_from, valid_until], ...]}],
+  "revoke": ["<sha256 hex>", ...],
+  "signature": "<hex HMAC-SHA256 over the canonical JSON without the signature field>"
+}
+valid_from / valid_until are unix timestamps, null means unbounded.
+"""
+import hashlib
+import hmac
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DOOR_ID = "main"
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_DECISION_TTL = 10 * 60  # seconds a learned online decision stays valid
+DEFAULT_MAX_SYNC_AGE = 60 * 60  # seconds after which the allowlist is reported as stale
+DEFAULT_STALE_LIMIT = 24 * 60 * 60  # seconds after which a stale allowlist isn't trusted at all
+DEFAULT_MAX_PENDING = 16  # deltas kept while waiting for the update they apply on
+SNAPSHOT_TOPIC_SUFFIX = "/snapshot"
+RESYNC_TOPIC_SUFFIX = "/resync"
+
+
+class CacheSyncError(Exception):
+    pass
+
+
+class CacheSyncGap(CacheSyncError):
+    """Authentic delta that doesn't apply on the local version."""
+    pass
+
+
+class CacheEntry:
+    __slots__ = ("allowed", "windows", "expires", "synced")
+
+    def __init__(self, allowed: bool, windows=None, expires: float = None, synced: bool = False):
+        self.allowed = allowed
+        self.windows = windows  # list of (valid_from, valid_until) or None for always
+        self.expires = expires  # monotonic deadline for learned decisions, None for synced entries
+        self.synced = synced
+
+    def allows(self, now: float) -> bool:
+        if not self.allowed:
+            return False
+        if self.windows is None:
+            return True
+        for valid_from, valid_until in self.windows:
+            if (valid_from is None or valid_from <= now) and (valid_until is None or now < valid_until):
+                return True
+        return False
+
+
+def credentialHash(cred_type: str, data) -> str:
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.sha256(cred_type.encode("ascii") + b":" + data).hexdigest()
+
+
+def signUpdate(update: dict, key: bytes) -> str:
+    body = {k: v for k, v in update.items() if k != "signature"}
+    canonical = json.dumps(body, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    return hmac.new(key, canonical, hashlib.sha256).hexdigest()
+
+
+class DecisionCache:
+
+    def __init__(self, sync_key: bytes = None,
+                 door_id: str = DEFAULT_DOOR_ID,
+                 max_entries: int = DEFAULT_MAX_ENTRIES,
+                 decision_ttl: float = DEFAULT_DECISION_TTL,
+                 max_sync_age: float = DEFAULT_MAX_SYNC_AGE,
+                 stale_limit: float = DEFAULT_STALE_LIMIT,
+                 resync=None):
+        self.sync_key = sync_key
+        self.door_id = door_id
+        self.max_entries = max_entries
+        self.decision_ttl = decision_ttl
+        self.max_sync_age = max_sync_age
+        self.stale_limit = stale_limit
+        self.resync = resync  # optional callable(version) asking the producer for a full snapshot
+
+        self.version = None
+        self.last_sync = None  # monotonic time of the last applied update
+        self._entries = OrderedDict()
+        self._pending = {}  # base version -> delta waiting for it
+        self._resync_requested = False
+        self._lock = threading.Lock()
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "stale_hits": 0,
+            "expired": 0,
+            "evictions": 0,
+            "updates_applied": 0,
+            "updates_rejected": 0,
+            "updates_deferred": 0,
+            "resyncs": 0,
+        }
+
+    # ------------------------
+    # Lookup
+    # ------------------------
+    def lookup(self, cred_type: str, data, now: float = None):
+        """Return True/False for a cached decision or None when the credential is unknown."""
+        key = credentialHash(cred_type, data)
+        mono = time.monotonic()
+        if now is None:
+            now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+
+            if entry.expires is not None and mono >= entry.expires:
+                del self._entries[key]
+                self.stats["expired"] += 1
+                self.stats["misses"] += 1
+                return None
+
+            if entry.synced and self.sync_age(mono) > self.stale_limit:
+                self.stats["misses"] += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            if entry.synced and self.is_stale(mono):
+                self.stats["stale_hits"] += 1
+            return entry.allows(now)
+
+    def remember(self, cred_type: str, data, allowed: bool):
+        """Store a decision returned by the backend, valid for decision_ttl seconds.
+
+        An online deny replaces a synced allow, a revocation must not wait for the next
+        allowlist update (which restores the synced entry if it still allows).
+        """
+        key = credentialHash(cred_type, data)
+        with self._lock:
+            current = self._entries.get(key)
+            if current is not None and current.synced and allowed:
+                # The synced entry agrees and carries the allow windows, only refresh its LRU position
+                self._entries.move_to_end(key)
+                return
+            self._put(key, CacheEntry(allowed, expires=time.monotonic() + self.decision_ttl))
+
+    def _put(self, key: str, entry: CacheEntry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    # ------------------------
+    # Allowlist sync
+    # ------------------------
+    def applyUpdate(self, payload):
+        """Verify and apply a signed allowlist update. Raises CacheSyncError when rejected."""
+        try:
+            update = json.loads(payload)
+        except ValueError as e:
+            self.stats["updates_rejected"] += 1
+            raise CacheSyncError("Allowlist update is not valid JSON") from e
+
+        try:
+            self._verify(update)
+        except CacheSyncGap as e:
+            self._defer(update, e)
+            return
+        except CacheSyncError:
+            self.stats["updates_rejected"] += 1
+            raise
+
+        self._apply(update)
+        # Deltas that arrived before the update they build on
+        while True:
+            with self._lock:
+                self._pending = {base: delta for base, delta in self._pending.items() if delta["version"] > self.version}
+                delta = self._pending.pop(self.version, None)
+            if delta is None:
+                break
+            self._apply(delta)
+
+    def _apply(self, update: dict):
+        with self._lock:
+            if update.get("full"):
+                # Learned denies survive, learned allows must not outlive a snapshot that dropped the credential
+                self._entries = OrderedDict((k, e) for k, e in self._entries.items() if not e.synced and not e.allowed)
+            for key in update.get("revoke", []):
+                self._entries.pop(key, None)
+            for item in update.get("upserts", []):
+                windows = item.get("windows")
+                if windows is not None:
+                    windows = [tuple(w) for w in windows]
+                self._put(item["credential"], CacheEntry(True, windows=windows, synced=True))
+
+            self.version = update["version"]
+            self.last_sync = time.monotonic()
+            self.stats["updates_applied"] += 1
+            self._resync_requested = False
+
+        logger.debug(f"Applied allowlist update version {self.version}")
+
+    def _defer(self, update: dict, reason: CacheSyncGap):
+        with self._lock:
+            self._pending[update["base"]] = update
+            while len(self._pending) > DEFAULT_MAX_PENDING:
+                del self._pending[min(self._pending)]
+            self.stats["updates_deferred"] += 1
+            request = not self._resync_requested and self.resync is not None
+            self._resync_requested = True
+        logger.info(f"Deferred allowlist delta: {reason}")
+        if request:
+            self.stats["resyncs"] += 1
+            self.resync(self.version)
+
+    def _verify(self, update: dict):
+        if self.sync_key is None:
+            raise CacheSyncError("No sync key configured, refusing unsigned allowlist")
+        signature = update.get("signature", "")
+        if not hmac.compare_digest(signUpdate(update, self.sync_key), signature):
+            raise CacheSyncError("Invalid allowlist signature")
+        if update.get("door", self.door_id) != self.door_id:
+            raise CacheSyncError(f"Allowlist is for door {update.get('door')}")
+        if "version" not in update:
+            raise CacheSyncError("Allowlist update has no version")
+        if self.version is not None and update["version"] <= self.version:
+            raise CacheSyncError(f"Allowlist version {update['version']} is not newer than {self.version}")
+        if not update.get("full") and update.get("base") != self.version:
+            if not isinstance(update.get("base"), int):
+                raise CacheSyncError("Allowlist delta has no base version")
+            raise CacheSyncGap(f"Allowlist delta base {update.get('base')} doesn't match local version {self.version}")
+
+    def onSyncMessage(self, payload: bytes):
+        # MQTTClient subscription callback
+        try:
+            self.applyUpdate(payload)
+        except CacheSyncError as e:
+            logger.warning(f"Rejected allowlist update: {e}")
+
+    # ------------------------
+    # Stats
+    # ------------------------
+    def sync_age(self, mono: float = None) -> float:
+        if self.last_sync is None:
+            return float("inf")
+        return (mono if mono is not None else time.monotonic()) - self.last_sync
+
+    def is_stale(self, mono: float = None) -> bool:
+        return self.sync_age(mono) > self.max_sync_age
+
+    def getStats(self) -> dict:
+        with self._lock:
+            stats = dict(self.stats)
+            stats["entries"] = len(self._entries)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = stats["hits"] / lookups if lookups else 0.0
+        stats["version"] = self.version
+        stats["pending"] = len(self._pending)
+        stats["sync_age"] = self.sync_age()
+        stats["stale"] = self.is_stale()
+        return stats
+
+
+if __name__ == "__main__":
+    # Signed full snapshot from [{"type": "rfid", "data": "04A1B2C3", "windows": [[from, until], ...]}, ...]
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="Sign a full allowlist snapshot for <sync topic>/snapshot")
+    parser.add_argument("credentials", help="JSON file with the allowed credentials, - for stdin")
+    parser.add_argument("--key", required=True, help="CACHE_SYNC_KEY")
+    parser.add_argument("--door", default=DEFAULT_DOOR_ID)
+    parser.add_argument("--version", type=int, default=int(time.time()), help="default: current unix time")
+    args = parser.parse_args()
+
+    with (sys.stdin if args.credentials == "-" else open(args.credentials, encoding="utf-8")) as f:
+        credentials = json.load(f)
+    snapshot = {"version": args.version, "full": True, "door": args.door, "revoke": [],
+                "upserts": [{"credential": credentialHash(item["type"], item["data"]), "windows": item.get("windows")}
+                            for item in credentials]}
+    snapshot["signature"] = signUpdate(snapshot, args.key.encode("utf-8"))
+    print(json.dumps(snapshot, separators=(",", ":")))
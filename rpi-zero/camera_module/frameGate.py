@@ -0,0 +1,114 @@
+"""
+frameGate.py
+
+Cheap pre-filter placed in front of the QR decoder.
+Works on a strided (downsampled) view of the luma plane and rejects frames when:
+- nothing changed in the view since the last reference frame (empty hallway),
+- the frame is too blurry to decode (variance of Laplacian),
+- the frame is badly exposed (too dark / too bright / clipped).
+After motion is detected the gate stays open for a short hold time, so a code
+held still in front of the camera keeps being decoded.
+"""
+import time
+
+import cv2
+import numpy as np
+
+DEFAULT_DOWNSAMPLE = 8  # use every n-th pixel in both directions
+DEFAULT_MOTION_THRESHOLD = 12  # per pixel absolute luma difference counted as change
+DEFAULT_MOTION_FRACTION = 0.01  # fraction of changed pixels that counts as motion
+DEFAULT_MOTION_HOLD = 3.0  # seconds the gate stays open after motion
+DEFAULT_MIN_SHARPNESS = 20.0  # variance of Laplacian on the downsampled frame
+DEFAULT_MIN_BRIGHTNESS = 25
+DEFAULT_MAX_BRIGHTNESS = 230
+DEFAULT_MAX_CLIPPED = 0.4  # fraction of saturated pixels
+
+
+class FrameGate:
+
+    def __init__(self, downsample: int = DEFAULT_DOWNSAMPLE,
+                 motion_threshold: int = DEFAULT_MOTION_THRESHOLD,
+                 motion_fraction: float = DEFAULT_MOTION_FRACTION,
+                 motion_hold: float = DEFAULT_MOTION_HOLD,
+                 min_sharpness: float = DEFAULT_MIN_SHARPNESS,
+                 min_brightness: int = DEFAULT_MIN_BRIGHTNESS,
+                 max_brightness: int = DEFAULT_MAX_BRIGHTNESS,
+                 max_clipped: float = DEFAULT_MAX_CLIPPED):
+        self.downsample = downsample
+        self.motion_threshold = motion_threshold
+        self.motion_fraction = motion_fraction
+        self.motion_hold = motion_hold
+        self.min_sharpness = min_sharpness
+        self.min_brightness = min_brightness
+        self.max_brightness = max_brightness
+        self.max_clipped = max_clipped
+
+        self._reference = None
+        self._diff = None
+        self._open_until = 0.0
+        self.motion_rect = None  # (x, y, w, h) of the changed area in full frame coordinates
+        self.stats = {
+            "frames": 0,
+            "gated_static": 0,
+            "gated_blur": 0,
+            "gated_exposure": 0,
+            "passed": 0,
+        }
+
+    def reset(self):
+        """Forget the reference frame, the next frame is treated as motion."""
+        self._reference = None
+        self._open_until = 0.0
+
+    def check(self, luma) -> bool:
+        """Return True when the frame is worth decoding. `luma` is a 2D uint8 array."""
+        self.stats["frames"] += 1
+        # 1/64 of the frame for the default downsample, copied once so OpenCV gets a contiguous array
+        small = np.ascontiguousarray(luma[::self.downsample, ::self.downsample])
+
+        if not self._detect_motion(small):
+            self.stats["gated_static"] += 1
+            return False
+
+        mean = float(small.mean())
+        clipped = np.count_nonzero(small >= 250) / small.size
+        if mean < self.min_brightness or mean > self.max_brightness or clipped > self.max_clipped:
+            self.stats["gated_exposure"] += 1
+            return False
+
+        if cv2.Laplacian(small, cv2.CV_16S).var() < self.min_sharpness:
+            self.stats["gated_blur"] += 1
+            return False
+
+        self.stats["passed"] += 1
+        return True
+
+    def _detect_motion(self, small) -> bool:
+        now = time.monotonic()
+        if self._reference is None or self._reference.shape != small.shape:
+            self._reference = small.copy()
+            self._diff = np.empty(small.shape, dtype=np.uint8)
+            self._open_until = now + self.motion_hold
+            self.motion_rect = None
+            return True
+
+        cv2.absdiff(small, self._reference, dst=self._diff)
+        changed = self._diff > self.motion_threshold
+        # The reference follows the scene so slow lighting changes don't keep the gate open
+        np.copyto(self._reference, small)
+
+        if np.count_nonzero(changed) >= self.motion_fraction * changed.size:
+            self._open_until = now + self.motion_hold
+            self.motion_rect = self._changed_rect(changed)
+            return True
+
+        # Held open without new motion: there is no fresh area to hint at
+        self.motion_rect = None
+        return now < self._open_until
+
+    def _changed_rect(self, changed):
+        rows = np.flatnonzero(changed.any(axis=1))
+        cols = np.flatnonzero(changed.any(axis=0))
+        n = self.downsample
+        x, y = int(cols[0]) * n, int(rows[0]) * n
+        return (x, y, (int(cols[-1]) + 1) * n - x, (int(rows[-1]) + 1) * n - y)
@@ -0,0 +1,257 @@
+"""
+parallelDecode.py
+
+Optional multi-core QR decoding for Pi Zero 2 W / Pi 4.
+Frames are copied once into a shared-memory ring of frame slots and a small
+process pool decodes them without pickling any pixel data (workers only get
+the slot index and the region to look at). Two modes:
+- "frames": consecutive frames are decoded concurrently (higher throughput,
+  results may belong to a frame captured slightly earlier),
+- "tiles": one large frame is split into overlapping tiles decoded concurrently
+  (lower latency per frame).
+In both modes the first result wins and the remaining work is cancelled.
+
+Run `python -m camera_module.parallelDecode <frames_dir>` to compare the
+modes with the serial path on recorded frames.
+"""
+import logging
+import os
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from camera_module.qrDecoders import QRResult, create_decoder
+
+logger = logging.getLogger(__name__)
+
+DECODE_MODE_SERIAL = "serial"
+DECODE_MODE_FRAMES = "frames"
+DECODE_MODE_TILES = "tiles"
+
+DEFAULT_WORKERS = max(1, min(4, (os.cpu_count() or 1)))
+DEFAULT_TILE_OVERLAP = 0.25  # fraction of the tile size shared with the neighbouring tile
+DEFAULT_MIN_PARALLEL_AREA = 320 * 480  # smaller images (e.g. ROI crops) are decoded in process
+DEFAULT_LATENCY_SAMPLES = 1024  # latest worker task latencies kept
+
+# Worker process state, set up once by _init_worker
+_worker = {}
+
+
+def _init_worker(shm_name: str, ring_shape: tuple, decoder_name: str):
+    # Workers share the coordinator's resource tracker, the segment is unlinked once by FrameRing.close()
+    shm = SharedMemory(name=shm_name)
+    _worker["shm"] = shm
+    _worker["ring"] = np.ndarray(ring_shape, dtype=np.uint8, buffer=shm.buf)
+    _worker["decoder"] = create_decoder(decoder_name)
+
+
+def _decode_region(slot: int, height: int, width: int, region: tuple) -> list:
+    x, y, w, h = region
+    frame = _worker["ring"][slot, :height, :width]
+    codes = _worker["decoder"].decode(frame[y:y + h, x:x + w])
+    return [QRResult(c.data, (c.rect[0] + x, c.rect[1] + y, c.rect[2], c.rect[3])) for c in codes]
+
+
+def tile_regions(height: int, width: int, tiles_x: int, tiles_y: int, overlap: float = DEFAULT_TILE_OVERLAP) -> list:
+    """Overlapping (x, y, w, h) tiles covering the frame, so a code on a tile border is whole in one tile."""
+    tile_w = int(width / (tiles_x - (tiles_x - 1) * overlap)) if tiles_x > 1 else width
+    tile_h = int(height / (tiles_y - (tiles_y - 1) * overlap)) if tiles_y > 1 else height
+    regions = []
+    for j in range(tiles_y):
+        y = 0 if tiles_y == 1 else round(j * (height - tile_h) / (tiles_y - 1))
+        for i in range(tiles_x):
+            x = 0 if tiles_x == 1 else round(i * (width - tile_w) / (tiles_x - 1))
+            regions.append((x, y, tile_w, tile_h))
+    return regions
+
+
+class FrameRing:
+    """Fixed number of frame slots in one shared memory segment."""
+
+    def __init__(self, slots: int, max_shape: tuple):
+        self.shape = (slots,) + tuple(max_shape)
+        self.shm = SharedMemory(create=True, size=int(np.prod(self.shape)))
+        self.frames = np.ndarray(self.shape, dtype=np.uint8, buffer=self.shm.buf)
+        self._busy = [0] * slots  # outstanding worker tasks per slot
+        self._next = 0
+        self._lock = threading.Lock()  # release() runs in the executor's callback thread
+
+    def acquire(self):
+        """Index of a slot no worker is reading, or None when the ring is full."""
+        slots = self.shape[0]
+        with self._lock:
+            for i in range(slots):
+                slot = (self._next + i) % slots
+                if self._busy[slot] == 0:
+                    self._next = (slot + 1) % slots
+                    return slot
+        return None
+
+    def write(self, slot: int, luma):
+        height, width = luma.shape
+        np.copyto(self.frames[slot, :height, :width], luma)
+
+    def retain(self, slot: int):
+        with self._lock:
+            self._busy[slot] += 1
+
+    def release(self, slot: int):
+        with self._lock:
+            self._busy[slot] -= 1
+
+    def close(self):
+        if self.frames is None:
+            return
+        self.frames = None
+        self.shm.close()
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class ParallelDecoder:
+    """Drop-in decoder (decode(luma) -> [QRResult]) spreading the work over a process pool."""
+
+    def __init__(self, decoder_name: str, frame_shape: tuple,
+                 mode: str = DECODE_MODE_TILES,
+                 workers: int = DEFAULT_WORKERS,
+                 overlap: float = DEFAULT_TILE_OVERLAP,
+                 min_parallel_area: int = DEFAULT_MIN_PARALLEL_AREA):
+        if mode not in (DECODE_MODE_FRAMES, DECODE_MODE_TILES):
+            raise ValueError(f"Unknown parallel decode mode {mode}")
+        self.name = f"{decoder_name}-{mode}x{workers}"
+        self.mode = mode
+        self.workers = workers
+        self.min_parallel_area = min_parallel_area
+        self.frame_shape = tuple(frame_shape)
+        self.local = create_decoder(decoder_name)
+
+        # Frames mode keeps up to two frames per worker in flight
+        slots = workers * 2 if mode == DECODE_MODE_FRAMES else 2
+        self.ring = FrameRing(slots, self.frame_shape)
+        self.pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                        initargs=(self.ring.shm.name, self.ring.shape, decoder_name))
+
+        tiles_y = 2 if workers >= 2 else 1
+        tiles_x = max(1, workers // tiles_y)
+        self.tiles = tile_regions(self.frame_shape[0], self.frame_shape[1], tiles_x, tiles_y, overlap)
+        self._in_flight = set()
+        # Seconds from submit to result of the latest finished worker tasks
+        self.task_latencies = deque(maxlen=DEFAULT_LATENCY_SAMPLES)
+        self.stats = {"local": 0, "parallel": 0, "cancelled": 0, "ring_full": 0}
+
+    def decode(self, luma) -> list:
+        height, width = luma.shape
+        if height * width < self.min_parallel_area or height > self.frame_shape[0] or width > self.frame_shape[1]:
+            self.stats["local"] += 1
+            return self.local.decode(luma)
+
+        slot = self.ring.acquire()
+        if slot is None:
+            # All slots are still being read, don't block the capture loop
+            self.stats["ring_full"] += 1
+            return self._collect(block=self.mode == DECODE_MODE_TILES)
+
+        self.stats["parallel"] += 1
+        self.ring.write(slot, luma)
+        if self.mode == DECODE_MODE_TILES and (height, width) == self.frame_shape:
+            regions = self.tiles
+        else:
+            regions = [(0, 0, width, height)]
+        for region in regions:
+            self._submit(slot, height, width, region)
+
+        return self._collect(block=self.mode == DECODE_MODE_TILES)
+
+    def _submit(self, slot, height, width, region):
+        self.ring.retain(slot)
+        submitted = time.perf_counter()
+        future = self.pool.submit(_decode_region, slot, height, width, region)
+        future.add_done_callback(lambda f: self._on_done(f, slot, submitted))
+        self._in_flight.add(future)
+
+    def _on_done(self, future, slot, submitted):
+        self.ring.release(slot)
+        if not future.cancelled():
+            self.task_latencies.append(time.perf_counter() - submitted)
+
+    def _collect(self, block: bool) -> list:
+        """Return the first non-empty result, cancelling the remaining work when one is found."""
+        while self._in_flight:
+            done, pending = wait(self._in_flight, timeout=None if block else 0, return_when=FIRST_COMPLETED)
+            if not done:
+                return []
+            self._in_flight = pending
+            for future in done:
+                if future.cancelled() or future.exception() is not None:
+                    continue
+                codes = future.result()
+                if codes:
+                    self.cancel()
+                    return codes
+        return []
+
+    def cancel(self):
+        for future in self._in_flight:
+            if future.cancel():
+                self.stats["cancelled"] += 1
+        # Tasks already running finish in the background, their slots are released by the callback
+        self._in_flight = set()
+
+    def close(self):
+        self.cancel()
+        self.pool.shutdown(wait=True, cancel_futures=True)
+        self.ring.close()
+
+
+def benchmark(frames: list, decoder_name: str, workers: int = DEFAULT_WORKERS) -> dict:
+    """Throughput (frames/s) and mean latency (ms) from handing a frame over to getting its result."""
+    results = {}
+    local = create_decoder(decoder_name)
+    start = time.perf_counter()
+    for frame in frames:
+        local.decode(frame)
+    elapsed = time.perf_counter() - start
+    results[DECODE_MODE_SERIAL] = (len(frames) / elapsed, elapsed * 1000 / len(frames))
+
+    for mode in (DECODE_MODE_FRAMES, DECODE_MODE_TILES):
+        decoder = ParallelDecoder(decoder_name, frames[0].shape, mode=mode, workers=workers)
+        try:
+            decoder.decode(frames[0])  # warm up the pool
+            decoder._collect(block=True)
+            decoder.task_latencies = deque(maxlen=len(frames) * len(decoder.tiles))
+            latencies = []
+            start = time.perf_counter()
+            for frame in frames:
+                frame_start = time.perf_counter()
+                decoder.decode(frame)
+                latencies.append(time.perf_counter() - frame_start)
+            decoder._collect(block=True)
+            elapsed = time.perf_counter() - start
+            if mode == DECODE_MODE_FRAMES:
+                # decode() doesn't wait in frames mode, the worker round trip is the latency
+                latencies = decoder.task_latencies
+            results[mode] = (len(frames) / elapsed, sum(latencies) * 1000 / max(len(latencies), 1))
+        finally:
+            decoder.close()
+    return results
+
+
+if __name__ == "__main__":
+    from camera_module.qrDecoders import select_decoder
+    from camera_module.qrRead import load_calibration_frames
+
+    logging.basicConfig(level=logging.INFO)
+    frames = load_calibration_frames(sys.argv[1])
+    if not frames:
+        sys.exit(f"No frames found in {sys.argv[1]}")
+    frames = [f for f in frames if f.shape == frames[0].shape]
+    engine = select_decoder(frames)
+    for mode, (fps, latency_ms) in benchmark(frames, engine.name).items():
+        logger.info(f"{mode:>7}: {fps:6.1f} frames/s, {latency_ms:6.1f} ms/frame")
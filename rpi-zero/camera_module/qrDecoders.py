@@ -0,0 +1,200 @@
+"""
+qrDecoders.py
+
+Pluggable QR decoder engines and region-of-interest tracking.
+Every engine takes a 2D uint8 luma array and returns a list of QRResult
+(same `data` / `rect` fields as pyzbar's Decoded). Engines whose packages
+are not installed are simply not offered.
+"""
+import ctypes
+import logging
+import time
+from collections import namedtuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+QRResult = namedtuple("QRResult", ["data", "rect"])
+
+DEFAULT_ROI_PADDING = 0.5  # fraction of the last code size added on each side of the crop
+DEFAULT_ROI_MAX_MISSES = 3  # consecutive misses in the crop before the ROI is dropped
+
+
+class _PlanePixels:
+    """Hands a contiguous uint8 plane to pyzbar without the copy done by ndarray.tobytes()."""
+
+    def __init__(self, plane):
+        self.plane = plane
+        self._as_parameter_ = ctypes.c_void_p(plane.ctypes.data)
+
+    def __len__(self):
+        return self.plane.nbytes
+
+
+class PyzbarDecoder:
+    name = "pyzbar"
+
+    def __init__(self):
+        from pyzbar import pyzbar
+        from pyzbar.pyzbar import ZBarSymbol
+        self._pyzbar = pyzbar
+        self._symbols = [ZBarSymbol.QRCODE]
+
+    def decode(self, luma) -> list:
+        if not luma.flags.c_contiguous:
+            luma = np.ascontiguousarray(luma)
+        height, width = luma.shape
+        codes = self._pyzbar.decode((_PlanePixels(luma), width, height), symbols=self._symbols)
+        return [QRResult(code.data, tuple(code.rect)) for code in codes]
+
+
+class OpenCVDecoder:
+    name = "opencv"
+
+    def __init__(self):
+        import cv2
+        self._detector = cv2.QRCodeDetector()
+
+    def decode(self, luma) -> list:
+        text, points, _ = self._detector.detectAndDecode(luma)
+        if not text or points is None:
+            return []
+        xs, ys = points[0][:, 0], points[0][:, 1]
+        x, y = int(xs.min()), int(ys.min())
+        return [QRResult(text.encode("utf-8"), (x, y, int(xs.max()) - x, int(ys.max()) - y))]
+
+
+class ZxingDecoder:
+    name = "zxing"
+
+    def __init__(self):
+        import zxingcpp
+        self._zxing = zxingcpp
+        self._formats = zxingcpp.BarcodeFormat.QRCode
+
+    def decode(self, luma) -> list:
+        results = []
+        for code in self._zxing.read_barcodes(luma, formats=self._formats):
+            corners = (code.position.top_left, code.position.top_right,
+                       code.position.bottom_left, code.position.bottom_right)
+            xs = [p.x for p in corners]
+            ys = [p.y for p in corners]
+            x, y = min(xs), min(ys)
+            results.append(QRResult(code.bytes, (x, y, max(xs) - x, max(ys) - y)))
+        return results
+
+
+DECODER_ENGINES = (PyzbarDecoder, OpenCVDecoder, ZxingDecoder)
+
+
+def available_decoders() -> list:
+    decoders = []
+    for engine in DECODER_ENGINES:
+        try:
+            decoders.append(engine())
+        except ImportError:
+            logger.debug(f"QR decoder engine {engine.name} not installed")
+    return decoders
+
+
+def create_decoder(name: str):
+    for engine in DECODER_ENGINES:
+        if engine.name == name:
+            return engine()
+    raise ValueError(f"Unknown QR decoder engine {name}")
+
+
+def benchmark_decoders(frames: list, decoders: list = None) -> dict:
+    """Decode recorded frames with every engine. Returns name -> (decode rate, mean ms per frame)."""
+    results = {}
+    for decoder in decoders if decoders is not None else available_decoders():
+        decoded = 0
+        start = time.perf_counter()
+        for frame in frames:
+            if decoder.decode(frame):
+                decoded += 1
+        elapsed_ms = (time.perf_counter() - start) * 1000 / max(len(frames), 1)
+        results[decoder.name] = (decoded / max(len(frames), 1), elapsed_ms)
+    return results
+
+
+def select_decoder(frames: list = None):
+    """Pick the engine with the best decode rate on recorded frames, ties broken by speed.
+
+    Without frames pyzbar (the previous hardwired engine) is used when available.
+    """
+    decoders = available_decoders()
+    if not decoders:
+        raise ImportError("No QR decoder engine installed")
+    if not frames:
+        return decoders[0]
+
+    results = benchmark_decoders(frames, decoders)
+    for name, (rate, elapsed_ms) in results.items():
+        logger.debug(f"QR decoder {name}: decode rate {rate:.2f}, {elapsed_ms:.1f} ms/frame")
+    return max(decoders, key=lambda d: (results[d.name][0], -results[d.name][1]))
+
+
+class RoiTracker:
+    """Remembers where the last code (or motion) was, so the next frames are searched in a padded crop first."""
+
+    def __init__(self, padding: float = DEFAULT_ROI_PADDING, max_misses: int = DEFAULT_ROI_MAX_MISSES):
+        self.padding = padding
+        self.max_misses = max_misses
+        self.rect = None
+        self._misses = 0
+        self._from_motion = False
+        self.stats = {"roi_hits": 0, "roi_misses": 0, "full_frame": 0}
+
+    def reset(self):
+        self.rect = None
+        self._misses = 0
+        self._from_motion = False
+
+    def hint(self, rect):
+        # Motion area is only used while no code position is known
+        if self.rect is None and rect is not None:
+            self.rect = rect
+            self._misses = 0
+            self._from_motion = True
+
+    def update(self, rect):
+        self.rect = rect
+        self._misses = 0
+        self._from_motion = False
+
+    def region(self, shape):
+        """Padded crop (x, y, w, h) clipped to the frame, or None without a ROI."""
+        if self.rect is None:
+            return None
+        height, width = shape[:2]
+        x, y, w, h = self.rect
+        pad_x, pad_y = int(w * self.padding), int(h * self.padding)
+        x0, y0 = max(0, x - pad_x), max(0, y - pad_y)
+        x1, y1 = min(width, x + w + pad_x), min(height, y + h + pad_y)
+        if x1 - x0 >= width and y1 - y0 >= height:
+            return None  # crop would be the whole frame anyway
+        return (x0, y0, x1 - x0, y1 - y0)
+
+    def decode(self, decoder, luma) -> list:
+        region = self.region(luma.shape)
+        if region is not None:
+            x0, y0, w, h = region
+            codes = decoder.decode(luma[y0:y0 + h, x0:x0 + w])
+            if codes:
+                self.stats["roi_hits"] += 1
+                codes = [QRResult(c.data, (c.rect[0] + x0, c.rect[1] + y0, c.rect[2], c.rect[3])) for c in codes]
+                self.update(codes[0].rect)
+                return codes
+            self.stats["roi_misses"] += 1
+            self._misses += 1
+            # A motion hint gets a single try, a code position a few frames to reappear
+            if self._from_motion or self._misses >= self.max_misses:
+                self.reset()
+
+        self.stats["full_frame"] += 1
+        codes = decoder.decode(luma)
+        if codes:
+            self.update(codes[0].rect)
+        return codes
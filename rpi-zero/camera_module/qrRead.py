@@ -5,22 +5,119 @@ camera_module.py
 Driver for RaspberryPi Camera.
 Works on Raspberry Pi Zero.
 """
+import logging
 import os
 import cv2
 import time
 import json
+import glob
 from datetime import datetime
-from pyzbar import pyzbar
-from picamera2 import Picamera2
+import numpy as np
+from picamera2 import Picamera2, MappedArray
+import queue
 import threading
 
+from camera_module.qrDecoders import PyzbarDecoder, RoiTracker
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAIN_SIZE = (1200, 1800)
+DEFAULT_FRAME_RATE = 5.0
+DEFAULT_LORES_SIZE = (400, 600)
+# Candidate lores sizes (same 2:3 aspect as the main stream), smallest first
+LORES_CANDIDATES = [(240, 360), (320, 480), (400, 600), (480, 720), (600, 900)]
+DEFAULT_MIN_DECODE_RATE = 0.95
+DEFAULT_RESULT_QUEUE_SIZE = 4
+
+SCAN_MODE_MAIN = "main"
+SCAN_MODE_LORES = "lores"
+
+# Scan worker states
+STATE_RUNNING = "running"
+STATE_PAUSED = "paused"
+STATE_STOPPED = "stopped"
+
+
+def create_scan_configuration(picam, lores_size=None):
+    """Video configuration for scanning, with an optional YUV420 lores stream."""
+    if lores_size is None:
+        return picam.create_video_configuration(
+            main={"size": DEFAULT_MAIN_SIZE, "format": "RGB888"}, buffer_count=2,
+            controls={"FrameRate": DEFAULT_FRAME_RATE}
+        )
+    # Nothing reads the main stream in lores mode, but the ISP needs one at least as large as lores:
+    # a YUV420 main of the same size keeps both buffers small instead of a full 1200x1800 RGB888 frame
+    return picam.create_video_configuration(
+        main={"size": lores_size, "format": "YUV420"},
+        lores={"size": lores_size, "format": "YUV420"}, buffer_count=2,
+        controls={"FrameRate": DEFAULT_FRAME_RATE}
+    )
+
+
+def load_calibration_frames(directory: str) -> list:
+    """Load grayscale frames (photos of our printed codes taken by the camera) for benchmarking."""
+    frames = []
+    for path in sorted(glob.glob(os.path.join(directory, "*"))):
+        frame = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+        if frame is not None:
+            frames.append(frame)
+    return frames
+
+
+def benchmark_lores_sizes(frames: list, candidates=LORES_CANDIDATES, min_decode_rate: float = DEFAULT_MIN_DECODE_RATE, decoder=None):
+    """Pick the smallest lores size that still decodes the calibration frames reliably.
+
+    Returns (size, results) where results maps size -> (decode rate, mean decode time in ms).
+    Falls back to DEFAULT_LORES_SIZE when nothing decodes well enough.
+    """
+    results = {}
+    if not frames:
+        return DEFAULT_LORES_SIZE, results
+    if decoder is None:
+        decoder = PyzbarDecoder()
+
+    for size in candidates:
+        decoded = 0
+        start = time.perf_counter()
+        for frame in frames:
+            small = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+            if decoder.decode(small):
+                decoded += 1
+        elapsed_ms = (time.perf_counter() - start) * 1000 / len(frames)
+        results[size] = (decoded / len(frames), elapsed_ms)
+
+    for size in candidates:
+        if results[size][0] >= min_decode_rate:
+            return size, results
+    return DEFAULT_LORES_SIZE, results
+
+
 class CameraModule:
-    def __init__(self, picam):
+    def __init__(self, picam, scan_mode: str = SCAN_MODE_MAIN, gate=None, decoder=None, verifier=None):
         self.picam = picam
+        self.scan_mode = scan_mode
+        self.gate = gate  # optional FrameGate, frames it rejects never reach the decoder
+        self.verifier = verifier  # optional QRTokenVerifier, rejected codes never leave the scan thread
+        self.decoder = decoder if decoder is not None else PyzbarDecoder()
+        self.roi = RoiTracker()
+        self.stats = {"frames": 0, "gated": 0, "decoded": 0, "found": 0}
+        self.tracer = None  # optional Tracer receiving capture and decode times
+        self._luma = None
+        if scan_mode == SCAN_MODE_LORES:
+            lores = picam.camera_configuration()["lores"]
+            self.lores_size = tuple(lores["size"])
+            self.lores_stride = lores["stride"]
+            width, height = self.lores_size
+            # Reused buffer, only needed when the lores stride has row padding
+            self._luma = np.empty((height, width), dtype=np.uint8)
         self.is_started = True
         self.qr_result = None
         self.qr_event = threading.Event()
-        self._stop_event = threading.Event()
+        self.on_result = None  # optional callback(qr_text) called from the scan thread
+        self.results = queue.Queue(maxsize=DEFAULT_RESULT_QUEUE_SIZE)
+        self._state = STATE_PAUSED
+        self._generation = 0  # bumped by flush(), results of older frames are dropped
+        self._cond = threading.Condition()
         self._thread = None
         print("Camera ready for scanning.")
 
@@ -32,101 +129,230 @@ class CameraModule:
 
     def cleanup(self):
         print("Cleaning up camera...")
+        self.shutdown()
         if self.picam:
             if self.is_started:
                 self.picam.stop()
                 self.is_started = False
             self.picam.close()
             self.picam = None
+        if hasattr(self.decoder, "close"):
+            self.decoder.close()
         print("Camera shutdown complete.")
 
     def live_scan(self, save_dir: str = None, timeout: int = 0):
+        """Body of the long-lived scan worker. Sleeps on a condition variable while paused."""
         if not self.is_started:
             raise RuntimeError("Camera not started")
 
         if save_dir is not None:
             os.makedirs(save_dir, exist_ok=True)
             print("[INFO] Starting live QR scan...")
-        
-        start_time = time.time()
 
+        last_generation = None
         try:
-            while not self._stop_event.is_set():
-                frame = self.picam.capture_array()
-                frame_gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
-                qr_codes = pyzbar.decode(frame_gray)
-
-                if qr_codes:  # stop at the first detected QR
-                    qr = qr_codes[0]
-                    data_bytes = qr.data
-                    data_text = data_bytes.decode("utf-8", errors="ignore")
-                    (x, y, w, h) = qr.rect
-
-                    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-
-                    if save_dir is not None:
-                        # Save cropped QR image
-                        crop = frame_gray[y:y + h, x:x + w]
-                        img_path = os.path.join(save_dir, f"qr_{timestamp}.jpg")
-                        cv2.imwrite(img_path, crop)
-
-                    # Convert to JSON
-                    qr_json = self.qr_to_json(data_text)
-                    if save_dir is not None:
-                        json_path = os.path.join(save_dir, f"qr_{timestamp}.json")
-                        with open(json_path, "w", encoding="utf-8") as f:
-                            json.dump(qr_json, f, indent=2)
-
-                    # print(f"[INFO] QR detected: {data_text}")
-                    if save_dir is not None:
-                        print(f"[INFO] Saved image: {img_path}")
-                        print(f"[INFO] Saved JSON:  {json_path}")
-
-                    self.qr_result = data_text
-                    self.qr_event.set()
-                    return
-                
-                time.sleep(0.05)
-
-        except Exception:
-            pass
+            while True:
+                with self._cond:
+                    while self._state == STATE_PAUSED:
+                        self._cond.wait()
+                    if self._state == STATE_STOPPED:
+                        return
+                    generation = self._generation
+
+                if generation != last_generation:
+                    # New scan session, motion is measured against a fresh reference frame
+                    last_generation = generation
+                    if self.gate is not None:
+                        self.gate.reset()
+                    # Frames still being decoded in parallel were captured before the flush/pause.
+                    # Cancelled here on the scan thread, the decoder isn't safe to use from pause()/flush()
+                    if hasattr(self.decoder, "cancel"):
+                        self.decoder.cancel()
+
+                try:
+                    if self.scan_mode == SCAN_MODE_LORES:
+                        data_text = self._scan_lores(save_dir)
+                    else:
+                        data_text = self._scan_main(save_dir)
+                except Exception as e:
+                    logger.warning("QR scan failed: %s", e)
+                    with self._cond:
+                        self._cond.wait(0.1)  # back off, but wake up at once on pause/stop
+                    continue
+
+                if data_text is not None and self.verifier is not None:
+                    # Scanning goes on after a rejected code, the verifier cache keeps rescans of it cheap
+                    data_text = self.verifier.check(data_text)
+                if data_text is not None:
+                    self._deliver(data_text, generation)
+
         finally:
             print("QR scanning thread exiting.")
 
+    def _deliver(self, data_text: str, generation: int):
+        with self._cond:
+            # Frame started before a flush/pause, its result is stale
+            if generation != self._generation or self._state != STATE_RUNNING:
+                return
+            # Stop at the first detected QR until resumed
+            self._state = STATE_PAUSED
+            if self.results.full():
+                self.results.get_nowait()  # keep the newest results
+            self.results.put_nowait(data_text)
+            self.qr_result = data_text
+            self.qr_event.set()
+
+        if self.on_result is not None:
+            self.on_result(data_text)
+
+    def _scan_main(self, save_dir):
+        start = time.monotonic_ns()
+        frame = self.picam.capture_array()
+        if self.tracer is not None:
+            self.tracer.record("qr_capture", time.monotonic_ns() - start)
+        # Green channel is a good enough luma estimate for gating, no conversion of rejected frames
+        if not self._passes_gate(frame[:, :, 1]):
+            return None
+        frame_gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+        qr_codes = self._decode(frame_gray)
+        if not qr_codes:
+            return None
+        return self._handle_qr(qr_codes[0], frame_gray, save_dir)
+
+    def _scan_lores(self, save_dir):
+        # Decode the Y plane of the YUV420 lores stream in place, without RGB conversion
+        start = time.monotonic_ns()
+        request = self.picam.capture_request()
+        if self.tracer is not None:
+            self.tracer.record("qr_capture", time.monotonic_ns() - start)
+        try:
+            with MappedArray(request, "lores") as m:
+                width, height = self.lores_size
+                y_plane = m.array.reshape(-1)[:self.lores_stride * height].reshape(height, self.lores_stride)[:, :width]
+                if not self._passes_gate(y_plane):
+                    return None
+                if not y_plane.flags.c_contiguous:
+                    np.copyto(self._luma, y_plane)
+                    y_plane = self._luma
+                qr_codes = self._decode(y_plane)
+                if not qr_codes:
+                    return None
+                return self._handle_qr(qr_codes[0], y_plane, save_dir)
+        finally:
+            request.release()
+
+    def _passes_gate(self, luma) -> bool:
+        self.stats["frames"] += 1
+        if self.gate is not None:
+            if not self.gate.check(luma):
+                self.stats["gated"] += 1
+                return False
+            self.roi.hint(self.gate.motion_rect)
+        return True
+
+    def _decode(self, luma):
+        # Padded crop around the last code / motion first, full frame as fallback
+        self.stats["decoded"] += 1
+        start = time.monotonic_ns()
+        qr_codes = self.roi.decode(self.decoder, luma)
+        if self.tracer is not None:
+            self.tracer.record("qr_decode", time.monotonic_ns() - start)
+        if qr_codes:
+            self.stats["found"] += 1
+        return qr_codes
+
+    def getStats(self) -> dict:
+        stats = dict(self.stats)
+        stats["decoder"] = self.decoder.name
+        stats["roi"] = dict(self.roi.stats)
+        if self.gate is not None:
+            stats["gate"] = dict(self.gate.stats)
+        if self.verifier is not None:
+            stats["tokens"] = self.verifier.getStats()
+        return stats
+
+    def _handle_qr(self, qr, frame_gray, save_dir):
+        data_bytes = qr.data
+        data_text = data_bytes.decode("utf-8", errors="ignore")
+        (x, y, w, h) = qr.rect
+
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+
+        if save_dir is not None:
+            # Save cropped QR image
+            crop = frame_gray[y:y + h, x:x + w]
+            img_path = os.path.join(save_dir, f"qr_{timestamp}.jpg")
+            cv2.imwrite(img_path, crop)
+
+        # Convert to JSON
+        qr_json = self.qr_to_json(data_text)
+        if save_dir is not None:
+            json_path = os.path.join(save_dir, f"qr_{timestamp}.json")
+            with open(json_path, "w", encoding="utf-8") as f:
+                json.dump(qr_json, f, indent=2)
+
+        # print(f"[INFO] QR detected: {data_text}")
+        if save_dir is not None:
+            print(f"[INFO] Saved image: {img_path}")
+            print(f"[INFO] Saved JSON:  {json_path}")
+
+        return data_text
+
     def start_background_scan(self, **kwargs):
-        if self._thread and self._thread.is_alive():
-            print("Scan already running.")
-            return
-        self._stop_event.clear()
-        self.qr_event.clear()
-        self._thread = threading.Thread(target=self.live_scan, kwargs=kwargs, daemon=True)
-        self._thread.start()
+        """Start the scan worker on first use, afterwards just resume it."""
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self.live_scan, kwargs=kwargs, daemon=True)
+            self._thread.start()
+        self.resume()
+
+    def pause(self):
+        # Doesn't wait for the current frame, its result is discarded by _deliver
+        with self._cond:
+            if self._state == STATE_RUNNING:
+                self._state = STATE_PAUSED
+                self._generation += 1
+
+    def flush(self):
+        with self._cond:
+            self._generation += 1
+            while not self.results.empty():
+                self.results.get_nowait()
+            self.qr_event.clear()
+
+    def resume(self):
+        self.flush()
+        with self._cond:
+            if self._state == STATE_PAUSED:
+                self._state = STATE_RUNNING
+                self._cond.notify()
 
     def stop_scan(self):
-        self._stop_event.set()
+        self.pause()
+
+    def shutdown(self):
+        with self._cond:
+            self._state = STATE_STOPPED
+            self._cond.notify()
         if self._thread:
             self._thread.join()
+            self._thread = None
             print("Background QR scan stopped.")
 
 if __name__ == "__main__":
     print("Initializing camera...")
     picam = Picamera2()
-    config = picam.create_video_configuration(
-        main={"size": (1200, 1800), "format": "RGB888"}, buffer_count=2,
-        controls={"FrameRate": 5.0}
-    )
+    config = create_scan_configuration(picam, DEFAULT_LORES_SIZE)
     picam.configure(config)
     picam.start()
 
-    cam = CameraModule(picam)
+    cam = CameraModule(picam, scan_mode=SCAN_MODE_LORES)
     cam.start_background_scan()
 
     print("Show qr code to camer in order to read data...")
     while True:
         if cam.qr_event.wait(timeout=5):
             print("QR code detected!")
-            print(f"QR Data: \n {cam.qr_result}")
-            cam.stop_scan()
+            print(f"QR Data: \n {cam.results.get()}")
             cam.cleanup()
             break
         else:
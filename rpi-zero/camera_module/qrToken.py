@@ -0,0 +1,240 @@
+"""
+qrToken.py
+
+Signed QR tokens and their on-device verifier.
+A signed token carries the credential code, the doors it opens and its validity
+window, so forged codes, codes for other doors, expired guest codes and random
+product QR codes are rejected on the device in microseconds, without a broker
+round trip. Usage limits and revocation stay on the server, the verifier only
+decides what is worth asking about.
+
+Token text (what is printed in the QR code):
+    DQ1.<base64url(body)>.<base64url(signature)>
+body (big endian):
+    alg          u8     ALG_HMAC_SHA256 (16 byte truncated tag) or ALG_ED25519 (64 byte signature)
+    valid_from   u32    unix time
+    valid_until  u32    unix time
+    code         16 B   qr_codes.code (32 hex characters), forwarded as the credential
+    doors        rest   UTF-8, comma separated door ids, empty for every door
+The signature covers b"DQ1" + body. Ed25519 needs the `cryptography` package,
+HMAC only the standard library.
+"""
+import base64
+import binascii
+import hashlib
+import hmac
+import logging
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+TOKEN_PREFIX = "DQ1."
+ALG_HMAC_SHA256 = 1
+ALG_ED25519 = 2
+HMAC_TAG_SIZE = 16
+ED25519_SIGNATURE_SIZE = 64
+
+DEFAULT_CACHE_SIZE = 1024  # distinct QR texts remembered by the verifier
+DEFAULT_CLOCK_LEEWAY = 120  # seconds of device clock drift tolerated at both ends of the window
+
+_HEADER = struct.Struct(">BII16s")
+_SIGNED_PREFIX = TOKEN_PREFIX[:-1].encode("ascii")
+
+# Rejection reasons, also the keys of the verifier stats
+REJECT_UNSIGNED = "unsigned"
+REJECT_MALFORMED = "malformed"
+REJECT_FORGED = "forged"
+REJECT_FOREIGN = "foreign"
+REJECT_EXPIRED = "expired"
+REJECT_NOT_YET_VALID = "not_yet_valid"
+
+
+class QRTokenError(Exception):
+    pass
+
+
+class QRToken:
+    __slots__ = ("alg", "valid_from", "valid_until", "code", "doors")
+
+    def __init__(self, alg: int, valid_from: int, valid_until: int, code: str, doors: tuple):
+        self.alg = alg
+        self.valid_from = valid_from
+        self.valid_until = valid_until
+        self.code = code  # hex, the identifier sent in the access request
+        self.doors = doors  # empty for every door
+
+    def opens(self, door_id: str) -> bool:
+        return not self.doors or door_id in self.doors
+
+
+def _b64encode(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def _hmac_tag(key: bytes, body: bytes) -> bytes:
+    return hmac.new(key, _SIGNED_PREFIX + body, hashlib.sha256).digest()[:HMAC_TAG_SIZE]
+
+
+def encode_body(code: str, valid_from: float, valid_until: float, doors=(), alg: int = ALG_HMAC_SHA256) -> bytes:
+    code_bytes = bytes.fromhex(code)
+    if len(code_bytes) != 16:
+        raise QRTokenError("Token code has to be 16 bytes (32 hex characters)")
+    if any("," in door for door in doors):
+        raise QRTokenError("Door ids in a token can't contain commas")
+    return _HEADER.pack(alg, int(valid_from), int(valid_until), code_bytes) + ",".join(doors).encode("utf-8")
+
+
+def sign_token(code: str, valid_from: float, valid_until: float, doors=(), key: bytes = None, private_key=None) -> str:
+    """Token text for a QR code, signed with the HMAC `key` or an Ed25519 `private_key` (cryptography object)."""
+    if private_key is not None:
+        body = encode_body(code, valid_from, valid_until, doors, ALG_ED25519)
+        signature = private_key.sign(_SIGNED_PREFIX + body)
+    elif key is not None:
+        body = encode_body(code, valid_from, valid_until, doors, ALG_HMAC_SHA256)
+        signature = _hmac_tag(key, body)
+    else:
+        raise QRTokenError("A signing key is required")
+    return f"{TOKEN_PREFIX}{_b64encode(body)}.{_b64encode(signature)}"
+
+
+def load_public_key(raw_hex: str):
+    """Ed25519 public key from its 32 raw bytes in hex."""
+    try:
+        from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PublicKey
+    except ImportError as e:
+        raise QRTokenError("Ed25519 QR tokens need the cryptography package") from e
+    return Ed25519PublicKey.from_public_bytes(bytes.fromhex(raw_hex))
+
+
+class QRTokenVerifier:
+    """check(text) -> credential to forward or None, called from the QR scan thread."""
+
+    def __init__(self, door_id: str, hmac_keys=(), public_keys=(),
+                 allow_unsigned: bool = False,
+                 cache_size: int = DEFAULT_CACHE_SIZE,
+                 leeway: float = DEFAULT_CLOCK_LEEWAY):
+        self.door_id = door_id
+        self.hmac_keys = list(hmac_keys)  # several keys while a key is being rotated
+        self.public_keys = list(public_keys)
+        self.allow_unsigned = allow_unsigned  # forward legacy (unsigned) codes as they are
+        self.cache_size = cache_size
+        self.leeway = leeway
+        self.stats = {"accepted": 0, "cache_hits": 0, REJECT_UNSIGNED: 0, REJECT_MALFORMED: 0,
+                      REJECT_FORGED: 0, REJECT_FOREIGN: 0, REJECT_EXPIRED: 0, REJECT_NOT_YET_VALID: 0}
+        # text -> QRToken when authentic for this door, rejection reason otherwise. Both
+        # outcomes only depend on the text, the validity window is checked on every scan.
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def check(self, text: str, now: float = None):
+        with self._lock:
+            verdict = self._cache.get(text)
+            if verdict is not None:
+                self._cache.move_to_end(text)
+                self.stats["cache_hits"] += 1
+        if verdict is None:
+            verdict = self._verify(text)
+            with self._lock:
+                self._cache[text] = verdict
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+
+        if isinstance(verdict, str):
+            return self._reject(verdict, text)
+        if verdict is _UNSIGNED:
+            self.stats["accepted"] += 1
+            return text
+        now = time.time() if now is None else now
+        if now + self.leeway < verdict.valid_from:
+            return self._reject(REJECT_NOT_YET_VALID, text)
+        if now - self.leeway >= verdict.valid_until:
+            return self._reject(REJECT_EXPIRED, text)
+        self.stats["accepted"] += 1
+        return verdict.code
+
+    def _reject(self, reason: str, text: str):
+        self.stats[reason] += 1
+        logger.debug(f"Rejected QR code ({reason}): {text[:32]!r}")
+        return None
+
+    def _verify(self, text: str):
+        if not text.startswith(TOKEN_PREFIX):
+            return _UNSIGNED if self.allow_unsigned else REJECT_UNSIGNED
+        try:
+            body_text, signature_text = text[len(TOKEN_PREFIX):].split(".")
+            body = _b64decode(body_text)
+            signature = _b64decode(signature_text)
+            alg, valid_from, valid_until, code = _HEADER.unpack_from(body)
+            doors = body[_HEADER.size:].decode("utf-8")
+        except (ValueError, binascii.Error, struct.error):
+            return REJECT_MALFORMED
+
+        if alg == ALG_HMAC_SHA256:
+            authentic = any(hmac.compare_digest(_hmac_tag(key, body), signature) for key in self.hmac_keys)
+        elif alg == ALG_ED25519:
+            authentic = len(signature) == ED25519_SIGNATURE_SIZE and self._ed25519_valid(body, signature)
+        else:
+            return REJECT_MALFORMED
+        if not authentic:
+            return REJECT_FORGED
+
+        token = QRToken(alg, valid_from, valid_until, code.hex(), tuple(doors.split(",")) if doors else ())
+        if not token.opens(self.door_id):
+            return REJECT_FOREIGN
+        return token
+
+    def _ed25519_valid(self, body: bytes, signature: bytes) -> bool:
+        from cryptography.exceptions import InvalidSignature
+        for public_key in self.public_keys:
+            try:
+                public_key.verify(signature, _SIGNED_PREFIX + body)
+                return True
+            except InvalidSignature:
+                continue
+        return False
+
+    def getStats(self) -> dict:
+        stats = dict(self.stats)
+        stats["cached"] = len(self._cache)
+        return stats
+
+
+_UNSIGNED = object()  # verdict of a legacy code forwarded as it is
+
+
+if __name__ == "__main__":
+    # Cost of a first verification and of a repeated scan of the same code
+    import os
+    import sys
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    key = os.urandom(32)
+    now = time.time()
+    valid = sign_token(os.urandom(16).hex(), now - 60, now + 3600, ("main",), key=key)
+    forged = valid[:-4] + ("AAAA" if not valid.endswith("AAAA") else "BBBB")
+    texts = [sign_token(os.urandom(16).hex(), now - 60, now + 3600, ("main",), key=key) for _ in range(count)]
+    print(f"token: {valid} ({len(valid)} characters)")
+
+    verifier = QRTokenVerifier("main", hmac_keys=[key], cache_size=count)
+    start = time.perf_counter_ns()
+    for text in texts:
+        verifier.check(text, now)
+    first_ns = (time.perf_counter_ns() - start) / count
+    start = time.perf_counter_ns()
+    for text in texts:
+        verifier.check(text, now)
+    cached_ns = (time.perf_counter_ns() - start) / count
+    start = time.perf_counter_ns()
+    for _ in range(count):
+        verifier.check(forged, now)
+    forged_ns = (time.perf_counter_ns() - start) / count
+    print(f"first scan: {first_ns / 1000:.2f} us, repeated scan: {cached_ns / 1000:.2f} us, "
+          f"repeated forgery: {forged_ns / 1000:.2f} us")
+    print(verifier.getStats())
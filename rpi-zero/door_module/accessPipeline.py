@@ -0,0 +1,217 @@
+"""
+accessPipeline.py
+
+Shared request/decision pipeline used by every credential reader.
+A credential (rfid uid, qr text or fingerprint eigenvalues) is published
+to the MQTT request topic and the pipeline waits for the backend decision.
+"""
+import asyncio
+import base64
+import json
+import logging
+import time
+import uuid
+
+import mqtt_module.mqttClient as mqttClient
+from mqtt_module.wireFormat import (WIRE_FORMAT_JSON, WIRE_FORMAT_BINARY, BINARY_CONTENT_TYPE,
+                                    encode_request, decode_decision, is_binary_decision)
+from door_module.admissionControl import ADMITTED, COALESCED, MERGED
+from journal_module.eventJournal import KIND_ATTEMPT, KIND_DECISION
+from telemetry_module.latencyTrace import STAGE_ADMITTED, STAGE_PUBLISHED, STAGE_DECIDED, STAGE_TIMED_OUT, STAGE_ACTUATED
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RESPONSE_TIMEOUT_NS = 5 * 1000000000
+DEFAULT_DOOR_ID = "main"
+DECISION_RESULTS = {True: "allow", False: "deny", None: "none"}
+
+
+def createJSONRequest(type, data, request_id: str = None, door_id: str = None):
+    if type == "fingerprint":
+        data = base64.b64encode(data).decode("ascii")
+
+    request = {"type" : type,
+               "data" : data}
+    if request_id is not None:
+        request["request_id"] = request_id
+    if door_id is not None:
+        request["door_id"] = door_id
+
+    json_request = json.dumps(request)
+
+    return json_request
+
+
+def decodeJSONDecision(data):
+    parsed_data = json.loads(data)
+    if parsed_data["status"] == "allow":
+        return True
+    elif parsed_data["status"] == "deny":
+        return False
+    else:
+        logger.error(f"Received invalid status value. Received value: {parsed_data['status']}")
+        return False
+
+
+def decodeDecision(data):
+    """Decision from either a binary envelope (bytes) or a JSON message."""
+    if isinstance(data, bytes) and is_binary_decision(data):
+        status, _ = decode_decision(data)
+        if status not in ("allow", "deny"):
+            logger.error(f"Received invalid status value. Received value: {status}")
+        return status == "allow"
+    return decodeJSONDecision(data)
+
+
+class AccessPipeline:
+
+    def __init__(self, mqtt,
+                 response_timeout_ns: int = DEFAULT_RESPONSE_TIMEOUT_NS,
+                 door=None,
+                 cache=None,
+                 admission=None,
+                 tracer=None,
+                 door_id: str = DEFAULT_DOOR_ID,
+                 wire_format: str = WIRE_FORMAT_JSON,
+                 request_topic: str = None,
+                 decision_topic: str = None,
+                 events=None):
+        self.mqtt = mqtt
+        self.door_id = door_id
+        # Per door topic pair, None uses the pair configured in the MQTT client
+        self.request_topic = request_topic
+        self.decision_topic = decision_topic
+        self.wire_format = wire_format  # WIRE_FORMAT_BINARY publishes the compact envelope instead of JSON
+        self.door = door  # DoorController acting on the decisions without blocking the loop
+        self.cache = cache  # optional DecisionCache used when the broker doesn't answer
+        self.admission = admission  # optional AdmissionController deduplicating reads before they are published
+        self.tracer = tracer  # optional Tracer, every attempt is traced under its request id
+        self.events = events  # optional EventJournal keeping every attempt and decision for the access logs
+        self.response_timeout_ns = response_timeout_ns
+        self.stats = {"requests": 0, "allowed": 0, "denied": 0, "undecided": 0, "offline": 0}
+
+    async def handle(self, cred_type: str, data, read_ns: int = None):
+        """Publish a credential and act on the decision. Returns True/False, or None on timeout/error.
+
+        `read_ns` is the time.monotonic_ns() of the read, used to drop reads that waited too long.
+        """
+        request_id = uuid.uuid4().hex
+        trace = None
+        if self.tracer is not None:
+            trace = self.tracer.start(cred_type, read_ns, trace_id=request_id)
+
+        ticket = None
+        if self.admission is not None:
+            ticket = self.admission.admit(cred_type, data, read_ns)
+            if ticket.outcome == MERGED:
+                # Shares the decision of the request already in flight instead of publishing another one
+                allowed = await asyncio.shield(ticket.future)
+                self._record_unsent(request_id, cred_type, data, allowed, MERGED, read_ns)
+                return self._act(allowed, trace)
+            if ticket.outcome == COALESCED:
+                self._record_unsent(request_id, cred_type, data, ticket.result, COALESCED, read_ns)
+                return self._act(ticket.result, trace)
+            if ticket.outcome != ADMITTED:
+                # Stale or busy reads are dropped, the journal still shows them
+                self._record_unsent(request_id, cred_type, data, None, ticket.outcome, read_ns)
+                return None
+        if trace is not None:
+            trace.mark(STAGE_ADMITTED)
+        if self.events is not None:
+            self.events.record(KIND_ATTEMPT, request_id, self.door_id, cred_type, data)
+
+        if self.wire_format == WIRE_FORMAT_BINARY:
+            request = encode_request(cred_type, data, request_id, self.door_id, read_ns)
+            content_type = BINARY_CONTENT_TYPE
+            logger.debug("Binary request %s: %d bytes", request_id, len(request))
+        else:
+            request = createJSONRequest(cred_type, data, request_id, self.door_id)
+            content_type = None
+            logger.debug("Json request: %s", request)
+
+        allowed = None
+        self.stats["requests"] += 1
+        try:
+            allowed = await self._request_decision(request, request_id, trace, content_type)
+        finally:
+            if ticket is not None:
+                self.admission.finish(ticket, allowed)
+
+        source = "online" if allowed is not None else None
+        if self.cache is not None:
+            if allowed is None:
+                allowed = self.cache.lookup(cred_type, data)
+                logger.debug("Broker didn't answer, offline cache decision: %s", allowed)
+                if allowed is not None:
+                    source = "cache"
+            else:
+                self.cache.remember(cred_type, data, allowed)
+
+        if allowed is None:
+            logger.warning("No decision received for %s request %s", cred_type, request_id)
+        self._record_decision(request_id, cred_type, data, allowed, source, read_ns)
+        return self._act(allowed, trace)
+
+    def _record_decision(self, request_id: str, cred_type: str, data, allowed, source: str, read_ns: int = None):
+        if self.events is None:
+            return
+        latency_ms = (time.monotonic_ns() - read_ns) / 1000000 if read_ns is not None else None
+        self.events.record(KIND_DECISION, request_id, self.door_id, cred_type, data,
+                           result=DECISION_RESULTS[allowed], source=source, latency_ms=latency_ms)
+
+    def _record_unsent(self, request_id: str, cred_type: str, data, allowed, source: str, read_ns: int = None):
+        # Read decided by admission control (the admission outcome is the source), never published
+        if self.events is None:
+            return
+        self.events.record(KIND_ATTEMPT, request_id, self.door_id, cred_type, data, source=source)
+        self._record_decision(request_id, cred_type, data, allowed, source, read_ns)
+
+    def _act(self, allowed, trace=None):
+        if allowed:
+            self.stats["allowed"] += 1
+            logger.info("Door %s: allowed", self.door_id)
+            if self.door is not None:
+                self.door.grant()
+        elif allowed is False:
+            self.stats["denied"] += 1
+            logger.info("Door %s: denied", self.door_id)
+            if self.door is not None:
+                self.door.deny()
+        else:
+            self.stats["undecided"] += 1
+
+        if trace is not None:
+            trace.mark(STAGE_ACTUATED)
+            self.tracer.finish(trace)
+        return allowed
+
+    async def _request_decision(self, request, request_id: str, trace=None, content_type: str = None):
+        if not self.mqtt.isConnected():
+            # Degraded mode: the client is reconnecting, the cache decides now instead of after publish_timeout
+            self.stats["offline"] += 1
+            if trace is not None:
+                trace.mark(STAGE_TIMED_OUT)
+            return None
+        loop = asyncio.get_running_loop()
+        timeout = self.response_timeout_ns / 1000000000
+        # sendRequest blocks until the broker acknowledges the publish
+        future = await loop.run_in_executor(None, self.mqtt.sendRequest, request, request_id, timeout, content_type,
+                                            self.request_topic, self.decision_topic)
+        if trace is not None:
+            trace.mark(STAGE_PUBLISHED)
+        try:
+            msg = await asyncio.wrap_future(future)
+            if trace is not None:
+                trace.mark(STAGE_DECIDED)
+        except TimeoutError:
+            if trace is not None:
+                trace.mark(STAGE_TIMED_OUT)
+            return None
+        except mqttClient.MQTTError:
+            logger.warning("MQTT error while waiting for decision %s", request_id)
+            if trace is not None:
+                trace.mark(STAGE_TIMED_OUT)
+            return None
+
+        logger.debug("Decision message: %s", msg)
+        return decodeDecision(msg)
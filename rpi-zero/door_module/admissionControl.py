@@ -0,0 +1,117 @@
+"""
+admissionControl.py
+
+Admission layer between the credential readers and MQTTClient.sendRequest.
+- identical credentials (same rfid uid / qr text, or a fingerprint template
+  within a small Hamming distance) read again within `window` seconds reuse the
+  previous decision instead of publishing a new request,
+- a read of a credential that is already in flight is merged into that request,
+- at most `max_in_flight` requests per door are published at once,
+- reads that waited longer than `max_age` seconds before admission are dropped.
+"""
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WINDOW = 3.0  # seconds
+DEFAULT_MAX_IN_FLIGHT = 2
+DEFAULT_MAX_AGE = 2.0  # seconds between the read and its admission
+DEFAULT_FINGERPRINT_MAX_DISTANCE = 0.1  # fraction of differing bits for "near identical" templates
+FINGERPRINT_HEADER_SIZE = 3  # leading bytes of the eigenvalue packet that are not template data
+
+# Admission outcomes
+ADMITTED = "admitted"
+COALESCED = "coalesced"
+MERGED = "merged"
+STALE = "stale"
+BUSY = "busy"
+
+
+class AdmissionTicket:
+    """Result of AdmissionController.admit(). Admitted tickets must be completed with finish()."""
+
+    def __init__(self, outcome: str, key=None, result=None, future: asyncio.Future = None):
+        self.outcome = outcome
+        self.key = key
+        self.result = result  # previous decision for coalesced reads
+        self.future = future  # decision of the in-flight request for merged reads
+
+    @property
+    def admitted(self) -> bool:
+        return self.outcome == ADMITTED
+
+
+class AdmissionController:
+
+    def __init__(self, window: float = DEFAULT_WINDOW,
+                 max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+                 max_age: float = DEFAULT_MAX_AGE,
+                 fingerprint_max_distance: float = DEFAULT_FINGERPRINT_MAX_DISTANCE):
+        self.window = window
+        self.max_in_flight = max_in_flight
+        self.max_age = max_age
+        self.fingerprint_max_distance = fingerprint_max_distance
+
+        self._in_flight = {}  # key -> asyncio.Future resolved with the decision
+        self._recent = {}  # key -> (monotonic time of the decision, decision)
+        self.stats = {ADMITTED: 0, COALESCED: 0, MERGED: 0, STALE: 0, BUSY: 0}
+
+    def admit(self, cred_type: str, data, read_ns: int = None) -> AdmissionTicket:
+        """Decide what to do with a read. Must be called from the event loop thread."""
+        now = time.monotonic()
+        if read_ns is not None and now - read_ns / 1000000000 > self.max_age:
+            return self._count(AdmissionTicket(STALE))
+
+        self._expire(now)
+        key = self._key(cred_type, data)
+
+        if key in self._in_flight:
+            return self._count(AdmissionTicket(MERGED, key, future=self._in_flight[key]))
+        if key in self._recent:
+            return self._count(AdmissionTicket(COALESCED, key, result=self._recent[key][1]))
+        if len(self._in_flight) >= self.max_in_flight:
+            return self._count(AdmissionTicket(BUSY, key))
+
+        self._in_flight[key] = asyncio.get_running_loop().create_future()
+        return self._count(AdmissionTicket(ADMITTED, key))
+
+    def finish(self, ticket: AdmissionTicket, result):
+        """Record the decision of an admitted request and wake up merged reads."""
+        future = self._in_flight.pop(ticket.key, None)
+        if future is not None and not future.done():
+            future.set_result(result)
+        # Timeouts / broker errors are not remembered, the next read should try again
+        if result is not None:
+            self._recent[ticket.key] = (time.monotonic(), result)
+
+    def _count(self, ticket: AdmissionTicket) -> AdmissionTicket:
+        self.stats[ticket.outcome] += 1
+        if not ticket.admitted:
+            logger.debug(f"Credential read {ticket.outcome}")
+        return ticket
+
+    def _expire(self, now: float):
+        for key in [k for k, (t, _) in self._recent.items() if now - t > self.window]:
+            del self._recent[key]
+
+    def _key(self, cred_type: str, data):
+        if cred_type != "fingerprint":
+            return (cred_type, data)
+
+        # Near identical templates map to the key of the template already known
+        template = int.from_bytes(data[FINGERPRINT_HEADER_SIZE:], "big")
+        max_bits = self.fingerprint_max_distance * 8 * max(len(data) - FINGERPRINT_HEADER_SIZE, 1)
+        for key in list(self._in_flight) + list(self._recent):
+            if key[0] == "fingerprint" and len(key[1]) == len(data):
+                known = int.from_bytes(key[1][FINGERPRINT_HEADER_SIZE:], "big")
+                if (template ^ known).bit_count() <= max_bits:
+                    return key
+        return (cred_type, bytes(data))
+
+    def getStats(self) -> dict:
+        stats = dict(self.stats)
+        stats["in_flight"] = len(self._in_flight)
+        stats["suppressed"] = stats[COALESCED] + stats[MERGED] + stats[STALE] + stats[BUSY]
+        return stats
@@ -0,0 +1,131 @@
+"""
+doorController.py
+
+Timer driven door actuation. Decisions only change the controller state,
+relay and feedback pulses are scheduled on the asyncio event loop, so the
+readers, MQTT decisions and the fingerprint UART keep being serviced while
+the door is open.
+
+    LOCKED --grant--> UNLOCKING --unlock_time--> OPEN --hold_time--> RELOCKING --relock_time--> LOCKED
+
+A grant while OPEN extends the hold time, a grant while RELOCKING unlocks again.
+"""
+import asyncio
+import logging
+import time
+
+import RPi.GPIO as GPIO
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RELAY_PIN = 12
+DEFAULT_UNLOCK_TIME = 0.2  # seconds for the strike to release before the door counts as open
+DEFAULT_HOLD_TIME = 5.0  # seconds the door stays unlocked
+DEFAULT_RELOCK_TIME = 0.5  # seconds for the strike to engage again
+DEFAULT_DENY_TIME = 1.0  # seconds the deny feedback output is held
+
+# Door states
+LOCKED = "locked"
+UNLOCKING = "unlocking"
+OPEN = "open"
+RELOCKING = "relocking"
+
+
+class DoorController:
+
+    def __init__(self, relay_pin: int = DEFAULT_RELAY_PIN,
+                 unlock_time: float = DEFAULT_UNLOCK_TIME,
+                 hold_time: float = DEFAULT_HOLD_TIME,
+                 relock_time: float = DEFAULT_RELOCK_TIME,
+                 deny_time: float = DEFAULT_DENY_TIME,
+                 feedback_pin: int = None):
+        self.relay_pin = relay_pin
+        self.unlock_time = unlock_time
+        self.hold_time = hold_time
+        self.relock_time = relock_time
+        self.deny_time = deny_time
+        self.feedback_pin = feedback_pin  # optional buzzer / LED pulsed on deny
+        self.on_state_change = None  # optional callback(old_state, new_state)
+
+        self.state = LOCKED
+        self.loop = None
+        self._timer = None
+        self._feedback_timer = None
+        self._open_until = 0.0
+        self.stats = {"grants": 0, "denials": 0, "extensions": 0, "cycles": 0}
+
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setup(relay_pin, GPIO.OUT, initial=GPIO.LOW)
+        if feedback_pin is not None:
+            GPIO.setup(feedback_pin, GPIO.OUT, initial=GPIO.LOW)
+
+    def grant(self):
+        """Unlock the door (or keep it unlocked for another hold_time). Never blocks."""
+        self.loop = asyncio.get_running_loop()
+        self.stats["grants"] += 1
+        self._open_until = time.monotonic() + self.unlock_time + self.hold_time
+
+        if self.state in (LOCKED, RELOCKING):
+            GPIO.output(self.relay_pin, GPIO.HIGH)
+            self._schedule(self.unlock_time, self._on_unlocked)
+            self._set_state(UNLOCKING)
+        elif self.state == OPEN:
+            self.stats["extensions"] += 1
+            self._schedule(self.hold_time, self._on_hold_expired)
+        # UNLOCKING: _on_unlocked picks up the new _open_until
+
+    def deny(self):
+        """Pulse the feedback output, the door state is not touched. Never blocks."""
+        self.loop = asyncio.get_running_loop()
+        self.stats["denials"] += 1
+        if self.feedback_pin is None:
+            return
+        GPIO.output(self.feedback_pin, GPIO.HIGH)
+        if self._feedback_timer is not None:
+            self._feedback_timer.cancel()
+        self._feedback_timer = self.loop.call_later(self.deny_time, self._end_feedback)
+
+    def _on_unlocked(self):
+        self._set_state(OPEN)
+        self._schedule(max(self._open_until - time.monotonic(), 0), self._on_hold_expired)
+
+    def _on_hold_expired(self):
+        GPIO.output(self.relay_pin, GPIO.LOW)
+        self._set_state(RELOCKING)
+        self._schedule(self.relock_time, self._on_relocked)
+
+    def _on_relocked(self):
+        self._timer = None
+        self.stats["cycles"] += 1
+        self._set_state(LOCKED)
+
+    def _end_feedback(self):
+        self._feedback_timer = None
+        GPIO.output(self.feedback_pin, GPIO.LOW)
+
+    def _schedule(self, delay: float, callback):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = self.loop.call_later(delay, callback)
+
+    def _set_state(self, state: str):
+        old_state, self.state = self.state, state
+        logger.debug(f"Door {old_state} -> {state}")
+        if self.on_state_change is not None:
+            self.on_state_change(old_state, state)
+
+    def getStats(self) -> dict:
+        stats = dict(self.stats)
+        stats["state"] = self.state
+        return stats
+
+    def close(self):
+        """Cancel pending transitions and leave the door locked."""
+        for timer in (self._timer, self._feedback_timer):
+            if timer is not None:
+                timer.cancel()
+        self._timer = self._feedback_timer = None
+        GPIO.output(self.relay_pin, GPIO.LOW)
+        if self.feedback_pin is not None:
+            GPIO.output(self.feedback_pin, GPIO.LOW)
+        self.state = LOCKED
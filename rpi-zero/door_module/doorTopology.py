@@ -0,0 +1,343 @@
+"""
+doorTopology.py
+
+Config driven door topology, one device process driving several doors.
+Every door owns its readers, relay, admission control, pipeline and MQTT
+topic pair; all doors share the MQTT connection and the asyncio event loop.
+
+Topology file (JSON), only "id" is required:
+{
+  "doors": [
+    {"id": "main", "relay_pin": 12, "feedback_pin": null, "hold_time": 5,
+     "request_topic": "access/door/main/request", "decision_topic": "access/door/main/decision",
+     "cache_sync_topic": "access/door/main/allowlist",
+     "rfid": {"i2c_bus": 1, "irq_pin": null},
+     "fingerprint": {"port": "/dev/ttyS0", "baud": 19200, "reset_pin": 24},
+     "camera": {"camera_num": 0}},
+    {"id": "garage", "relay_pin": 16, "rfid": {"i2c_bus": 3}, "camera": {"camera_num": 1}}
+  ]
+}
+The PN532 answers on a fixed I2C address, several of them need separate I2C buses
+(e.g. the i2c-gpio / i2c3..i2c6 overlays). Topics default to access/door/<id>/request
+and access/door/<id>/decision.
+"""
+import json
+import logging
+import threading
+
+from cache_module.decisionCache import SNAPSHOT_TOPIC_SUFFIX, RESYNC_TOPIC_SUFFIX
+from door_module.accessPipeline import AccessPipeline
+from door_module.admissionControl import AdmissionController, DEFAULT_WINDOW, DEFAULT_MAX_IN_FLIGHT
+from door_module.doorController import DoorController, DEFAULT_RELAY_PIN, DEFAULT_HOLD_TIME
+from door_module.readerOrchestrator import ReaderOrchestrator
+from door_module.readerWorkers import ReaderWorker
+from mqtt_module.wireFormat import WIRE_FORMAT_JSON
+from telemetry_module.latencyTrace import Tracer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DOOR_ID = "main"
+DEFAULT_TOPIC_PREFIX = "access/door"
+
+
+class TopologyError(Exception):
+    pass
+
+
+class DoorConfig:
+
+    def __init__(self, door_id: str,
+                 relay_pin: int = DEFAULT_RELAY_PIN,
+                 feedback_pin: int = None,
+                 hold_time: float = DEFAULT_HOLD_TIME,
+                 request_topic: str = None,
+                 decision_topic: str = None,
+                 cache_sync_topic: str = None,
+                 rfid: dict = None,
+                 fingerprint: dict = None,
+                 camera: dict = None):
+        self.door_id = door_id
+        self.relay_pin = relay_pin
+        self.feedback_pin = feedback_pin
+        self.hold_time = hold_time
+        self.request_topic = request_topic or f"{DEFAULT_TOPIC_PREFIX}/{door_id}/request"
+        self.decision_topic = decision_topic or f"{DEFAULT_TOPIC_PREFIX}/{door_id}/decision"
+        self.cache_sync_topic = cache_sync_topic
+        # Reader settings, None when the door doesn't have that reader
+        self.rfid = rfid
+        self.fingerprint = fingerprint
+        self.camera = camera
+
+    @classmethod
+    def from_dict(cls, entry: dict):
+        if not entry.get("id"):
+            raise TopologyError(f"Door without an id: {entry}")
+        return cls(door_id=entry["id"],
+                   relay_pin=entry.get("relay_pin", DEFAULT_RELAY_PIN),
+                   feedback_pin=entry.get("feedback_pin"),
+                   hold_time=entry.get("hold_time", DEFAULT_HOLD_TIME),
+                   request_topic=entry.get("request_topic"),
+                   decision_topic=entry.get("decision_topic"),
+                   cache_sync_topic=entry.get("cache_sync_topic"),
+                   rfid=entry.get("rfid"),
+                   fingerprint=entry.get("fingerprint"),
+                   camera=entry.get("camera"))
+
+
+def validate_topology(doors: list):
+    """Raise TopologyError when two doors claim the same id, pin, bus, port, camera or topic."""
+    if not doors:
+        raise TopologyError("Topology has no doors")
+    claimed = {}
+
+    def claim(resource, door_id):
+        if resource in claimed:
+            raise TopologyError(f"Door {door_id} uses {resource[0]} {resource[1]} already used by door {claimed[resource]}")
+        claimed[resource] = door_id
+
+    for door in doors:
+        claim(("id", door.door_id), door.door_id)
+        claim(("GPIO", door.relay_pin), door.door_id)
+        if door.feedback_pin is not None:
+            claim(("GPIO", door.feedback_pin), door.door_id)
+        claim(("request topic", door.request_topic), door.door_id)
+        claim(("decision topic", door.decision_topic), door.door_id)
+        if door.cache_sync_topic:
+            claim(("cache sync topic", door.cache_sync_topic), door.door_id)
+        if door.rfid is not None:
+            claim(("I2C bus", door.rfid.get("i2c_bus", 1)), door.door_id)
+            if door.rfid.get("irq_pin") is not None:
+                claim(("GPIO", door.rfid["irq_pin"]), door.door_id)
+        if door.fingerprint is not None:
+            claim(("serial port", door.fingerprint.get("port")), door.door_id)
+            if door.fingerprint.get("reset_pin") is not None:
+                claim(("GPIO", door.fingerprint["reset_pin"]), door.door_id)
+        if door.camera is not None:
+            claim(("camera", door.camera.get("camera_num", 0)), door.door_id)
+
+
+def load_topology(path: str) -> list:
+    with open(path, encoding="utf-8") as f:
+        try:
+            topology = json.load(f)
+        except ValueError as e:
+            raise TopologyError(f"Topology file {path} is not valid JSON") from e
+    doors = [DoorConfig.from_dict(entry) for entry in topology.get("doors", [])]
+    validate_topology(doors)
+    return doors
+
+
+def topology_from_env(secrets: dict, relay_pin: int = DEFAULT_RELAY_PIN) -> list:
+    """Single door topology from the .env keys, the layout main.py always had."""
+    from fingerprint_module.fingerprintRead import DEFAULT_PORT, DEFAULT_BAUD
+
+    door_id = secrets.get('DOOR_ID') or DEFAULT_DOOR_ID
+    door = DoorConfig(door_id,
+                      relay_pin=relay_pin,
+                      feedback_pin=int(secrets['DOOR_FEEDBACK_PIN']) if secrets.get('DOOR_FEEDBACK_PIN') else None,
+                      hold_time=float(secrets.get('DOOR_HOLD_TIME') or DEFAULT_HOLD_TIME),
+                      request_topic=secrets.get('MQTT_REQUEST_TOPIC'),
+                      decision_topic=secrets.get('MQTT_DECISION_TOPIC'),
+                      cache_sync_topic=secrets.get('CACHE_SYNC_TOPIC'),
+                      rfid={"i2c_bus": 1},
+                      fingerprint={"port": DEFAULT_PORT, "baud": DEFAULT_BAUD},
+                      camera={"camera_num": 0})
+    return [door]
+
+
+class Door:
+    """One door with its readers, relay, pipeline and orchestrator."""
+
+    def __init__(self, config: DoorConfig, controller: DoorController, pipeline: AccessPipeline,
+                 orchestrator: ReaderOrchestrator, tracer: Tracer, cache=None):
+        self.config = config
+        self.door_id = config.door_id
+        self.controller = controller
+        self.pipeline = pipeline
+        self.orchestrator = orchestrator
+        self.tracer = tracer
+        self.cache = cache
+
+    @property
+    def stats(self) -> dict:
+        return self.pipeline.stats
+
+    async def run(self):
+        await self.orchestrator.run()
+
+    def getStats(self) -> dict:
+        stats = dict(self.pipeline.stats)
+        stats["door"] = dict(self.controller.stats, state=self.controller.state)
+        if self.orchestrator.workers:
+            stats["workers"] = {worker.name: worker.getStats() for worker in self.orchestrator.workers}
+        return stats
+
+    def close(self):
+        for worker in self.orchestrator.workers:
+            worker.stop()
+        if self.orchestrator.fingerprint is not None:
+            self.orchestrator.fingerprint.stop_scan()
+        if self.orchestrator.scanner is not None:
+            self.orchestrator.scanner.cleanup()
+        self.controller.close()
+
+
+def _open_rfid(settings: dict):
+    from rfid_module.cardRead import RFIDModule, DEFAULT_I2C_BUS
+    return RFIDModule(settings.get("i2c_bus", DEFAULT_I2C_BUS), irq_pin=settings.get("irq_pin"))
+
+
+def _open_fingerprint(settings: dict):
+    from fingerprint_module.fingerprintRead import FingerprintModule, DEFAULT_PORT, DEFAULT_BAUD, RST_PIN
+    return FingerprintModule(port=settings.get("port", DEFAULT_PORT), baud=settings.get("baud", DEFAULT_BAUD),
+                             timeout=0, reset_pin=settings.get("reset_pin", RST_PIN))
+
+
+def _reader_openers(config: DoorConfig, camera_factory=None) -> dict:
+    """{reader name: callable opening it} for the readers of a door.
+
+    Reader modules (and their heavy dependencies) are imported by the openers,
+    so only the readers that are configured get imported at all.
+    """
+    openers = {}
+    if config.rfid is not None:
+        openers["rfid"] = lambda: _open_rfid(config.rfid)
+    if config.fingerprint is not None:
+        openers["fingerprint"] = lambda: _open_fingerprint(config.fingerprint)
+    if config.camera is not None:
+        if camera_factory is None:
+            raise TopologyError(f"Door {config.door_id} has a camera but no camera factory was given")
+        openers["scanner"] = lambda: camera_factory(config.camera.get("camera_num", 0))
+    return openers
+
+
+def close_readers(readers: dict):
+    if readers.get("fingerprint") is not None:
+        readers["fingerprint"].close()
+    if readers.get("scanner") is not None:
+        readers["scanner"].cleanup()
+
+
+def open_readers(topology: list, camera_factory=None, executor=None, timeline=None) -> dict:
+    """Open the readers of every door, {door id: {"rfid": ..., "fingerprint": ..., "scanner": ...}}.
+
+    With an executor all readers are opened at once (PN532 firmware probe, serial port
+    open, camera configure / start overlap), otherwise one after another. When any
+    reader fails the ones already opened are closed and the error is raised.
+    """
+    jobs = []
+    for config in topology:
+        for name, opener in _reader_openers(config, camera_factory).items():
+            if timeline is not None:
+                opener = timeline.timed(f"door {config.door_id} {name}", opener)
+            jobs.append((config.door_id, name, executor.submit(opener) if executor is not None else opener))
+
+    readers = {config.door_id: {} for config in topology}
+    error = None
+    for door_id, name, job in jobs:
+        try:
+            readers[door_id][name] = job.result() if executor is not None else job()
+        except Exception as e:
+            logger.error(f"Failed to open {name} of door {door_id}: {e}")
+            if error is None:
+                error = e
+            if executor is None:
+                break
+    if error is not None:
+        for opened in readers.values():
+            close_readers(opened)
+        raise error
+    return readers
+
+
+def make_resync_request(mqtt, cache_sync_topic: str, door_id: str):
+    """DecisionCache.resync publishing a snapshot request on <sync topic>/resync."""
+
+    def resync(version):
+        payload = json.dumps({"door": door_id, "version": version}, separators=(",", ":"))
+        # Called from the network thread, which has to stay free to receive the publish acknowledgement
+        threading.Thread(target=mqtt.publish, args=(cache_sync_topic + RESYNC_TOPIC_SUFFIX, payload),
+                         name=f"cache-resync-{door_id}", daemon=True).start()
+
+    return resync
+
+
+def build_door(config: DoorConfig, mqtt, camera_factory=None, cache_factory=None,
+               qr_verifier_factory=None,
+               wire_format: str = WIRE_FORMAT_JSON,
+               admission_window: float = DEFAULT_WINDOW,
+               admission_max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+               events=None,
+               readers: dict = None,
+               reader_processes: bool = False) -> Door:
+    """Create the readers, relay and pipeline of one door on the shared MQTT client.
+
+    camera_factory(camera_num) -> CameraModule creates the scanner, so the decoder and lores
+    tuning stay in one place. cache_factory(door_id) -> DecisionCache is only used for doors
+    with a cache_sync_topic. qr_verifier_factory(door_id) -> QRTokenVerifier checks the QR
+    codes of the door's camera. With reader_processes every reader is opened and run in
+    its own worker process (readerWorkers.py) once the door runs. `events` is the EventJournal shared by all doors. `readers`
+    are the door's readers from open_readers(), without them they are opened here.
+    """
+    workers = []
+    if reader_processes:
+        openers = _reader_openers(config, camera_factory)
+        if "scanner" in openers and qr_verifier_factory is not None:
+            open_camera = openers["scanner"]
+
+            def open_verified_camera():
+                camera = open_camera()
+                camera.verifier = qr_verifier_factory(config.door_id)
+                return camera
+            openers["scanner"] = open_verified_camera
+        workers = [ReaderWorker(config.door_id, name, opener) for name, opener in openers.items()]
+        readers = {}
+    elif readers is None:
+        readers = open_readers([config], camera_factory)[config.door_id]
+    rfid = readers.get("rfid")
+    fingerprint = readers.get("fingerprint")
+    scanner = readers.get("scanner")
+    tracer = Tracer()
+    if fingerprint is not None:
+        fingerprint.tracer = tracer
+    if scanner is not None:
+        scanner.tracer = tracer
+        if qr_verifier_factory is not None:
+            scanner.verifier = qr_verifier_factory(config.door_id)
+
+    cache = None
+    if config.cache_sync_topic and cache_factory is not None:
+        cache = cache_factory(config.door_id)
+        cache.resync = make_resync_request(mqtt, config.cache_sync_topic, config.door_id)
+        mqtt.addSubscription(config.cache_sync_topic, cache.onSyncMessage)
+        mqtt.addSubscription(config.cache_sync_topic + SNAPSHOT_TOPIC_SUFFIX, cache.onSyncMessage)
+
+    mqtt.addDecisionTopic(config.decision_topic)
+    controller = DoorController(relay_pin=config.relay_pin, hold_time=config.hold_time,
+                                feedback_pin=config.feedback_pin)
+    pipeline = AccessPipeline(mqtt, door=controller, cache=cache,
+                              admission=AdmissionController(window=admission_window,
+                                                            max_in_flight=admission_max_in_flight),
+                              tracer=tracer, door_id=config.door_id, wire_format=wire_format,
+                              request_topic=config.request_topic, decision_topic=config.decision_topic,
+                              events=events)
+    # Readers keep reading while a decision is pending, the admission controller bounds the requests in flight
+    orchestrator = ReaderOrchestrator(pipeline, fingerprint=fingerprint, scanner=scanner, rfid=rfid, tracer=tracer,
+                                      workers=workers, concurrent=True)
+    if workers:
+        logger.info(f"Door {config.door_id}: relay GPIO {config.relay_pin}, reader processes "
+                    f"{', '.join(worker.name for worker in workers)}")
+    else:
+        logger.info(f"Door {config.door_id}: relay GPIO {config.relay_pin}, readers "
+                    f"{', '.join(name for name, reader in (('rfid', rfid), ('fingerprint', fingerprint), ('qr', scanner)) if reader) or 'none'}")
+    return Door(config, controller, pipeline, orchestrator, tracer, cache)
+
+
+def build_doors(topology: list, mqtt, camera_factory=None, executor=None, timeline=None, **options) -> list:
+    """build_door for every door of the topology, all readers opened concurrently on `executor`."""
+    if options.get("reader_processes"):
+        # Every worker opens its own reader when the doors start
+        return [build_door(config, mqtt, camera_factory=camera_factory, **options) for config in topology]
+    readers = open_readers(topology, camera_factory, executor, timeline)
+    return [build_door(config, mqtt, camera_factory=camera_factory, readers=readers[config.door_id], **options)
+            for config in topology]
@@ -0,0 +1,233 @@
+"""
+readerOrchestrator.py
+
+Event driven orchestrator for the credential readers.
+Instead of polling every reader in a tight loop, the orchestrator sleeps
+in the asyncio event loop and only wakes up when a reader has data:
+- FingerprintModule: readability of the serial port file descriptor
+  (bytes are fed to the incremental frame parser as they arrive),
+- CameraModule: result callback from the QR scanning thread,
+- RFIDModule: RFIDPoller thread doing bounded, debounced polls,
+- ReaderWorker: event pipe of a reader running in its own process (readerWorkers.py),
+  workers that die or stop sending heartbeats are restarted.
+Every credential is handed to a single shared AccessPipeline.
+
+By default one credential is decided at a time and every reader is paused
+until its decision. With `concurrent=True` (a pipeline with an AdmissionController)
+the readers keep reading while decisions are pending, each credential is handled
+in its own task and admission control merges repeats and caps the requests in flight.
+"""
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ReaderOrchestrator:
+
+    def __init__(self, pipeline, fingerprint=None, scanner=None, rfid=None, tracer=None, workers=None,
+                 concurrent: bool = False):
+        self.pipeline = pipeline
+        self.concurrent = concurrent
+        self.tracer = tracer
+        self.fingerprint = fingerprint
+        self.scanner = scanner
+        self.rfid = rfid
+        self.workers = list(workers or [])
+
+        self.loop = None
+        self._credentials = None
+        self._accepting = False
+        self._fp_watched = False
+        self._rfid_poller = None
+        self._workers_waiting = set()  # workers that sent a credential, paused until resumed
+        self._restarting = set()
+        self._supervisor = None
+        self._tasks = set()  # credentials being decided in concurrent mode
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self._credentials = asyncio.Queue()
+
+        if self.scanner:
+            self.scanner.on_result = self._on_qr_result
+        if self.rfid:
+            # Imported here, so devices without an RFID reader never load pn532pi
+            from rfid_module.cardRead import RFIDPoller
+            self._rfid_poller = RFIDPoller(self.rfid)
+            self._rfid_poller.on_event = self._on_card_event
+            self._rfid_poller.tracer = self.tracer
+        if self.workers:
+            # Forked from executor threads, a fork of the event loop thread couldn't run its own loop
+            await asyncio.gather(*(self.loop.run_in_executor(None, worker.start) for worker in self.workers))
+            for worker in self.workers:
+                self.loop.add_reader(worker.fileno(), self._on_worker_readable, worker)
+            self._supervisor = asyncio.create_task(self._supervise())
+
+        await self._resume_readers()
+
+        try:
+            while True:
+                cred_type, data, read_ns, source = await self._credentials.get()
+                if self.concurrent:
+                    task = asyncio.create_task(self._handle(cred_type, data, read_ns))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+                    await self._rearm(source)
+                    continue
+                await self._pause_readers()
+                try:
+                    await self._handle(cred_type, data, read_ns)
+                finally:
+                    await self._resume_readers()
+        finally:
+            if self._supervisor is not None:
+                self._supervisor.cancel()
+            for task in self._tasks:
+                task.cancel()
+
+    async def _handle(self, cred_type: str, data, read_ns: int):
+        try:
+            await self.pipeline.handle(cred_type, data, read_ns)
+        except Exception:
+            logger.exception(f"Failed to handle {cred_type} credential")
+
+    def _submit(self, cred_type: str, data, read_ns: int = None, source=None):
+        # Runs in the event loop thread. Serially the first reader wins, the rest are ignored until resume.
+        if not self._accepting:
+            logger.debug("Ignoring %s credential while busy", cred_type)
+            return
+        if not self.concurrent:
+            self._accepting = False
+        self._credentials.put_nowait((cred_type, data, read_ns or time.monotonic_ns(), source))
+
+    async def _rearm(self, source):
+        """Let the reader that produced a credential read again, concurrent mode only."""
+        if source is None or not self._accepting:
+            # RFID poller keeps polling on its own, held readers are rearmed by release()
+            return
+        if source is self.fingerprint:
+            self._unwatch_fingerprint()
+            await self.loop.run_in_executor(None, self.fingerprint.new_scan)
+            if self._accepting:
+                self._watch_fingerprint()
+        elif source is self.scanner:
+            self.scanner.resume()
+        elif source not in self._restarting:
+            self._workers_waiting.discard(source)
+            source.resume()
+
+    async def hold(self):
+        """Stop accepting credentials and pause the readers, until release()."""
+        self._accepting = False
+        await self._pause_readers()
+
+    async def release(self):
+        await self._resume_readers()
+
+    # ------------------------
+    # Fingerprint (serial fd)
+    # ------------------------
+    def _watch_fingerprint(self):
+        self.loop.add_reader(self.fingerprint.fileno(), self._on_fingerprint_readable)
+        self._fp_watched = True
+
+    def _unwatch_fingerprint(self):
+        if self._fp_watched:
+            self.loop.remove_reader(self.fingerprint.fileno())
+            self._fp_watched = False
+
+    def _on_fingerprint_readable(self):
+        # Drains the serial buffer, so the fd only becomes readable again when new bytes land
+        data = self.fingerprint.get_eigenvalues()
+        if data is not None:
+            if self.concurrent:
+                # Not readable again until the next capture is armed
+                self._unwatch_fingerprint()
+            self._submit("fingerprint", data, source=self.fingerprint)
+
+    # ------------------------
+    # Camera (scan thread callback)
+    # ------------------------
+    def _on_qr_result(self, qr_text: str):
+        self.loop.call_soon_threadsafe(self._submit, "qr", qr_text, None, self.scanner)
+
+    # ------------------------
+    # RFID (poller thread callback)
+    # ------------------------
+    def _on_card_event(self, event):
+        self.loop.call_soon_threadsafe(self._submit, "rfid", event.uid)
+
+    # ------------------------
+    # Reader workers (event pipes)
+    # ------------------------
+    def _on_worker_readable(self, worker):
+        events = worker.read_events()
+        if events is None:
+            self.loop.create_task(self._restart_worker(worker, "exited"))
+            return
+        for cred_type, data, read_ns in events:
+            # The worker paused itself after sending, it is resumed with the other readers (concurrently: by _rearm)
+            self._workers_waiting.add(worker)
+            self._submit(cred_type, data, read_ns, worker)
+
+    async def _supervise(self):
+        while True:
+            await asyncio.sleep(min(worker.heartbeat_interval for worker in self.workers))
+            for worker in self.workers:
+                if worker in self._restarting:
+                    continue
+                if not worker.alive():
+                    await self._restart_worker(worker, "exited")
+                elif worker.hung():
+                    await self._restart_worker(worker, "stopped sending heartbeats")
+
+    async def _restart_worker(self, worker, reason: str):
+        if worker in self._restarting:
+            return
+        self._restarting.add(worker)
+        self.loop.remove_reader(worker.fileno())
+        self._workers_waiting.discard(worker)
+        logger.warning(f"{worker.name} worker of door {worker.door_id} {reason}, restarting in {worker.backoff:.0f} s")
+        try:
+            await asyncio.sleep(worker.backoff)
+            await self.loop.run_in_executor(None, worker.restart)
+            self.loop.add_reader(worker.fileno(), self._on_worker_readable, worker)
+            if not self._accepting:
+                worker.pause()  # a decision is in progress
+        except Exception:
+            logger.exception(f"Failed to restart {worker.name} worker of door {worker.door_id}")
+        finally:
+            self._restarting.discard(worker)
+
+    # ------------------------
+    # Reader state
+    # ------------------------
+    async def _pause_readers(self):
+        if self._rfid_poller:
+            self._rfid_poller.pause()
+        if self.fingerprint:
+            self._unwatch_fingerprint()
+            self.fingerprint.stop_scan()
+        if self.scanner:
+            self.scanner.pause()
+        for worker in self.workers:
+            if worker not in self._workers_waiting and worker not in self._restarting:
+                worker.pause()
+
+    async def _resume_readers(self):
+        if self.fingerprint:
+            await self.loop.run_in_executor(None, self.fingerprint.new_scan)
+            self._watch_fingerprint()
+        if self.scanner:
+            # Starts the persistent scan worker the first time, afterwards only resumes it
+            self.scanner.start_background_scan()
+        self._accepting = True
+        # Right after accepting is set, a worker credential can't slip in between and stay paused
+        for worker in self.workers:
+            if worker not in self._restarting:
+                worker.resume()
+        self._workers_waiting.clear()
+        if self._rfid_poller:
+            self._rfid_poller.start()
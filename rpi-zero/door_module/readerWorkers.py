@@ -0,0 +1,314 @@
+"""
+readerWorkers.py
+
+Process-per-reader mode. Every reader (camera, fingerprint, RFID) runs in its own
+worker process, so a QR decode holding the GIL can't delay the RFID polls or the
+fingerprint UART, and a crashing reader takes only its own process down.
+
+- A worker opens its reader and runs a one-reader ReaderOrchestrator whose pipeline
+  is a WorkerLink: every credential becomes one fixed-size record written to the
+  event pipe (writes up to PIPE_BUF are atomic, records never interleave), after
+  which the worker waits, readers paused, until the coordinator resumes it.
+- The coordinator owns the MQTT client and the relay. Its ReaderOrchestrator
+  watches the event pipes in its event loop next to the in-process readers, the
+  first credential wins and the other workers are paused until the decision.
+- Commands go the other way as single bytes on a command pipe (pause / resume / stop).
+- Workers send a heartbeat, a worker that exits, closes its pipe or misses
+  heartbeats is restarted with a growing backoff while the door keeps working
+  with its remaining readers.
+
+Workers are forked, so the reader openers can be any callable (closures included).
+
+Record (RECORD_SIZE bytes): kind u8, credential type u8, encoding u8, pad,
+payload length u32, read_ns u64 (CLOCK_MONOTONIC, shared by all processes), payload.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import struct
+import time
+
+logger = logging.getLogger(__name__)
+
+RECORD_SIZE = 512
+DEFAULT_HEARTBEAT_INTERVAL = 2.0  # seconds between worker heartbeats
+DEFAULT_HEARTBEAT_MISSES = 3  # heartbeats missed before a worker is considered hung
+DEFAULT_RESTART_BACKOFF = 1.0  # seconds before the first restart, doubled on every failed one
+DEFAULT_MAX_RESTART_BACKOFF = 30.0
+DEFAULT_STOP_TIMEOUT = 3.0  # seconds a worker gets to close its reader before it is killed
+
+_HEADER = struct.Struct("<BBBxIQ")
+PAYLOAD_SIZE = RECORD_SIZE - _HEADER.size
+
+# Record kinds
+RECORD_CREDENTIAL = 1
+RECORD_HEARTBEAT = 2
+RECORD_READY = 3  # reader opened
+
+CREDENTIAL_TYPES = ("rfid", "fingerprint", "qr")
+_ENCODING_BYTES = 0
+_ENCODING_TEXT = 1
+
+# Commands (coordinator -> worker)
+CMD_PAUSE = b"p"
+CMD_RESUME = b"r"
+CMD_STOP = b"s"
+
+# Reader name (doorTopology) -> ReaderOrchestrator argument
+READER_ARGUMENTS = {"rfid": "rfid", "fingerprint": "fingerprint", "scanner": "scanner"}
+
+
+class WorkerRecordError(Exception):
+    pass
+
+
+def encode_record(kind: int, cred_type: str = None, data=None, read_ns: int = 0) -> bytes:
+    encoding = _ENCODING_BYTES
+    payload = b""
+    if data is not None:
+        if isinstance(data, str):
+            encoding = _ENCODING_TEXT
+            payload = data.encode("utf-8")
+        else:
+            payload = bytes(data)
+    if len(payload) > PAYLOAD_SIZE:
+        raise WorkerRecordError(f"{cred_type} credential of {len(payload)} bytes doesn't fit a record")
+    type_index = CREDENTIAL_TYPES.index(cred_type) if cred_type is not None else 0
+    record = _HEADER.pack(kind, type_index, encoding, len(payload), read_ns) + payload
+    return record + bytes(RECORD_SIZE - len(record))
+
+
+def decode_record(record: bytes) -> tuple:
+    """(kind, credential type, data, read_ns) of one record."""
+    kind, type_index, encoding, length, read_ns = _HEADER.unpack_from(record)
+    if length > PAYLOAD_SIZE or type_index >= len(CREDENTIAL_TYPES):
+        raise WorkerRecordError("Corrupt worker record")
+    payload = bytes(record[_HEADER.size:_HEADER.size + length])
+    data = payload.decode("utf-8") if encoding == _ENCODING_TEXT else payload
+    return kind, CREDENTIAL_TYPES[type_index], data, read_ns
+
+
+# ------------------------
+# Worker side
+# ------------------------
+class WorkerLink:
+    """Pipeline of the worker's ReaderOrchestrator, forwards credentials to the coordinator."""
+
+    def __init__(self, event_fd: int, command_fd: int, heartbeat_interval: float = DEFAULT_HEARTBEAT_INTERVAL):
+        self.event_fd = event_fd
+        self.command_fd = command_fd
+        self.heartbeat_interval = heartbeat_interval
+        self.orchestrator = None
+        self._loop = None
+        self._resumed = None
+        self._stopped = None
+        self._waiting = False  # a credential is out, readers stay paused until CMD_RESUME
+        self._held = False  # paused by the coordinator while another reader's credential is decided
+
+    async def handle(self, cred_type: str, data, read_ns: int = None):
+        try:
+            record = encode_record(RECORD_CREDENTIAL, cred_type, data, read_ns or time.monotonic_ns())
+        except WorkerRecordError as e:
+            logger.warning(str(e))
+            return
+        self._resumed.clear()
+        self._waiting = True
+        try:
+            os.write(self.event_fd, record)
+            await self._resumed.wait()
+        finally:
+            self._waiting = False
+
+    async def serve(self, orchestrator):
+        self.orchestrator = orchestrator
+        self._loop = asyncio.get_running_loop()
+        self._resumed = asyncio.Event()
+        self._stopped = asyncio.Event()
+        os.set_blocking(self.command_fd, False)
+        self._loop.add_reader(self.command_fd, self._on_command)
+        os.write(self.event_fd, encode_record(RECORD_READY))
+        tasks = [asyncio.create_task(orchestrator.run()), asyncio.create_task(self._heartbeat())]
+        try:
+            await self._stopped.wait()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _on_command(self):
+        try:
+            commands = os.read(self.command_fd, 64)
+        except BlockingIOError:
+            return
+        if not commands:
+            # Coordinator is gone
+            self._stopped.set()
+            return
+        for command in commands:
+            command = bytes((command,))
+            if command == CMD_STOP:
+                self._stopped.set()
+            elif command == CMD_PAUSE:
+                if not self._waiting and not self._held:
+                    self._held = True
+                    self._loop.create_task(self.orchestrator.hold())
+            elif command == CMD_RESUME:
+                if self._waiting:
+                    self._resumed.set()
+                elif self._held:
+                    self._loop.create_task(self.orchestrator.release())
+                self._held = False
+
+    async def _heartbeat(self):
+        parent = os.getppid()
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            if os.getppid() != parent:
+                # Re-parented: the coordinator died without closing our pipes (siblings inherit them)
+                self._stopped.set()
+                return
+            os.write(self.event_fd, encode_record(RECORD_HEARTBEAT))
+
+
+def _worker_main(name: str, opener, event_fd: int, command_fd: int, heartbeat_interval: float):
+    # Ctrl+C goes to the whole process group, the coordinator decides when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    from door_module.readerOrchestrator import ReaderOrchestrator
+    from door_module.doorTopology import close_readers
+
+    reader = opener()
+    link = WorkerLink(event_fd, command_fd, heartbeat_interval)
+    orchestrator = ReaderOrchestrator(link, **{READER_ARGUMENTS[name]: reader})
+    try:
+        asyncio.run(link.serve(orchestrator))
+    finally:
+        close_readers({name: reader})
+
+
+# ------------------------
+# Coordinator side
+# ------------------------
+class ReaderWorker:
+    """Handle of one reader worker process, driven by the coordinator's ReaderOrchestrator."""
+
+    def __init__(self, door_id: str, name: str, opener,
+                 heartbeat_interval: float = DEFAULT_HEARTBEAT_INTERVAL,
+                 heartbeat_misses: int = DEFAULT_HEARTBEAT_MISSES):
+        self.door_id = door_id
+        self.name = name
+        self.opener = opener
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_misses = heartbeat_misses
+        self.process = None
+        self.ready = False
+        self.backoff = DEFAULT_RESTART_BACKOFF
+        self.stats = {"starts": 0, "restarts": 0, "credentials": 0, "heartbeats": 0, "corrupt": 0}
+        self._event_fd = None
+        self._command_fd = None
+        self._buffer = b""
+        self._last_seen = 0.0
+
+    def start(self):
+        """Fork the worker, blocking, call it from an executor thread (a forked event loop thread can't run asyncio)."""
+        event_read, event_write = os.pipe()
+        command_read, command_write = os.pipe()
+        context = multiprocessing.get_context("fork")
+        self.process = context.Process(target=_worker_main, name=f"reader-{self.door_id}-{self.name}",
+                                       args=(self.name, self.opener, event_write, command_read, self.heartbeat_interval),
+                                       daemon=True)
+        self.process.start()
+        # Only the worker keeps its ends, so its exit shows up as EOF here
+        os.close(event_write)
+        os.close(command_read)
+        os.set_blocking(event_read, False)
+        self._event_fd = event_read
+        self._command_fd = command_write
+        self._buffer = b""
+        self._last_seen = time.monotonic()
+        self.ready = False
+        self.stats["starts"] += 1
+        logger.info(f"Started {self.name} worker of door {self.door_id} (pid {self.process.pid})")
+
+    def fileno(self) -> int:
+        return self._event_fd
+
+    def read_events(self):
+        """Credentials that arrived, [(cred_type, data, read_ns)], None when the worker is gone."""
+        try:
+            chunk = os.read(self._event_fd, RECORD_SIZE * 16)
+        except BlockingIOError:
+            return []
+        except OSError:
+            return None
+        if not chunk:
+            return None
+        self._last_seen = time.monotonic()
+        self._buffer += chunk
+        credentials = []
+        while len(self._buffer) >= RECORD_SIZE:
+            record, self._buffer = self._buffer[:RECORD_SIZE], self._buffer[RECORD_SIZE:]
+            try:
+                kind, cred_type, data, read_ns = decode_record(record)
+            except WorkerRecordError:
+                self.stats["corrupt"] += 1
+                continue
+            if kind == RECORD_CREDENTIAL:
+                self.stats["credentials"] += 1
+                credentials.append((cred_type, data, read_ns))
+            elif kind == RECORD_HEARTBEAT:
+                self.stats["heartbeats"] += 1
+                # Up for a heartbeat interval: a crash loop keeps its growing backoff, a one-off crash doesn't
+                self.backoff = DEFAULT_RESTART_BACKOFF
+            elif kind == RECORD_READY:
+                self.ready = True
+                logger.info(f"{self.name} worker of door {self.door_id} ready")
+        return credentials
+
+    def hung(self) -> bool:
+        return time.monotonic() - self._last_seen > self.heartbeat_interval * self.heartbeat_misses
+
+    def alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    def _command(self, command: bytes):
+        try:
+            os.write(self._command_fd, command)
+        except OSError:
+            pass  # worker gone, the supervisor restarts it
+
+    def pause(self):
+        self._command(CMD_PAUSE)
+
+    def resume(self):
+        self._command(CMD_RESUME)
+
+    def stop(self, timeout: float = DEFAULT_STOP_TIMEOUT):
+        """Blocking, lets the worker close its reader and kills it if it doesn't exit in time."""
+        if self.process is None:
+            return
+        self._command(CMD_STOP)
+        self.process.join(timeout)
+        if self.process.is_alive():
+            logger.warning(f"{self.name} worker of door {self.door_id} didn't stop, killing it")
+            self.process.kill()
+            self.process.join()
+        for fd in (self._event_fd, self._command_fd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self.process = None
+
+    def restart(self):
+        self.stop(timeout=0.5)
+        self.stats["restarts"] += 1
+        self.start()
+        self.backoff = min(self.backoff * 2, DEFAULT_MAX_RESTART_BACKOFF)
+
+    def getStats(self) -> dict:
+        stats = dict(self.stats)
+        stats["pid"] = self.process.pid if self.process is not None else None
+        stats["ready"] = self.ready
+        return stats
@@ -8,8 +8,8 @@ Works on Raspberry Pi Zero (using /dev/serial0, /dev/ttyAMA0, or /dev/ttyS0 depe
 
 import serial
 import time
-import struct
-from typing import Optional, Tuple, List
+import select
+from typing import List
 import base64
 import json
 from pathlib import Path
@@ -17,11 +17,14 @@ import logging
 
 import RPi.GPIO as GPIO
 
+from fingerprint_module.frameParser import Frame, SerialFrameReader
+
 
 # Default serial port for Raspberry Pi
 DEFAULT_PORT = "/dev/serial0"
 DEFAULT_BAUD = 19200
 DEFAULT_TIMEOUT = 15.0  # seconds for serial read
+DEFAULT_CAPTURE_WATCHDOG = 60.0  # seconds without any answer to 0x23 before the module is considered hung
 
 # ACK response codes from manual
 ACK_SUCCESS = 0x00
@@ -32,12 +35,15 @@ ACK_FIN_EXIST = 0x07
 ACK_TIMEOUT = 0x08
 ACK_USER_EXIST = 0x06
 
+# Commands
+CMD_GET_EIGENVALUES = 0x23
+CMD_SLEEP = 0x2C
+
 # GPIO
 RST_PIN = 24
 
 # Logging
 logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.DEBUG)
 
 class FingerprintError(Exception):
     pass
@@ -45,18 +51,43 @@ class FingerprintError(Exception):
 
 class FingerprintModule:
 
-    def __init__(self, port: str = DEFAULT_PORT, baud: int = DEFAULT_BAUD, timeout: float = DEFAULT_TIMEOUT):
+    def __init__(self, port: str = DEFAULT_PORT, baud: int = DEFAULT_BAUD, timeout: float = DEFAULT_TIMEOUT,
+                 warm_standby: bool = True, capture_watchdog: float = DEFAULT_CAPTURE_WATCHDOG,
+                 reset_pin: int = RST_PIN):
         self.port = port
+        self.reset_pin = reset_pin  # every sensor on the device needs its own reset line
         self.baud = baud
         self.timeout = timeout
+        # Warm standby keeps the sensor awake between scans, hardware reset is only used for recovery
+        self.warm_standby = warm_standby
+        self.capture_watchdog = capture_watchdog
+        self._asleep = True  # state after power up / previous process is unknown
+        self._armed = False  # caller wants eigenvalues
+        self._capture_sent = None  # monotonic time of the pending 0x23 command, None when none is pending
+        self._gpio_ready = False
+        self.stats = {"rearms": 0, "resets": 0, "timeouts": 0, "last_rearm_ms": 0.0, "max_rearm_ms": 0.0}
+        self.tracer = None  # optional Tracer receiving the serial framing time of every capture
         self.ser = serial.Serial(port=self.port, baudrate=self.baud, timeout=self.timeout)
         # Ensure serial is open
         if not self.ser.is_open:
             self.ser.open()
+        self.reader = SerialFrameReader(self.ser)
+        self._frames = []
 
     def close(self):
         if self.ser and self.ser.is_open:
             self.ser.close()
+        if self._gpio_ready:
+            GPIO.cleanup(self.reset_pin)
+            self._gpio_ready = False
+
+    def fileno(self) -> int:
+        # Allows registering the serial port in selectors / asyncio event loops
+        return self.ser.fileno()
+
+    def bytes_missing(self) -> int:
+        """Number of bytes still missing to complete the response currently being received."""
+        return self.reader.parser.bytes_missing()
 
     # ------------------------
     # Packet helpers
@@ -91,19 +122,6 @@ class FingerprintModule:
 
         return header_packet + data_packet
 
-    def _read_exact(self, n: int) -> bytes:
-        buf = b""
-        start = time.time()
-        while len(buf) < n:
-            chunk = self.ser.read(n - len(buf))
-            if not chunk:
-                # timeout
-                if (time.time() - start) >= self.timeout:
-                    raise FingerprintError(f"Timeout reading {n} bytes from serial (got {len(buf)}).")
-                continue
-            buf += chunk
-        return buf
-
     # ------------------------
     # Low-level send / receive
     # ------------------------
@@ -111,73 +129,114 @@ class FingerprintModule:
         self.ser.write(packet)
         self.ser.flush()
 
-    def _receive_response(self, expect_data: bool = False) -> Tuple[int, List[int], Optional[bytes]]:
-        if self.ser.in_waiting < 198:
-            return None, None, None
-
-        header = self._read_exact(8)
-        if header[0] != 0xF5 or header[-1] != 0xF5:
-            raise FingerprintError(f"Invalid response header framing: {header.hex()}")
-
-        cmd = header[1]
-        hi = header[2]
-        lo = header[3]
-        q3 = header[4]
-        # header checksum verify
-        chk_calc = self._checksum(header[1:6])
-        if chk_calc != header[6]:
-            raise FingerprintError(f"Header checksum mismatch: calc {chk_calc:02x} != recv {header[6]:02x}")
-
-        length = (hi << 8) | lo
-        data = None
-        if length > 0:
-            # Now receive data packet: expect 0xF5, then length bytes, then CHK, then 0xF5
-            first = self._read_exact(1)
-            if first[0] != 0xF5:
-                raise FingerprintError("Data packet does not start with 0xF5")
-            payload = self._read_exact(length)
-            tail = self._read_exact(2)  # CHK, 0xF5
-            chk_calc = self._checksum(payload)  # manual: CHK is XOR of second byte to Len+1 in data packet.
-            # In our payload-only approach, we XOR payload bytes (which correspond to data bytes)
-            if chk_calc != tail[0]:
-                raise FingerprintError("Data packet checksum mismatch")
-            if tail[1] != 0xF5:
-                raise FingerprintError("Data packet end byte not 0xF5")
-            data = payload
-        # Return command, params (give back Q3 and others if useful), and data
-        params = [header[2], header[3], header[4]]  # hi, lo, Q3 (useful mapping depends on cmd)
-        return cmd, params, data
+    def poll(self) -> List[Frame]:
+        """Parse every byte the driver has buffered and return the complete frames, never blocks."""
+        frames = self._frames + self.reader.read_available()
+        self._frames = []
+        return frames
+
+    def _receive_response(self, cmd: int = None, timeout: float = None) -> Frame:
+        """Wait for the next frame (for `cmd` when given), sleeping in select() until bytes arrive."""
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+        while True:
+            frames = self.poll()
+            for i, frame in enumerate(frames):
+                if cmd is None or frame.cmd == cmd:
+                    # Frames that arrived after the matching one are kept for the next call
+                    self._frames = frames[i + 1:]
+                    return frame
+                logger.debug(f"Dropping unexpected response to command {frame.cmd:#04x}")
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise FingerprintError("Timeout waiting for fingerprint module response")
+            select.select([self.ser.fileno()], [], [], remaining)
 
     # ------------------------
     # Data commands (image / eigenvalues)
     # ------------------------
 
     def new_scan(self):
-        self.hardware_reset()
-        packet = self._build_simple_command(0x23)
-        self._send(packet)
-    
+        """Arm an eigenvalue capture. In warm standby this is a plain command, no reset."""
+        start = time.perf_counter()
+        if not self.warm_standby or self._asleep or self._capture_hung():
+            self.hardware_reset()
+
+        self._discard_stale()
+        self._armed = True
+        if self._capture_sent is None:
+            self._arm_capture()
+
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        self.stats["rearms"] += 1
+        self.stats["last_rearm_ms"] = elapsed_ms
+        self.stats["max_rearm_ms"] = max(self.stats["max_rearm_ms"], elapsed_ms)
+
     def stop_scan(self):
-        packet = self._build_simple_command(0x2C)
+        self._armed = False
+        if self.warm_standby:
+            # A capture still pending in the sensor is reused by the next new_scan()
+            logger.debug("Scan paused, sensor kept in warm standby.")
+            return
+        packet = self._build_simple_command(CMD_SLEEP)
         self._send(packet)
+        self._asleep = True
+        self._capture_sent = None
         logger.debug("Stop (sleep) command sent.")
 
+    def _arm_capture(self):
+        self._send(self._build_simple_command(CMD_GET_EIGENVALUES))
+        self._capture_sent = time.monotonic()
+
+    def _capture_hung(self) -> bool:
+        return self._capture_sent is not None and time.monotonic() - self._capture_sent > self.capture_watchdog
+
+    def _discard_stale(self):
+        # Anything that arrived while paused belongs to the previous user
+        for frame in self.poll():
+            if frame.cmd == CMD_GET_EIGENVALUES:
+                self._capture_sent = None
+
     def hardware_reset(self):
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setup(RST_PIN, GPIO.OUT)
-        GPIO.output(RST_PIN, GPIO.LOW)
+        # Only the reset pin is touched, other GPIOs (e.g. the door relay) keep their configuration
+        if not self._gpio_ready:
+            GPIO.setmode(GPIO.BCM)
+            GPIO.setup(self.reset_pin, GPIO.OUT, initial=GPIO.HIGH)
+            self._gpio_ready = True
+        GPIO.output(self.reset_pin, GPIO.LOW)
         time.sleep(0.05)  # 50 ms low pulse
-        GPIO.output(RST_PIN, GPIO.HIGH)
+        GPIO.output(self.reset_pin, GPIO.HIGH)
         time.sleep(0.2)   # wait for module to boot
-        GPIO.cleanup()
+        self.ser.reset_input_buffer()
+        self.reader.parser.reset()
+        self._frames = []
+        self._asleep = False
+        self._capture_sent = None
+        self.stats["resets"] += 1
         logger.debug("Fingerprint module reset (woken from sleep).")
 
+    def getStats(self) -> dict:
+        stats = dict(self.stats)
+        stats["parser"] = dict(self.reader.parser.stats)
+        return stats
+
     def get_eigenvalues(self, wait=0) -> bytes:
+        """Non-blocking: eigenvalues once the whole response has arrived, None before that."""
         time.sleep(wait)
-        cmd, params, data = self._receive_response(expect_data=True)
-        if data is None:
-           return None
-        return data  # likely starts with 0 0 0 then 193 bytes per manual; handle caller-side.
+        for frame in self.poll():
+            if frame.cmd != CMD_GET_EIGENVALUES:
+                continue
+            self._capture_sent = None
+            if frame.data is not None:
+                if self.tracer is not None:
+                    self.tracer.record("fp_framing", frame.rx_ns)
+                return frame.data  # likely starts with 0 0 0 then 193 bytes per manual; handle caller-side.
+            logger.debug(f"Eigenvalue capture finished without data, ACK {frame.params[2]:#04x}")
+            if frame.params[2] == ACK_TIMEOUT:
+                self.stats["timeouts"] += 1
+            if self._armed:
+                # Sensor gave up waiting for a finger, re-arm with a plain command
+                self._arm_capture()
+        return None
 
     # ------------------------
     # Utility: Conversion tools (JSON, bin)
@@ -221,6 +280,7 @@ class FingerprintModule:
     
     
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
     fp = FingerprintModule(port=DEFAULT_PORT, baud=DEFAULT_BAUD, timeout=0)
 
     logger.info("Get eigenvalues of your fingerprint")
@@ -0,0 +1,216 @@
+"""
+frameParser.py
+
+Incremental parser for the 0xF5 framing used by the UART fingerprint sensor.
+
+Every response starts with an 8-byte header:
+    0xF5 CMD P1 P2 P3 0 CHK 0xF5          CHK = XOR of CMD..0
+Some commands (e.g. 0x23, upload eigenvalues) follow a successful header with
+a data packet whose length is given by P1/P2:
+    0xF5 DATA[length] CHK 0xF5            CHK = XOR of DATA
+
+The parser accepts whatever bytes have arrived, validates both checksums on
+the fly into a reused buffer and emits complete frames through a callback.
+Garbage before a frame start is skipped so the stream resynchronises itself.
+"""
+import asyncio
+import logging
+import time
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+FRAME_MARK = 0xF5
+HEADER_SIZE = 8
+MAX_DATA_LENGTH = 16 * 1024
+DEFAULT_RX_CHUNK = 256
+
+# Commands whose successful response carries a data packet
+DATA_RESPONSE_COMMANDS = frozenset((0x23, 0x24, 0x31))
+
+# rx_ns: nanoseconds from the first byte of the frame arriving to the frame being complete
+Frame = namedtuple("Frame", ["cmd", "params", "data", "rx_ns"])
+
+# Parser states
+_SYNC = 0
+_HEADER = 1
+_DATA_START = 2
+_DATA = 3
+_DATA_CHK = 4
+_DATA_END = 5
+
+
+class FrameParser:
+
+    def __init__(self, on_frame=None, data_commands=DATA_RESPONSE_COMMANDS, max_data_length: int = MAX_DATA_LENGTH):
+        self.on_frame = on_frame
+        self.data_commands = data_commands
+        self.max_data_length = max_data_length
+
+        self._header = bytearray(HEADER_SIZE)
+        self._data = bytearray(max_data_length)
+        self._data_view = memoryview(self._data)
+        self.stats = {"frames": 0, "checksum_errors": 0, "framing_errors": 0, "skipped_bytes": 0}
+        self.reset()
+
+    def reset(self):
+        self._state = _SYNC
+        self._pos = 0
+        self._chk = 0
+        self._length = 0
+        self._start_ns = 0
+
+    def bytes_missing(self) -> int:
+        """Lower bound of bytes still needed to finish the frame in progress (0 when idle)."""
+        state = self._state
+        if state == _SYNC:
+            return 0
+        if state == _HEADER:
+            return HEADER_SIZE - self._pos
+        if state == _DATA_START:
+            return self._length + 3
+        if state == _DATA:
+            return self._length - self._pos + 2
+        return 2 if state == _DATA_CHK else 1
+
+    def feed(self, chunk) -> list:
+        """Consume any number of bytes, return the frames completed by them."""
+        frames = []
+        for byte in memoryview(chunk).cast("B"):
+            frame = self._step(byte)
+            if frame is not None:
+                frames.append(frame)
+                self.stats["frames"] += 1
+                if self.on_frame is not None:
+                    self.on_frame(frame)
+        return frames
+
+    def _step(self, byte: int):
+        state = self._state
+
+        if state == _SYNC:
+            if byte == FRAME_MARK:
+                self._header[0] = byte
+                self._pos = 1
+                self._chk = 0
+                self._start_ns = time.monotonic_ns()
+                self._state = _HEADER
+            else:
+                self.stats["skipped_bytes"] += 1
+            return None
+
+        if state == _HEADER:
+            self._header[self._pos] = byte
+            self._pos += 1
+            if self._pos < 7:
+                self._chk ^= byte
+                return None
+            if self._pos == 7:
+                if byte != self._chk:
+                    return self._error("checksum_errors", f"Header checksum mismatch: calc {self._chk:02x} != recv {byte:02x}")
+                return None
+            if byte != FRAME_MARK:
+                return self._error("framing_errors", f"Invalid response header framing: {self._header.hex()}")
+            return self._header_done()
+
+        if state == _DATA_START:
+            if byte != FRAME_MARK:
+                return self._error("framing_errors", "Data packet does not start with 0xF5")
+            self._pos = 0
+            self._chk = 0
+            self._state = _DATA
+            return None
+
+        if state == _DATA:
+            self._data[self._pos] = byte
+            self._chk ^= byte
+            self._pos += 1
+            if self._pos == self._length:
+                self._state = _DATA_CHK
+            return None
+
+        if state == _DATA_CHK:
+            if byte != self._chk:
+                return self._error("checksum_errors", "Data packet checksum mismatch")
+            self._state = _DATA_END
+            return None
+
+        # _DATA_END
+        if byte != FRAME_MARK:
+            return self._error("framing_errors", "Data packet end byte not 0xF5")
+        header = self._header
+        frame = Frame(header[1], (header[2], header[3], header[4]), bytes(self._data_view[:self._length]),
+                      time.monotonic_ns() - self._start_ns)
+        self.reset()
+        return frame
+
+    def _header_done(self):
+        header = self._header
+        cmd = header[1]
+        length = (header[2] << 8) | header[3]
+        if cmd in self.data_commands and length > 0:
+            if length > self.max_data_length:
+                return self._error("framing_errors", f"Data packet of {length} bytes is too long")
+            self._length = length
+            self._state = _DATA_START
+            return None
+        self.reset()
+        return Frame(cmd, (header[2], header[3], header[4]), None, time.monotonic_ns() - self._start_ns)
+
+    def _error(self, counter: str, message: str):
+        self.stats[counter] += 1
+        logger.warning(message)
+        self.reset()
+        return None
+
+
+class SerialFrameReader:
+    """Drives a FrameParser from the readability of a non-blocking serial port in an asyncio loop.
+
+    Frames are delivered to `on_frame` or can be consumed with `async for frame in reader`.
+    """
+
+    def __init__(self, ser, parser: FrameParser = None, on_frame=None, rx_chunk: int = DEFAULT_RX_CHUNK):
+        self.ser = ser
+        self.parser = parser if parser is not None else FrameParser()
+        self.parser.on_frame = self._on_frame
+        self.on_frame = on_frame
+        self._rx = bytearray(rx_chunk)
+        self._rx_view = memoryview(self._rx)
+        self._queue = None
+        self._loop = None
+
+    def attach(self, loop: asyncio.AbstractEventLoop = None):
+        self._loop = loop if loop is not None else asyncio.get_running_loop()
+        if self.on_frame is None and self._queue is None:
+            self._queue = asyncio.Queue()
+        self._loop.add_reader(self.ser.fileno(), self.read_available)
+
+    def detach(self):
+        if self._loop is not None:
+            self._loop.remove_reader(self.ser.fileno())
+            self._loop = None
+
+    def read_available(self) -> list:
+        """Drain everything the driver has buffered into the parser, never blocks."""
+        frames = []
+        while True:
+            waiting = min(self.ser.in_waiting, len(self._rx))
+            if not waiting:
+                return frames
+            n = self.ser.readinto(self._rx_view[:waiting])
+            frames.extend(self.parser.feed(self._rx_view[:n]))
+
+    def _on_frame(self, frame: Frame):
+        if self.on_frame is not None:
+            self.on_frame(frame)
+        elif self._queue is not None:
+            self._queue.put_nowait(frame)
+
+    def __aiter__(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        return self
+
+    async def __anext__(self) -> Frame:
+        return await self._queue.get()
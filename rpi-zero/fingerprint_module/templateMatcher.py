@@ -0,0 +1,411 @@
+"""
+templateMatcher.py
+
+1:N matching of fingerprint eigenvalues against the enrolled templates.
+Templates live in one fixed-layout file that is memory-mapped, so opening it is
+instant whatever its size and every process matching against it (door, bridge)
+shares the same page cache copy:
+
+    header     64 B      magic, layout, capacity, count, generation
+    ids        capacity x 64 B              UTF-8 identifier (credential id), zero padded
+    coarse     COARSE_WORDS x capacity u64  a few words of every template, one column per word
+    templates  capacity x ROW_WORDS u64     193 eigenvalue bytes, zero padded to 200
+
+A template is compared by the Hamming distance of its bits. match() first scores
+the coarse words of every template at once (32 B per template instead of 200 B),
+keeps the closest `candidates` and computes the full distance only for them. A
+genuine capture sits tens of standard deviations closer than an impostor even on
+the coarse bits, prefilter=False scans everything exactly.
+
+Writers (enroll, remove) take an exclusive flock on <path>.lock, match() a shared
+one, so a match never sees a row that is being moved or rewritten (remove() moves
+the last template into the freed row). The lock file is never replaced, unlike the
+store when it grows, readers remap a grown (re-created) store on their next match().
+"""
+import argparse
+import contextlib
+import fcntl
+import logging
+import os
+import struct
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"FPT1"
+TEMPLATE_HEADER = 3  # leading zero bytes of the sensor's eigenvalue packet
+TEMPLATE_BYTES = 193
+ROW_WORDS = 25  # 193 bytes padded to 200, compared as 64 bit words
+ID_BYTES = 64
+COARSE_WORDS = (1, 7, 13, 19)  # spread over the template, the tail of real captures is mostly zeros
+TEMPLATE_BITS = TEMPLATE_BYTES * 8
+
+DEFAULT_CAPACITY = 1024  # templates, the file doubles when it is full
+DEFAULT_MAX_DISTANCE = 0.25  # fraction of the template bits that may differ for a match
+DEFAULT_CANDIDATES = 64  # templates kept by the coarse prefilter
+
+_HEADER = struct.Struct("<4sHHHHIII")  # magic, template bytes, row words, id bytes, coarse words, capacity, count, generation
+_HEADER_SIZE = 64
+_COUNT_OFFSET = 16
+_GENERATION_OFFSET = 20
+
+if hasattr(np, "bitwise_count"):
+    def _popcount(words) -> np.ndarray:
+        """Set bits of every uint64 word."""
+        return np.bitwise_count(words)
+else:
+    # NumPy < 2.0 (Raspberry Pi OS), byte lookup table
+    _POPCOUNT8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+    def _popcount(words) -> np.ndarray:
+        counts = _POPCOUNT8[np.ascontiguousarray(words).view(np.uint8)]
+        return counts.reshape(*words.shape, 8).sum(axis=-1, dtype=np.uint8)
+
+
+def _popcount_rows(words) -> np.ndarray:
+    return _popcount(words).sum(axis=1, dtype=np.uint16)
+
+
+class TemplateStoreError(Exception):
+    pass
+
+
+class MatchResult:
+    __slots__ = ("identifier", "distance", "score")
+
+    def __init__(self, identifier: str, distance: int, score: float):
+        self.identifier = identifier
+        self.distance = distance  # differing bits
+        self.score = score  # 1.0 for identical templates, about 0.5 for unrelated ones
+
+    def __repr__(self):
+        return f"MatchResult({self.identifier!r}, distance={self.distance}, score={self.score:.3f})"
+
+
+def template_row(eigen: bytes) -> np.ndarray:
+    """ROW_WORDS uint64 words of a 196 byte sensor packet or of the bare 193 eigenvalue bytes."""
+    if len(eigen) == TEMPLATE_BYTES + TEMPLATE_HEADER:
+        eigen = eigen[TEMPLATE_HEADER:]
+    if len(eigen) != TEMPLATE_BYTES:
+        raise ValueError(f"Fingerprint template has {len(eigen)} bytes, expected {TEMPLATE_BYTES}")
+    row = np.zeros(ROW_WORDS * 8, dtype=np.uint8)
+    row[:TEMPLATE_BYTES] = np.frombuffer(eigen, dtype=np.uint8)
+    return row.view(np.uint64)
+
+
+def _layout(capacity: int) -> tuple:
+    ids = _HEADER_SIZE
+    coarse = ids + capacity * ID_BYTES
+    templates = coarse + capacity * len(COARSE_WORDS) * 8
+    return ids, coarse, templates, templates + capacity * ROW_WORDS * 8
+
+
+def _create(path: str, capacity: int):
+    size = _layout(capacity)[3]
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, TEMPLATE_BYTES, ROW_WORDS, ID_BYTES, len(COARSE_WORDS), capacity, 0, 0))
+        f.truncate(size)
+    return tmp
+
+
+class TemplateMatcher:
+
+    def __init__(self, path: str, writable: bool = False,
+                 max_distance: float = DEFAULT_MAX_DISTANCE,
+                 candidates: int = DEFAULT_CANDIDATES,
+                 prefilter: bool = True,
+                 capacity: int = DEFAULT_CAPACITY):
+        self.path = path
+        self.writable = writable
+        self.max_distance_bits = int(max_distance * TEMPLATE_BITS)
+        self.candidates = candidates
+        self.prefilter = prefilter
+        self.stats = {"matches": 0, "matched": 0, "unmatched": 0, "exact_scans": 0, "remaps": 0}
+        self._index = None  # identifier -> row, only built for enrollment
+        self._index_generation = None
+        self.lock_path = f"{path}.lock"
+        if not os.path.exists(path):
+            if not writable:
+                raise TemplateStoreError(f"Template store {path} doesn't exist")
+            with self._locked(fcntl.LOCK_EX):
+                if not os.path.exists(path):
+                    os.replace(_create(path, capacity), path)
+        self._map()
+
+    @contextlib.contextmanager
+    def _locked(self, operation: int):
+        # One open file description per call, flock locks are shared by every thread using the same one
+        try:
+            fd = os.open(self.lock_path, os.O_RDONLY | os.O_CREAT, 0o644)
+        except OSError as e:
+            raise TemplateStoreError(f"Can't open the template store lock {self.lock_path}: {e}") from e
+        try:
+            fcntl.flock(fd, operation)
+            yield
+        finally:
+            os.close(fd)
+
+    def _map(self):
+        mode = "r+" if self.writable else "r"
+        self._mm = np.memmap(self.path, dtype=np.uint8, mode=mode)
+        magic, template_bytes, row_words, id_bytes, coarse_words, capacity, _, _ = _HEADER.unpack_from(self._mm)
+        if (magic, template_bytes, row_words, id_bytes, coarse_words) != (MAGIC, TEMPLATE_BYTES, ROW_WORDS, ID_BYTES, len(COARSE_WORDS)):
+            raise TemplateStoreError(f"{self.path} is not a template store of this layout")
+        ids, coarse, templates, end = _layout(capacity)
+        if len(self._mm) < end:
+            raise TemplateStoreError(f"{self.path} is truncated")
+        self.capacity = capacity
+        self._header = self._mm[:_HEADER_SIZE].view(np.uint32)
+        self._ids = self._mm[ids:coarse].reshape(capacity, ID_BYTES)
+        self._coarse = self._mm[coarse:templates].view(np.uint64).reshape(len(COARSE_WORDS), capacity)
+        self._templates = self._mm[templates:end].view(np.uint64).reshape(capacity, ROW_WORDS)
+        self._inode = os.stat(self.path).st_ino
+        self._index = None
+
+    def refresh(self) -> bool:
+        """Remap when the store was re-created by a writer (grown), True when it was."""
+        try:
+            if os.stat(self.path).st_ino == self._inode:
+                return False
+        except FileNotFoundError:
+            return False
+        self._map()
+        self.stats["remaps"] += 1
+        return True
+
+    def count(self) -> int:
+        return int(self._header[_COUNT_OFFSET // 4])
+
+    def generation(self) -> int:
+        return int(self._header[_GENERATION_OFFSET // 4])
+
+    def identifier(self, index: int) -> str:
+        return bytes(self._ids[index]).rstrip(b"\0").decode("utf-8")
+
+    # ------------------------
+    # Matching
+    # ------------------------
+    def match(self, eigen: bytes):
+        """Closest enrolled template within max_distance as a MatchResult, None otherwise."""
+        with self._locked(fcntl.LOCK_SH):
+            self.refresh()
+            return self._match(eigen)
+
+    def _match(self, eigen: bytes):
+        self.stats["matches"] += 1
+        count = self.count()
+        if count == 0:
+            self.stats["unmatched"] += 1
+            return None
+        probe = template_row(eigen)
+
+        if self.prefilter and count > self.candidates:
+            # Column by column: long contiguous vectors instead of a reduction over 4 words per row
+            coarse = np.zeros(count, dtype=np.uint16)
+            for column, word in zip(self._coarse, COARSE_WORDS):
+                coarse += _popcount(column[:count] ^ probe[word])
+            rows = np.argpartition(coarse, self.candidates)[:self.candidates]
+            distances = _popcount_rows(self._templates[rows] ^ probe)
+        else:
+            self.stats["exact_scans"] += 1
+            rows = None
+            distances = _popcount_rows(self._templates[:count] ^ probe)
+
+        best = int(np.argmin(distances))
+        distance = int(distances[best])
+        if distance > self.max_distance_bits:
+            self.stats["unmatched"] += 1
+            return None
+        self.stats["matched"] += 1
+        index = int(rows[best]) if rows is not None else best
+        return MatchResult(self.identifier(index), distance, 1.0 - distance / TEMPLATE_BITS)
+
+    # ------------------------
+    # Enrollment
+    # ------------------------
+    def enroll(self, identifier: str, eigen: bytes) -> int:
+        """Add (or replace) the template of `identifier`, returns its row."""
+        return self.enroll_many([identifier], [eigen])[0]
+
+    def enroll_many(self, identifiers: list, templates: list) -> list:
+        if not self.writable:
+            raise TemplateStoreError("Template store opened read-only")
+        encoded = [identifier.encode("utf-8") for identifier in identifiers]
+        if any(len(name) > ID_BYTES or not name for name in encoded):
+            raise ValueError(f"Template identifiers have to be 1 to {ID_BYTES} bytes")
+        rows = [template_row(eigen) for eigen in templates]
+        with self._locked(fcntl.LOCK_EX):
+            self.refresh()
+            count = self.count()
+            if count + len(rows) > self.capacity:
+                self._grow(max(self.capacity * 2, count + len(rows)))
+            index = self._identifiers()
+            placed = []
+            for name, identifier, row in zip(encoded, identifiers, rows):
+                slot = index.get(identifier)
+                if slot is None:
+                    slot = count
+                    count += 1
+                    index[identifier] = slot
+                self._write_row(slot, name, row)
+                placed.append(slot)
+            # Count goes last, readers never see a row before it is complete
+            self._bump(count)
+        return placed
+
+    def remove(self, identifier: str) -> bool:
+        if not self.writable:
+            raise TemplateStoreError("Template store opened read-only")
+        with self._locked(fcntl.LOCK_EX):
+            self.refresh()
+            index = self._identifiers()
+            slot = index.pop(identifier, None)
+            if slot is None:
+                return False
+            last = self.count() - 1
+            if slot != last:
+                # Keep the rows dense: the last template moves into the hole
+                moved = self.identifier(last)
+                self._write_row(slot, bytes(self._ids[last]).rstrip(b"\0"), self._templates[last].copy())
+                index[moved] = slot
+            self._ids[last] = 0
+            self._bump(last)
+        return True
+
+    def _identifiers(self) -> dict:
+        # Rebuilt when another writer changed the store since
+        if self._index is None or self._index_generation != self.generation():
+            self._index = {self.identifier(i): i for i in range(self.count())}
+            self._index_generation = self.generation()
+        return self._index
+
+    def _write_row(self, slot: int, name: bytes, row: np.ndarray):
+        self._ids[slot] = 0
+        self._ids[slot, :len(name)] = np.frombuffer(name, dtype=np.uint8)
+        self._templates[slot] = row
+        self._coarse[:, slot] = row[list(COARSE_WORDS)]
+
+    def _bump(self, count: int):
+        self._header[_COUNT_OFFSET // 4] = count
+        self._header[_GENERATION_OFFSET // 4] += 1
+        self._index_generation = self.generation()
+        self._mm.flush()
+
+    def _grow(self, capacity: int):
+        count = self.count()
+        tmp = _create(self.path, capacity)
+        grown = np.memmap(tmp, dtype=np.uint8, mode="r+")
+        ids, coarse, templates, _ = _layout(capacity)
+        grown[ids:ids + count * ID_BYTES] = self._ids[:count].reshape(-1)
+        grown_coarse = grown[coarse:templates].view(np.uint64).reshape(len(COARSE_WORDS), capacity)
+        grown_coarse[:, :count] = self._coarse[:, :count]
+        del grown_coarse
+        grown[templates:templates + count * ROW_WORDS * 8] = self._templates[:count].view(np.uint8).reshape(-1)
+        header = grown[:_HEADER_SIZE].view(np.uint32)
+        header[_COUNT_OFFSET // 4] = count
+        header[_GENERATION_OFFSET // 4] = self.generation() + 1
+        grown.flush()
+        del grown
+        os.replace(tmp, self.path)
+        index = self._index
+        self._map()
+        self._index, self._index_generation = index, self.generation()
+        logger.info(f"Template store {self.path} grown to {capacity} templates")
+
+    def getStats(self) -> dict:
+        stats = dict(self.stats)
+        stats["templates"] = self.count()
+        stats["capacity"] = self.capacity
+        return stats
+
+    def close(self):
+        self._mm.flush() if self.writable else None
+        del self._mm
+
+
+def _noisy(template: np.ndarray, flip: float, rng) -> bytes:
+    """Template with a fraction `flip` of its eigenvalue bits flipped, a stand-in for a second capture."""
+    bits = np.unpackbits(template.view(np.uint8)[:TEMPLATE_BYTES])
+    bits ^= (rng.random(bits.size) < flip).astype(np.uint8)
+    return np.packbits(bits).tobytes()
+
+
+def benchmark(templates: int, probes: int, flip: float, candidates: int = DEFAULT_CANDIDATES) -> dict:
+    """Enroll random templates in a temporary store and time genuine and impostor 1:N searches."""
+    import tempfile
+
+    rng = np.random.default_rng(1)
+    enrolled = rng.integers(0, 256, size=(templates, TEMPLATE_BYTES), dtype=np.uint8)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "templates.fpt")
+        writer = TemplateMatcher(path, writable=True)
+        start = time.perf_counter()
+        writer.enroll_many([f"user-{i}" for i in range(templates)], [row.tobytes() for row in enrolled])
+        enroll_s = time.perf_counter() - start
+        writer.close()
+
+        start = time.perf_counter()
+        matcher = TemplateMatcher(path, candidates=candidates)
+        open_ms = (time.perf_counter() - start) * 1000
+        exact = TemplateMatcher(path, prefilter=False)
+
+        picks = rng.integers(0, templates, size=probes)
+        genuine = [_noisy(enrolled[i], flip, rng) for i in picks]
+        impostors = [rng.integers(0, 256, size=TEMPLATE_BYTES, dtype=np.uint8).tobytes() for _ in range(probes)]
+        results = {"templates": templates, "probes": probes, "flip": flip, "open_ms": open_ms,
+                   "enroll_us": enroll_s * 1e6 / templates}
+        for name, engine in (("prefilter", matcher), ("exact", exact)):
+            start = time.perf_counter()
+            found = [engine.match(probe) for probe in genuine]
+            genuine_s = time.perf_counter() - start
+            start = time.perf_counter()
+            false = sum(engine.match(probe) is not None for probe in impostors)
+            impostor_s = time.perf_counter() - start
+            results[name] = {
+                "genuine_ms": genuine_s * 1000 / probes,
+                "impostor_ms": impostor_s * 1000 / probes,
+                "matches_per_s": 2 * probes / (genuine_s + impostor_s),
+                "recall": sum(r is not None and r.identifier == f"user-{i}" for r, i in zip(found, picks)) / probes,
+                "false_matches": false,
+            }
+        matcher.close()
+        exact.close()
+    return results
+
+
+if __name__ == "__main__":
+    import json
+    import sys
+
+    parser = argparse.ArgumentParser(description="Fingerprint template store and 1:N matcher")
+    commands = parser.add_subparsers(dest="command", required=True)
+    bench = commands.add_parser("bench", help="1:N throughput on random templates")
+    bench.add_argument("--templates", type=int, default=20000)
+    bench.add_argument("--probes", type=int, default=500)
+    bench.add_argument("--flip", type=float, default=0.1, help="Fraction of bits that differ between two captures")
+    bench.add_argument("--candidates", type=int, default=DEFAULT_CANDIDATES)
+    enroll = commands.add_parser("enroll", help="Add the template from a JSON file written by FingerprintModule.eigen_to_json")
+    enroll.add_argument("store")
+    enroll.add_argument("identifier")
+    enroll.add_argument("template")
+    remove = commands.add_parser("remove", help="Remove the template of an identifier")
+    remove.add_argument("store")
+    remove.add_argument("identifier")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "bench":
+        json.dump(benchmark(args.templates, args.probes, args.flip, args.candidates), sys.stdout, indent=2)
+        print()
+    elif args.command == "enroll":
+        import base64
+        with open(args.template) as f:
+            eigen = base64.b64decode(json.load(f)["data"])
+        store = TemplateMatcher(args.store, writable=True)
+        logger.info(f"Enrolled {args.identifier} at row {store.enroll(args.identifier, eigen)}")
+    else:
+        store = TemplateMatcher(args.store, writable=True)
+        logger.info(f"Removed {args.identifier}" if store.remove(args.identifier) else f"{args.identifier} not enrolled")
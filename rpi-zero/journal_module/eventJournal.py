@@ -0,0 +1,250 @@
+"""
+eventJournal.py
+
+Durable outbound queue of access events (attempts and decisions), kept on the
+device while the broker is unreachable and shipped once it is back.
+- record() is the hot path: it appends a tuple to an in-memory buffer and returns,
+  hashing, JSON encoding and disk writes happen on the writer thread,
+- the writer thread commits the buffer to a SQLite database in WAL mode, at most once
+  per flush_interval (or when batch_size events are waiting), so a busy door costs a
+  handful of SD card writes per second instead of one per event,
+- the buffer is bounded, a long outage grows the database (capped at max_events,
+  oldest events are trimmed first) and never the process memory,
+- run() uploads the backlog in zlib compressed JSON batches with QoS 1 and deletes a
+  batch only after the broker acknowledged it. Delivery is at-least-once, every event
+  carries a unique id (<request id>/<kind>) so the receiver drops the duplicates,
+  the journal itself ignores ids it already holds.
+
+Credentials are never written in clear, events carry their credentialHash.
+
+Event (JSON): {"id": "<request id>/decision", "kind": "decision", "ts": 1700000000.123,
+               "door": "main", "type": "rfid", "credential": "<sha256 hex>",
+               "result": "allow", "source": "online", "latency_ms": 31.2}
+source: "online" / "cache" for published attempts, the admission outcome ("coalesced",
+"merged", "stale", "busy") for reads that weren't published.
+"""
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+from collections import deque
+
+from cache_module.decisionCache import credentialHash
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUFFER_SIZE = 4096  # events waiting for the writer thread
+DEFAULT_BATCH_SIZE = 256  # events per disk commit (early wake-up) and per uploaded message
+DEFAULT_FLUSH_INTERVAL = 1.0  # seconds between disk commits
+DEFAULT_UPLOAD_INTERVAL = 5.0  # seconds between backlog uploads
+DEFAULT_MAX_EVENTS = 200000  # events kept on disk, oldest are trimmed beyond that
+DEFAULT_EVENT_TOPIC = "access/events"
+EVENTS_CONTENT_TYPE = "application/vnd.door-events+zlib"
+
+# Event kinds
+KIND_ATTEMPT = "attempt"  # credential read, sent for a decision or decided by admission control (source)
+KIND_DECISION = "decision"  # outcome of an attempt
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    event_id TEXT NOT NULL UNIQUE,
+    body TEXT NOT NULL
+)
+"""
+
+
+class EventJournal:
+
+    def __init__(self, path: str, mqtt=None, topic: str = DEFAULT_EVENT_TOPIC,
+                 buffer_size: int = DEFAULT_BUFFER_SIZE,
+                 batch_size: int = DEFAULT_BATCH_SIZE,
+                 flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+                 upload_interval: float = DEFAULT_UPLOAD_INTERVAL,
+                 max_events: int = DEFAULT_MAX_EVENTS):
+        self.path = path
+        self.mqtt = mqtt  # MQTTClient the backlog is uploaded through, None keeps events on disk only
+        self.topic = topic
+        self.buffer_size = buffer_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.upload_interval = upload_interval
+        self.max_events = max_events
+        self.stats = {"recorded": 0, "dropped": 0, "written": 0, "duplicates": 0, "trimmed": 0,
+                      "uploaded": 0, "batches": 0, "upload_failures": 0, "raw_bytes": 0, "compressed_bytes": 0}
+
+        self._buffer = deque()
+        self._wake = threading.Event()
+        self._closed = False
+        self._db_lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        # WAL + synchronous=NORMAL: one sequential append per commit, fsync only at checkpoints
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(_SCHEMA)
+        # Kept up to date on every insert and delete, counting on every commit would scan the table
+        self._rows = self._db.execute("SELECT COUNT(*) FROM events").fetchone()[0]
+        self._thread = threading.Thread(target=self._writer, name="event-journal", daemon=True)
+        self._thread.start()
+
+    # ------------------------
+    # Hot path
+    # ------------------------
+    def record(self, kind: str, request_id: str, door_id: str, cred_type: str = None, data=None,
+               result: str = None, source: str = None, latency_ms: float = None):
+        """Queue one event, never blocks and never touches the disk."""
+        if len(self._buffer) >= self.buffer_size:
+            self.stats["dropped"] += 1
+            return
+        self._buffer.append((kind, request_id, time.time(), door_id, cred_type, data, result, source, latency_ms))
+        self.stats["recorded"] += 1
+        if len(self._buffer) >= self.batch_size:
+            self._wake.set()
+
+    # ------------------------
+    # Writer thread
+    # ------------------------
+    def _writer(self):
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except sqlite3.Error:
+                logger.exception("Failed to write access events")
+
+    @staticmethod
+    def _encode(event: tuple) -> tuple:
+        kind, request_id, ts, door_id, cred_type, data, result, source, latency_ms = event
+        event_id = f"{request_id}/{kind}"
+        body = {"id": event_id, "kind": kind, "ts": round(ts, 3), "door": door_id}
+        if cred_type is not None:
+            body["type"] = cred_type
+            body["credential"] = credentialHash(cred_type, data)
+        if result is not None:
+            body["result"] = result
+        if source is not None:
+            body["source"] = source
+        if latency_ms is not None:
+            body["latency_ms"] = round(latency_ms, 1)
+        return event_id, json.dumps(body, separators=(",", ":"))
+
+    def flush(self) -> int:
+        """Write the buffered events in one transaction, returns how many were new."""
+        rows = []
+        while self._buffer:
+            rows.append(self._encode(self._buffer.popleft()))
+        if not rows:
+            return 0
+        with self._db_lock:
+            before = self._db.total_changes
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany("INSERT OR IGNORE INTO events (event_id, body) VALUES (?, ?)", rows)
+                written = self._db.total_changes - before
+                trimmed = self._trim(self._rows + written)
+                self._db.execute("COMMIT")
+            except sqlite3.Error:
+                self._db.execute("ROLLBACK")
+                raise
+            self._rows += written - trimmed
+        self.stats["written"] += written
+        self.stats["duplicates"] += len(rows) - written
+        self.stats["trimmed"] += trimmed
+        return written
+
+    def _trim(self, rows: int) -> int:
+        excess = rows - self.max_events
+        if excess <= 0:
+            return 0
+        trimmed = self._db.execute("DELETE FROM events WHERE seq IN (SELECT seq FROM events ORDER BY seq LIMIT ?)",
+                                   (excess,)).rowcount
+        logger.warning(f"Event journal full, dropped the {trimmed} oldest events")
+        return trimmed
+
+    # ------------------------
+    # Upload
+    # ------------------------
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.upload_interval)
+            try:
+                await loop.run_in_executor(None, self.upload)
+            except Exception:
+                logger.exception("Event upload failed")
+
+    def upload(self) -> int:
+        """Ship the backlog batch by batch until it is empty or the broker stops acknowledging."""
+        if self.mqtt is None or not self.mqtt.isConnected():
+            return 0
+        uploaded = 0
+        while True:
+            with self._db_lock:
+                batch = self._db.execute("SELECT seq, body FROM events ORDER BY seq LIMIT ?", (self.batch_size,)).fetchall()
+            if not batch:
+                break
+            raw = ("[" + ",".join(body for _, body in batch) + "]").encode("utf-8")
+            payload = zlib.compress(raw)
+            if not self.mqtt.publish(self.topic, payload, content_type=EVENTS_CONTENT_TYPE):
+                self.stats["upload_failures"] += 1
+                break
+            with self._db_lock:
+                self._rows -= self._db.execute("DELETE FROM events WHERE seq <= ?", (batch[-1][0],)).rowcount
+            uploaded += len(batch)
+            self.stats["uploaded"] += len(batch)
+            self.stats["batches"] += 1
+            self.stats["raw_bytes"] += len(raw)
+            self.stats["compressed_bytes"] += len(payload)
+        if uploaded:
+            logger.debug(f"Uploaded {uploaded} access events")
+        return uploaded
+
+    # ------------------------
+    # State
+    # ------------------------
+    def backlog(self) -> int:
+        with self._db_lock:
+            return self._rows
+
+    def getStats(self) -> dict:
+        stats = dict(self.stats)
+        stats["buffered"] = len(self._buffer)
+        stats["backlog"] = self.backlog()
+        return stats
+
+    def close(self):
+        self._closed = True
+        self._wake.set()
+        self._thread.join()
+        self.flush()
+        with self._db_lock:
+            self._db.close()
+
+
+if __name__ == "__main__":
+    # Hot path cost of record() and disk throughput of flush()
+    import os
+    import sys
+    import tempfile
+    import uuid
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    with tempfile.TemporaryDirectory() as directory:
+        journal = EventJournal(os.path.join(directory, "events.db"), buffer_size=count, batch_size=count,
+                               flush_interval=3600)
+        request_ids = [uuid.uuid4().hex for _ in range(count)]
+        start = time.perf_counter_ns()
+        for request_id in request_ids:
+            journal.record(KIND_DECISION, request_id, "main", "rfid", "04a2246f2e5d80", "allow", "online", 31.2)
+        record_ns = (time.perf_counter_ns() - start) / count
+        start = time.perf_counter()
+        journal.flush()
+        flush_s = time.perf_counter() - start
+        size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+        journal.close()
+    print(f"record: {record_ns / 1000:.2f} us/event, flush: {flush_s * 1e6 / count:.1f} us/event, "
+          f"{size / count:.0f} B/event on disk")
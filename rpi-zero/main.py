@@ -1,57 +1,96 @@
+import asyncio
 import logging
-import time
-
-import json
-
-from rfid_module.cardRead import RFIDModule
-
-from fingerprint_module.fingerprintRead import FingerprintModule, DEFAULT_PORT, DEFAULT_BAUD
-import time
-import base64
-
-from camera_module.qrRead import CameraModule
-from picamera2 import Picamera2
+from concurrent.futures import ThreadPoolExecutor
 
 import mqtt_module.mqttClient as mqttClient
 import dotenv
 
+from mqtt_module.wireFormat import WIRE_FORMAT_JSON
+from door_module.admissionControl import DEFAULT_WINDOW, DEFAULT_MAX_IN_FLIGHT
+from door_module.doorTopology import build_doors, load_topology, topology_from_env
+from cache_module.decisionCache import DecisionCache
+from camera_module.qrToken import QRTokenVerifier, load_public_key
+from journal_module.eventJournal import EventJournal, DEFAULT_EVENT_TOPIC
+from telemetry_module.latencyTrace import Tracer
+from telemetry_module.logPipeline import (LogPipeline, DEFAULT_LEVEL, DEFAULT_CAPTURE_LEVEL, DEFAULT_RING_SIZE,
+                                          DEFAULT_RATE_LIMIT, DEFAULT_SHIP_INTERVAL)
+from telemetry_module.startupTimeline import StartupTimeline
+from telemetry_module.telemetryExport import TelemetryExporter, DEFAULT_EXPORT_INTERVAL
+
 import RPi.GPIO as GPIO
 
 import argparse
 
+# Reader modules (cv2, picamera2, pn532pi, serial) are imported on startup, only for the readers in the topology
 
-DEFAULT_RESPONSE_TIMEOUT_NS = 5 * 1000000000
-RELAY_PIN = 12
 
-GPIO.setwarnings(False)
-GPIO.setmode(GPIO.BCM)
-GPIO.setup(RELAY_PIN, GPIO.OUT)
+RELAY_PIN = 12
+DEVICE_TELEMETRY_ID = "device"  # telemetry source of the stages shared by all doors (MQTT publish, broker round trip)
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.DEBUG)
 
-def createJSONRequest(type, data):
-    if type == "fingerprint":
-        data = base64.b64encode(data).decode("ascii")
 
-    request = {"type" : type,
-               "data" : data}
-    
-    json_request = json.dumps(request)
+def select_qr_settings(secrets: dict) -> tuple:
+    """(decoder name, lores size): the fastest reliable decoder engine and the smallest lores resolution that still decodes our printed codes."""
+    from camera_module.qrDecoders import select_decoder
+    from camera_module.qrRead import load_calibration_frames, benchmark_lores_sizes, DEFAULT_LORES_SIZE
+
+    lores_size = DEFAULT_LORES_SIZE
+    calibration_frames = None
+    if secrets.get('QR_CALIBRATION_DIR'):
+        calibration_frames = load_calibration_frames(secrets['QR_CALIBRATION_DIR'])
+    decoder = select_decoder(calibration_frames)
+    logger.info(f"Selected QR decoder {decoder.name}")
+    if calibration_frames:
+        lores_size, results = benchmark_lores_sizes(calibration_frames, decoder=decoder)
+        for size, (rate, elapsed_ms) in results.items():
+            logger.debug(f"Lores {size[0]}x{size[1]}: decode rate {rate:.2f}, {elapsed_ms:.1f} ms/frame")
+        logger.info(f"Selected lores size {lores_size[0]}x{lores_size[1]}")
+    return decoder.name, lores_size
+
+
+def make_camera_factory(secrets: dict, qr_settings, cameras: int):
+    """camera_factory for build_doors, `qr_settings` is the Future of select_qr_settings()."""
+
+    def camera_factory(camera_num):
+        from picamera2 import Picamera2
+        from camera_module.frameGate import FrameGate
+        from camera_module.parallelDecode import ParallelDecoder, DECODE_MODE_SERIAL, DEFAULT_WORKERS
+        from camera_module.qrDecoders import create_decoder
+        from camera_module.qrRead import CameraModule, create_scan_configuration, SCAN_MODE_LORES
+
+        # Opening the camera overlaps with the decoder selection, configuring it needs the lores size
+        picam = Picamera2(camera_num)
+        decoder_name, lores_size = qr_settings.result()
+        decoder = create_decoder(decoder_name)
+        decode_mode = secrets.get('QR_DECODE_MODE') or DECODE_MODE_SERIAL
+        if decode_mode != DECODE_MODE_SERIAL:
+            # The worker budget is split between the cameras instead of multiplied by them
+            workers = max(1, int(secrets.get('QR_DECODE_WORKERS') or DEFAULT_WORKERS) // cameras)
+            decoder = ParallelDecoder(decoder_name, (lores_size[1], lores_size[0]), mode=decode_mode, workers=workers)
+            logger.info(f"Parallel QR decoding on camera {camera_num}: {decoder.name}")
+        picam.configure(create_scan_configuration(picam, lores_size))
+        picam.start()
+        return CameraModule(picam, scan_mode=SCAN_MODE_LORES, gate=FrameGate(), decoder=decoder)
 
-    return json_request
+    return camera_factory
+
+
+async def serve(doors, exporter=None, journal=None, log_shipper=None):
+    # One event loop for every door, each door's orchestrator only handles its own readers
+    tasks = [door.run() for door in doors]
+    if exporter is not None:
+        tasks.append(exporter.run())
+    if journal is not None:
+        tasks.append(journal.run())
+    if log_shipper is not None:
+        tasks.append(log_shipper.run())
+    await asyncio.gather(*tasks)
 
-def decodeJSONDecision(data):
-    parsed_data = json.loads(data)
-    if parsed_data["status"] == "allow":
-        return True
-    elif parsed_data["status"] == "deny":
-        return False
-    else:
-        logger.error(f"Received invalid status value. Received value: {parsed_data["status"]}")
-        return False
 
 if __name__ == "__main__":
+    timeline = StartupTimeline()
+    timeline.since_start("interpreter + imports")
 
     parser = argparse.ArgumentParser(description="Main system loop for IOT System")
 
@@ -63,6 +102,12 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     secrets = dotenv.dotenv_values(args.env_path)
+    # Records are written by a background thread, debug records only end up in the ring (dumped on error / SIGUSR1)
+    logs = LogPipeline(level=secrets.get('LOG_LEVEL') or DEFAULT_LEVEL,
+                       capture_level=secrets.get('LOG_CAPTURE_LEVEL') or DEFAULT_CAPTURE_LEVEL,
+                       ring_size=int(secrets.get('LOG_RING_SIZE') or DEFAULT_RING_SIZE),
+                       rate_limit=int(secrets.get('LOG_RATE_LIMIT') or DEFAULT_RATE_LIMIT),
+                       path=secrets.get('LOG_FILE') or None).install()
     mqtt = mqttClient.MQTTClient()
     
     if secrets:
@@ -75,160 +120,97 @@ if __name__ == "__main__":
                        cafile=secrets['MQTT_CAFILE'],
                        request_topic=secrets['MQTT_REQUEST_TOPIC'],
                        decision_topic=secrets['MQTT_DECISION_TOPIC'])
+            # Failover brokers, raced in order, MQTT_HOST alone when empty
+            if secrets.get('MQTT_BROKERS'):
+                mqtt.setup(brokers=mqttClient.parse_brokers(secrets['MQTT_BROKERS'], int(secrets['MQTT_PORT'])))
         else:
             logger.error(".env file exists but doesn't contain all neccessary entries")
             raise mqttClient.MQTTError("Incorrect .env file contents")
     else:
         logger.warn(".env file doesn't exist, initializing MQTT client with default values")
+
         
-    mqtt.connect()
+    GPIO.setwarnings(False)
+    GPIO.setmode(GPIO.BCM)
 
-    try:
-        rfid = RFIDModule()
-
-        fingerprint = FingerprintModule(port=DEFAULT_PORT, baud=DEFAULT_BAUD, timeout=0)
-        picam = Picamera2()
-        config = picam.create_video_configuration(
-            main={"size": (1200, 1800), "format": "RGB888"}, buffer_count=2,
-            controls={"FrameRate": 5.0}
-        )
-        picam.configure(config)
-        picam.start()
-        scanner = CameraModule(picam)
+    # MQTT publish and broker round trip histograms shared by all doors, every door traces its own attempts
+    tracer = Tracer()
+    mqtt.tracer = tracer
 
-        # First start of modules
-        fingerprint.new_scan()
-        scanner.start_background_scan()
+    if secrets.get('DOOR_TOPOLOGY'):
+        topology = load_topology(secrets['DOOR_TOPOLOGY'])
+    else:
+        topology = topology_from_env(secrets, relay_pin=RELAY_PIN)
+    cameras = sum(1 for config in topology if config.camera is not None)
+    readers = sum((config.rfid is not None) + (config.fingerprint is not None) + (config.camera is not None)
+                  for config in topology)
 
-    
-        while True:
-            f_uid = fingerprint.get_eigenvalues()
-            s_uid = scanner.qr_event.wait(0.001)
-            r_uid = rfid.readCard()
-            
-            if r_uid:
-                json_request = createJSONRequest("rfid", r_uid)
-                logger.debug(f"Json request: {json_request}")
-                r_uid = None
-                scanner.stop_scan()
-                fingerprint.stop_scan()
-                
-                if mqtt.sendRequest(json_request):
-                    timeoutStart = time.time_ns()
-                    while time.time_ns() - timeoutStart <= DEFAULT_RESPONSE_TIMEOUT_NS:
-                        msg, timestamp = mqtt.getDecision()
-
-                        logger.debug(f"Current message: {msg}")
-                        logger.debug(f"Current timestamp: {timestamp}")
-
-                        print("...")
-
-                        if not msg or not timestamp:
-                            time.sleep(0.2)
-                            continue 
-
-
-                        if timestamp >= timeoutStart and decodeJSONDecision(msg):
-                            print("allowed")
-                            # GPIO.output(RELAY_PIN, GPIO.HIGH)
-                            time.sleep(5)
-                            # GPIO.output(RELAY_PIN, GPIO.LOW)
-                            break
-                        elif timestamp >= timeoutStart and not decodeJSONDecision(msg):
-                            print("denied")
-                            break
-                        
-                        time.sleep(0.5)
-                else:
-                    print("MQTT ERROR")
-
-                fingerprint.new_scan()
-                scanner.start_background_scan()
-            elif f_uid:
-                json_request = createJSONRequest("fingerprint", f_uid)
-                logger.debug(f"Json request: {json_request}")
-                f_uid = None
-                scanner.stop_scan()
-                fingerprint.stop_scan()
-
-                if mqtt.sendRequest(json_request):
-                    timeoutStart = time.time_ns()
-                    while time.time_ns() - timeoutStart <= DEFAULT_RESPONSE_TIMEOUT_NS:
-                        msg, timestamp = mqtt.getDecision()
-
-                        logger.debug(f"Current message: {msg}")
-                        logger.debug(f"Current timestamp: {timestamp}")
-                    
-                        print("...")
-
-                        if not msg or not timestamp:
-                            time.sleep(0.2)
-                            continue
-                        
-                        if timestamp >= timeoutStart and decodeJSONDecision(msg):
-                            print("allowed")
-                            #GPIO.output(RELAY_PIN, GPIO.HIGH)
-                            time.sleep(5)
-                            #GPIO.output(RELAY_PIN, GPIO.LOW)
-                            break
-                        elif timestamp >= timeoutStart and not decodeJSONDecision(msg):
-                            print("denied")
-                            break
-                    
-                        time.sleep(0.5)
-                else:
-                    print("MQTT ERROR")
-
-                # Start scanning for new fingerprint eigenvalues
-                fingerprint.new_scan()
-                scanner.start_background_scan()
-            elif s_uid:
-                json_request = createJSONRequest("qr", scanner.qr_result)
-                logger.debug(f"Json request: {json_request}")
-                s_uid = None
-                fingerprint.stop_scan()
-                scanner.stop_scan()
-
-                if mqtt.sendRequest(json_request):
-                    timeoutStart = time.time_ns()
-                    while time.time_ns() - timeoutStart <= DEFAULT_RESPONSE_TIMEOUT_NS:
-                        msg, timestamp = mqtt.getDecision()
-
-                        logger.debug(f"Current message: {msg}")
-                        logger.debug(f"Current timestamp: {timestamp}")
-                    
-                        print("...")
-
-                        if not msg or not timestamp:
-                            time.sleep(0.2)
-                            continue
-                        
-                        if timestamp >= timeoutStart and decodeJSONDecision(msg):
-                            print("allowed")
-                            #GPIO.output(RELAY_PIN, GPIO.HIGH)
-                            time.sleep(5)
-                            #GPIO.output(RELAY_PIN, GPIO.LOW)
-                            break
-                        elif timestamp >= timeoutStart and not decodeJSONDecision(msg):
-                            print("denied")
-                            break
-                    
-                        time.sleep(0.5)
-                else:
-                    print("MQTT ERROR")
-
-                scanner.start_background_scan()
-                fingerprint.new_scan()
-
-            time.sleep(0.001)
+    doors = []
+    journal = None
+    try:
+        # Every attempt and decision is kept on disk until the broker acknowledged it
+        if secrets.get('EVENT_JOURNAL_PATH'):
+            journal = EventJournal(secrets['EVENT_JOURNAL_PATH'], mqtt=mqtt,
+                                   topic=secrets.get('EVENT_TOPIC') or DEFAULT_EVENT_TOPIC)
+
+        cache_factory = None
+        if secrets.get('CACHE_SYNC_KEY'):
+            cache_factory = lambda door_id: DecisionCache(sync_key=secrets['CACHE_SYNC_KEY'].encode('utf-8'), door_id=door_id)
+
+        # Signed QR tokens are checked on the device, only plausible codes reach the broker
+        qr_verifier_factory = None
+        if secrets.get('QR_TOKEN_KEY') or secrets.get('QR_TOKEN_PUBLIC_KEY'):
+            hmac_keys = [secrets['QR_TOKEN_KEY'].encode('utf-8')] if secrets.get('QR_TOKEN_KEY') else []
+            public_keys = [load_public_key(secrets['QR_TOKEN_PUBLIC_KEY'])] if secrets.get('QR_TOKEN_PUBLIC_KEY') else []
+            allow_unsigned = (secrets.get('QR_ALLOW_UNSIGNED') or '').lower() in ('1', 'true', 'yes')
+            qr_verifier_factory = lambda door_id: QRTokenVerifier(door_id, hmac_keys=hmac_keys, public_keys=public_keys,
+                                                                  allow_unsigned=allow_unsigned)
+
+        # Broker connection, QR decoder selection and every reader's init (PN532 probe, serial open,
+        # camera configure / start) run at the same time, a camera waits for the decoder selection only
+        with ThreadPoolExecutor(max_workers=readers + 2, thread_name_prefix="startup") as startup:
+            connected = startup.submit(timeline.timed("mqtt connect", mqtt.connect))
+            qr_settings = None
+            if cameras:
+                qr_settings = startup.submit(timeline.timed("qr decoder selection", select_qr_settings, secrets))
+            # Relay pulses run on the event loop timers, the readers keep working while the door is open
+            doors = build_doors(topology, mqtt, camera_factory=make_camera_factory(secrets, qr_settings, cameras),
+                                executor=startup, timeline=timeline, cache_factory=cache_factory,
+                                qr_verifier_factory=qr_verifier_factory,
+                                reader_processes=(secrets.get('READER_PROCESSES') or '').lower() in ('1', 'true', 'yes'),
+                                wire_format=secrets.get('MQTT_WIRE_FORMAT') or WIRE_FORMAT_JSON,
+                                admission_window=float(secrets.get('ADMISSION_WINDOW') or DEFAULT_WINDOW),
+                                admission_max_in_flight=int(secrets.get('ADMISSION_MAX_IN_FLIGHT') or DEFAULT_MAX_IN_FLIGHT),
+                                events=journal)
+            connected.result()
+
+        exporter = None
+        if secrets.get('TELEMETRY_TOPIC') or secrets.get('TELEMETRY_PROM_FILE'):
+            exporter = TelemetryExporter(tracer, mqtt=mqtt,
+                                         topic=secrets.get('TELEMETRY_TOPIC'),
+                                         prometheus_path=secrets.get('TELEMETRY_PROM_FILE'),
+                                         interval=float(secrets.get('TELEMETRY_INTERVAL') or DEFAULT_EXPORT_INTERVAL),
+                                         door_id=DEVICE_TELEMETRY_ID)
+            for door in doors:
+                exporter.addSource(door.door_id, door.tracer, door.stats)
+
+        log_shipper = None
+        if secrets.get('LOG_TOPIC'):
+            log_shipper = logs.attach_mqtt(mqtt, secrets['LOG_TOPIC'],
+                                           interval=float(secrets.get('LOG_SHIP_INTERVAL') or DEFAULT_SHIP_INTERVAL))
+
+        logger.info(timeline.report())
+        # Readers are started by the orchestrators and only wake them up when they have data
+        asyncio.run(serve(doors, exporter, journal, log_shipper))
 
     except Exception:
-        fingerprint.stop_scan()
-        scanner.stop_scan()
-        scanner.cleanup()
+        logger.exception("Door loop stopped")
 
     finally:
-        fingerprint.stop_scan()
-        scanner.stop_scan()
-        scanner.cleanup()
+        for door in doors:
+            door.close()
+        if journal is not None:
+            journal.close()
+        mqtt.disconnect()
         logger.debug("Everything closed gracefully :)")
+        logs.close()
@@ -1,7 +1,16 @@
 import paho.mqtt.client as mqtt
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
 import time
 import logging
+import random
 import ssl
+import json
+import threading
+import uuid
+from concurrent.futures import Future
+
+from mqtt_module.wireFormat import BINARY_CONTENT_TYPE, BINARY_TOPIC_SUFFIX, WireFormatError, decode_decision, is_binary_decision
 
 logger = logging.getLogger(__name__)
 
@@ -14,10 +23,98 @@ DEFAULT_MQTT_PUBLISH_TIMEOUT = 2
 DEFAULT_MQTT_USER = "test"
 DEFAULT_MQTT_PASSWORD = "test"
 DEFAULT_MQTT_CAFILE = "./server.crt"
+DEFAULT_MQTT_RESPONSE_TIMEOUT = 5  # seconds to wait for a correlated decision
+DEFAULT_MQTT_KEEPALIVE = 15  # seconds, also bounds how long a silently dead broker goes unnoticed
+DEFAULT_CONNECT_TIMEOUT = 5  # seconds a connection race waits for a CONNACK
+DEFAULT_RACE_DELAY = 0.25  # seconds before the next broker of the list joins the race
+DEFAULT_RECONNECT_MIN_DELAY = 0.5  # seconds, doubled after every failed race
+DEFAULT_RECONNECT_MAX_DELAY = 30
+
+# Connection states
+STATE_DISCONNECTED = "disconnected"
+STATE_CONNECTING = "connecting"
+STATE_CONNECTED = "connected"
 
 class MQTTError(Exception):
     pass
 
+def parse_brokers(text: str, default_port: int = DEFAULT_MQTT_PORT) -> list:
+    """[(host, port)] from "host1:8883,host2", in order of preference."""
+    brokers = []
+    for entry in text.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        host, _, port = entry.rpartition(":") if ":" in entry else (entry, "", "")
+        brokers.append((host, int(port) if port else default_port))
+    return brokers
+
+
+class TLSSessionCache(ssl.SSLContext):
+    """Client context resuming the last TLS session of each broker, a resumed handshake
+    skips the certificate exchange and verification, the slow part on a Pi Zero."""
+
+    def __init__(self, protocol=ssl.PROTOCOL_TLS_CLIENT):
+        super().__init__()
+        self.sessions = {}  # server hostname -> ssl.SSLSession
+
+    def wrap_socket(self, sock, server_side=False, do_handshake_on_connect=True, suppress_ragged_eofs=True,
+                    server_hostname=None, session=None):
+        if session is None and server_hostname is not None:
+            session = self.sessions.get(server_hostname)
+        return super().wrap_socket(sock, server_side=server_side, do_handshake_on_connect=do_handshake_on_connect,
+                                   suppress_ragged_eofs=suppress_ragged_eofs, server_hostname=server_hostname,
+                                   session=session)
+
+    def remember(self, server_hostname: str, sock) -> bool:
+        """Keep the session of a connected socket, returns whether the socket resumed one."""
+        if not isinstance(sock, ssl.SSLSocket):
+            return False
+        if sock.session is not None:
+            self.sessions[server_hostname] = sock.session
+        return sock.session_reused
+
+
+def create_tls_context(cafile: str) -> TLSSessionCache:
+    # Same settings as tls_set(ca_certs, PROTOCOL_TLSv1_2) + tls_insecure_set(True)
+    context = TLSSessionCache(ssl.PROTOCOL_TLS_CLIENT)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.maximum_version = ssl.TLSVersion.TLSv1_2
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_REQUIRED
+    context.load_verify_locations(cafile=cafile)
+    return context
+
+
+class ConnectionRace:
+    """Connection attempts to the brokers, the first CONNACK wins."""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.clients = []
+        self.started = 0
+        self.failed = 0
+        self.winner = None
+        self.over = False
+
+    def settled(self) -> bool:
+        return self.winner is not None or self.failed == self.started
+
+    def fail(self):
+        with self.cond:
+            self.failed += 1
+            self.cond.notify_all()
+
+
+class PendingRequest:
+    """Request waiting for its correlated decision."""
+
+    def __init__(self, correlation_id: str, future: Future, timer: threading.Timer):
+        self.correlation_id = correlation_id
+        self.future = future
+        self.timer = timer
+        self.sent_ns = time.monotonic_ns()
+
 class MQTTClient:
 
     config = {
@@ -30,7 +127,13 @@ class MQTTClient:
         'decision_topic': None,
         'qos': None,
         'publish_timeout': None,
-
+        'response_timeout': None,
+        'brokers': None,  # [(host, port)] in order of preference, None for just host / port
+        'keepalive': None,
+        'connect_timeout': None,
+        'race_delay': None,
+        'reconnect_min_delay': None,
+        'reconnect_max_delay': None,
     }
 
     def __init__(self, host: str = DEFAULT_MQTT_HOST, 
@@ -41,7 +144,14 @@ class MQTTClient:
                  request_topic: str = DEFAULT_MQTT_REQUEST_TOPIC,
                  decision_topic: str = DEFAULT_MQTT_DECISION_TOPIC,
                  qos: int = DEFAULT_MQTT_QOS,
-                 publish_timeout: int = DEFAULT_MQTT_PUBLISH_TIMEOUT):
+                 publish_timeout: int = DEFAULT_MQTT_PUBLISH_TIMEOUT,
+                 response_timeout: float = DEFAULT_MQTT_RESPONSE_TIMEOUT,
+                 brokers: list = None,
+                 keepalive: int = DEFAULT_MQTT_KEEPALIVE,
+                 connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+                 race_delay: float = DEFAULT_RACE_DELAY,
+                 reconnect_min_delay: float = DEFAULT_RECONNECT_MIN_DELAY,
+                 reconnect_max_delay: float = DEFAULT_RECONNECT_MAX_DELAY):
         self.config['host'] = host
         self.config['port'] = port
         self.config['user'] = user
@@ -51,80 +161,413 @@ class MQTTClient:
         self.config['decision_topic'] = decision_topic
         self.config['qos'] = qos
         self.config['publish_timeout'] = publish_timeout
-        
-        self.mqttc = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        self.config['response_timeout'] = response_timeout
+        self.config['brokers'] = brokers
+        self.config['keepalive'] = keepalive
+        self.config['connect_timeout'] = connect_timeout
+        self.config['race_delay'] = race_delay
+        self.config['reconnect_min_delay'] = reconnect_min_delay
+        self.config['reconnect_max_delay'] = reconnect_max_delay
+
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._subscriptions = {}
+        self._decision_topics = []  # extra decision topics, one per additional door
+        self.msg_payload = False
+        self.msg_timestamp = False
+        self.tracer = None  # optional Tracer receiving publish and broker round trip times
+
+        self.state = STATE_DISCONNECTED
+        self.broker = None  # (host, port) of the current connection
+        self.stats = {"connects": 0, "reconnects": 0, "failed_races": 0, "tls_resumed": 0}
+        self._state_listeners = []
+        self._tls_context = None
+        self._supervisor = None
+        self._connected = threading.Event()
+        self._lost = threading.Event()
+        self._stop = threading.Event()
+
+        self.mqttc = self._create_client()
+
+    @staticmethod
+    def _create_client():
+        # MQTT v5 is needed for response-topic / correlation-data properties. Reconnects are
+        # ours (next broker of the list, jittered backoff), the network thread exits on a drop.
+        return mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, protocol=mqtt.MQTTv5, reconnect_on_failure=False)
 
     def setup(self, **kwargs):
     
         for key, value in kwargs.items():
             if key in self.config.keys():
                 self.config[key] = value
-                NON_SENSITIVE_KEYS = ("host", "port", "user", "request_topic", "decision_topic", "qos", "cafile", "qos", "publish_timeout")
+                NON_SENSITIVE_KEYS = ("host", "port", "user", "request_topic", "decision_topic", "qos", "cafile", "qos", "publish_timeout", "response_timeout",
+                                      "brokers", "keepalive", "connect_timeout", "race_delay", "reconnect_min_delay", "reconnect_max_delay")
                 if key in ("user", "password"):
                     logger.debug(f"MQTT client set config value of key {key} to value [REDACTED]")
                 elif key in NON_SENSITIVE_KEYS:
                     logger.debug(f"MQTT client set config value of key {key} to value {value}")
                 else:
                     logger.debug(f"MQTT client set config value of key {key} to value [REDACTED]")
-        self.mqttc = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        self.mqttc = self._create_client()
 
 
-    def connect(self):
-        self.mqttc.on_connect = self._on_connect
+    def _create_tls_context(self):
+        # Plain MQTT without a CA file
+        return create_tls_context(self.config['cafile']) if self.config['cafile'] else None
 
-        self.mqttc.username_pw_set(self.config['user'], self.config['password'])
-        self.mqttc.tls_set(ca_certs=self.config['cafile'], tls_version=ssl.PROTOCOL_TLSv1_2)
-        self.mqttc.tls_insecure_set(True)
-        self.mqttc.connect(self.config['host'], self.config['port'])
-        
-        self.mqttc.on_message = self._on_message
-        
-        self.mqttc.subscribe(self.config['decision_topic'], self.config['qos'])
+    def connect(self) -> bool:
+        """Start connecting, waits up to connect_timeout for the first connection.
 
-        self.mqttc.loop_start()
+        The client stays connected in the background: after a drop (or when no broker
+        answers now) the brokers are raced again with a jittered, growing backoff.
+        Returns whether the client is connected.
+        """
+        if self._tls_context is None:
+            self._tls_context = self._create_tls_context()
+        if self._supervisor is None:
+            self._stop.clear()
+            self._supervisor = threading.Thread(target=self._supervise, name="mqtt-supervisor", daemon=True)
+            self._supervisor.start()
+        connected = self._connected.wait(self.config['connect_timeout'])
+        if not connected:
+            logger.warning("No MQTT broker reachable yet, connecting in the background")
+        logger.debug("Initialized MQTT client")
+        return connected
 
-        self.msg_payload = False
-        self.msg_timestamp = False
+    def disconnect(self):
+        self._stop.set()
+        self._lost.set()
+        self._connected.clear()
+        try:
+            self.mqttc.disconnect()
+            self.mqttc.loop_stop()
+        except Exception:
+            pass
+        if self._supervisor is not None:
+            self._supervisor.join(self.config['connect_timeout'] + 1)
+            self._supervisor = None
+        self._set_state(STATE_DISCONNECTED)
 
-        logger.debug("Initialized MQTT client")
+    def brokers(self) -> list:
+        return list(self.config['brokers'] or [(self.config['host'], self.config['port'])])
+
+    def addStateListener(self, callback):
+        """callback(state) on every connection state change, called from the network / supervisor thread."""
+        self._state_listeners.append(callback)
+
+    def _set_state(self, state: str):
+        if state == self.state:
+            return
+        self.state = state
+        for callback in list(self._state_listeners):
+            try:
+                callback(state)
+            except Exception:
+                logger.exception("MQTT state listener failed")
+
+    def _supervise(self):
+        delay = self.config['reconnect_min_delay']
+        while not self._stop.is_set():
+            self._set_state(STATE_CONNECTING)
+            self._lost.clear()
+            client = self._race()
+            if client is None:
+                self.stats["failed_races"] += 1
+                self._set_state(STATE_DISCONNECTED)
+                # Jittered, devices that lost the same broker don't all come back at the same moment
+                pause = random.uniform(delay / 2, delay)
+                logger.warning("No MQTT broker reachable, retrying in %.1f s", pause)
+                self._stop.wait(pause)
+                delay = min(delay * 2, self.config['reconnect_max_delay'])
+                continue
+            if self._stop.is_set():
+                client.disconnect()
+                break
+            delay = self.config['reconnect_min_delay']
+            self._lost.wait()
+            if not self._stop.is_set():
+                self.stats["reconnects"] += 1
+                self._stop.wait(random.uniform(0, self.config['reconnect_min_delay']))
 
+    def _race(self):
+        """Connect to the brokers in order, the next one joins when the previous ones failed or
+        didn't answer within race_delay. Returns the winning client or None."""
+        race = ConnectionRace()
+        for index, (host, port) in enumerate(self.brokers()):
+            if index:
+                with race.cond:
+                    race.cond.wait_for(race.settled, timeout=self.config['race_delay'])
+                    if race.winner is not None or self._stop.is_set():
+                        break
+            client = self._create_client()
+            client.user_data_set((race, host, port))
+            client.on_connect = self._on_connect
+            client.on_message = self._on_message
+            client.on_disconnect = self._on_disconnect
+            client.username_pw_set(self.config['user'], self.config['password'])
+            if self._tls_context is not None:
+                client.tls_set_context(self._tls_context)
+            with race.cond:
+                race.clients.append(client)
+                race.started += 1
+            threading.Thread(target=self._attempt, args=(race, client, host, port),
+                             name=f"mqtt-connect-{host}", daemon=True).start()
 
+        with race.cond:
+            race.cond.wait_for(race.settled, timeout=self.config['connect_timeout'])
+            race.over = True  # late CONNACKs lose
+            winner = race.winner
+        for client in race.clients:
+            if client is not winner:
+                try:
+                    client.disconnect()
+                except Exception:
+                    pass
+        return winner
+
+    def _attempt(self, race: ConnectionRace, client: mqtt.Client, host: str, port: int):
+        try:
+            # TCP connect, TLS handshake (resumed when the broker still knows our session) and CONNECT
+            client.connect(host, port, keepalive=self.config['keepalive'])
+        except (OSError, ValueError) as e:
+            logger.warning("MQTT broker %s:%d unreachable: %s", host, port, e)
+            race.fail()
+            return
+        client.loop_start()
 
     def _on_connect(self, client: mqtt.Client, userdata, flags, reason_code, properties):
+        race, host, port = userdata
         if reason_code.is_failure:
-            logger.error(f"Failed to connect: {reason_code}")
-            raise MQTTError("Failed to connect to host")
-        else:
-            logger.debug("Starting network loop")
-            #self.mqttc.loop_start()
+            logger.error("MQTT broker %s:%d refused the connection: %s", host, port, reason_code)
+            client.disconnect()
+            race.fail()
+            return
+        with race.cond:
+            won = race.winner is None and not race.over
+            if won:
+                race.winner = client
+                race.cond.notify_all()
+        if not won:
+            client.disconnect()
+            return
+
+        self.mqttc = client
+        self.broker = (host, port)
+        # Subscribed on every connect, topics added while connecting (doors opened in parallel) are included
+        client.subscribe(self.config['decision_topic'], self.config['qos'])
+        for topic in list(self._decision_topics):
+            client.subscribe(topic, self.config['qos'])
+        for topic in list(self._subscriptions):
+            client.subscribe(topic, self.config['qos'])
+
+        resumed = self._tls_context is not None and self._tls_context.remember(host, client.socket())
+        if resumed:
+            self.stats["tls_resumed"] += 1
+        self.stats["connects"] += 1
+        logger.info("Connected to MQTT broker %s:%d%s", host, port, " (TLS session resumed)" if resumed else "")
+        self._connected.set()
+        self._set_state(STATE_CONNECTED)
+
+    def _on_disconnect(self, client: mqtt.Client, userdata, flags, reason_code, properties):
+        if client is not self.mqttc or self._stop.is_set():
+            return
+        logger.warning("Lost connection to MQTT broker %s:%d: %s", *self.broker, reason_code)
+        self._connected.clear()
+        self._set_state(STATE_DISCONNECTED)
+        # Requests in flight won't get their decision, the callers fall back at once
+        self._fail_pending("Connection to the broker lost")
+        self._lost.set()
 
+    def _fail_pending(self, reason: str):
+        with self._pending_lock:
+            pending = list(self._pending.values())
+            self._pending.clear()
+        for request in pending:
+            request.timer.cancel()
+            if not request.future.done():
+                request.future.set_exception(MQTTError(f"{reason}, request {request.correlation_id}"))
+
+
+    def addSubscription(self, topic: str, callback):
+        """Subscribe to an extra topic, callback(payload: bytes) is called from the network thread."""
+        self._subscriptions[topic] = callback
+        if self.mqttc.is_connected():
+            self.mqttc.subscribe(topic, self.config['qos'])
+
+    def addDecisionTopic(self, topic: str):
+        """Also wait for decisions on `topic`, for doors with their own request / decision topic pair."""
+        if topic == self.config['decision_topic'] or topic in self._decision_topics:
+            return
+        self._decision_topics.append(topic)
+        if self.mqttc.is_connected():
+            self.mqttc.subscribe(topic, self.config['qos'])
 
     def _on_message(self, client: mqtt.Client, userdata: any, msg: mqtt.MQTTMessage):
-        logger.debug(f"Received message {msg.payload} from topic {msg.topic}")
-        self.msg_payload = msg.payload.decode('ascii').rstrip("\n")
+        for topic, callback in self._subscriptions.items():
+            if mqtt.topic_matches_sub(topic, msg.topic):
+                try:
+                    callback(msg.payload)
+                except Exception:
+                    # paho re-raises callback errors and its network thread would stop with them
+                    logger.exception(f"Subscription callback for topic {msg.topic} failed")
+                return
+
+        logger.debug("Received message %s from topic %s", msg.payload, msg.topic)
+        try:
+            if self._is_binary(msg):
+                # Compact envelope, decoded by the caller
+                payload = bytes(msg.payload)
+            else:
+                payload = msg.payload.decode('ascii').rstrip("\n")
+            correlation_id = self._extract_correlation_id(msg, payload)
+        except ValueError as e:
+            # Anyone can publish on the shared decision topic, a bad message must not stop the network thread
+            logger.warning(f"Ignoring undecodable message on topic {msg.topic}: {e}")
+            return
+        self.msg_payload = payload
         self.msg_timestamp = time.time_ns()
 
+        request = self._pop_pending(correlation_id)
+        if request is None:
+            logger.debug("Decision with unknown correlation id %s ignored", correlation_id)
+            return
 
-    def _publish(self, message: str, topic: str, qos: int, timeout: int):
+        request.timer.cancel()
+        if self.tracer is not None:
+            self.tracer.record("broker_rtt", time.monotonic_ns() - request.sent_ns)
+        if not request.future.done():
+            request.future.set_result(self.msg_payload)
+
+    @staticmethod
+    def _is_binary(msg: mqtt.MQTTMessage) -> bool:
+        content_type = getattr(getattr(msg, "properties", None), "ContentType", None)
+        return content_type == BINARY_CONTENT_TYPE or is_binary_decision(msg.payload)
+
+    @staticmethod
+    def _extract_correlation_id(msg: mqtt.MQTTMessage, payload):
+        properties = getattr(msg, "properties", None)
+        correlation_data = getattr(properties, "CorrelationData", None)
+        if correlation_data:
+            return correlation_data.decode('ascii')
+
+        if isinstance(payload, bytes):
+            try:
+                return decode_decision(payload)[1]
+            except WireFormatError:
+                return None
+
+        # Fallback for responders that echo the id in the JSON body instead of v5 properties
+        try:
+            return json.loads(payload).get("request_id")
+        except (ValueError, AttributeError):
+            return None
+
+    def _pop_pending(self, correlation_id):
+        with self._pending_lock:
+            if correlation_id is not None:
+                return self._pending.pop(correlation_id, None)
+            if len(self._pending) == 1:
+                # Legacy responder without any correlation: only unambiguous with a single request in flight
+                logger.warning("Decision without correlation id matched to the only pending request")
+                return self._pending.popitem()[1]
+        return None
+
+    def _on_response_timeout(self, correlation_id: str):
+        with self._pending_lock:
+            request = self._pending.pop(correlation_id, None)
+        if request and not request.future.done():
+            request.future.set_exception(TimeoutError(f"No decision for request {correlation_id}"))
+
+    def _publish(self, message: str, topic: str, qos: int, timeout: int, properties: Properties = None):
         
+        if not self.isConnected():
+            # Not queued for a later connection, the caller falls back now instead of after `timeout`
+            logger.debug("Not connected, dropped a message to topic %s", topic)
+            return False
+
+        start = time.monotonic_ns()
         try:
-            msg_info  = self.mqttc.publish(topic, message, qos=1)
+            msg_info  = self.mqttc.publish(topic, message, qos=qos, properties=properties)
             msg_info.wait_for_publish(timeout)
         except:
             logger.error(f"Failed to publish to topic {topic}")
             return False
+        if not msg_info.is_published():
+            # wait_for_publish returns quietly when the timeout runs out
+            logger.error(f"Publish to topic {topic} not acknowledged within {timeout} s")
+            return False
 
+        if self.tracer is not None:
+            self.tracer.record("mqtt_publish", time.monotonic_ns() - start)
         return True
-        
 
-    def sendRequest(self, data):
-        
-        if self._publish(data, self.config['request_topic'], self.config['qos'], self.config['publish_timeout']):    
-           return True
-        
-        return False
+    def publish(self, topic: str, message, qos: int = None, content_type: str = None) -> bool:
+        """Publish a message to any topic (e.g. telemetry), blocks until acknowledged or publish_timeout."""
+        if qos is None:
+            qos = self.config['qos']
+        properties = None
+        if content_type is not None:
+            properties = Properties(PacketTypes.PUBLISH)
+            properties.ContentType = content_type
+        return self._publish(message, topic, qos, self.config['publish_timeout'], properties)
+
+    def isConnected(self) -> bool:
+        return self.mqttc.is_connected()
+
+    def getStats(self) -> dict:
+        stats = dict(self.stats)
+        stats["state"] = self.state
+        stats["broker"] = f"{self.broker[0]}:{self.broker[1]}" if self.broker is not None else None
+        return stats
+
+
+    def sendRequest(self, data, correlation_id: str = None, timeout: float = None, content_type: str = None,
+                    request_topic: str = None, decision_topic: str = None) -> Future:
+        """Publish a request and return a Future resolved with the matching decision payload.
+
+        `request_topic` / `decision_topic` override the configured pair, the decision
+        topic has to be subscribed (config or addDecisionTopic).
+
+        With content_type set to the binary envelope type the request goes to the
+        request topic + BINARY_TOPIC_SUFFIX and carries the MQTT v5 content type.
+
+        The future fails with TimeoutError when no decision arrives within `timeout`
+        seconds and with MQTTError when the request could not be published.
+        Any number of requests can be in flight at once.
+        """
+        if correlation_id is None:
+            correlation_id = uuid.uuid4().hex
+        if timeout is None:
+            timeout = self.config['response_timeout']
+
+        future = Future()
+        timer = threading.Timer(timeout, self._on_response_timeout, args=(correlation_id,))
+        timer.daemon = True
+        with self._pending_lock:
+            self._pending[correlation_id] = PendingRequest(correlation_id, future, timer)
+        timer.start()
+
+        properties = Properties(PacketTypes.PUBLISH)
+        properties.ResponseTopic = decision_topic or self.config['decision_topic']
+        properties.CorrelationData = correlation_id.encode('ascii')
+        topic = request_topic or self.config['request_topic']
+        if content_type is not None:
+            properties.ContentType = content_type
+            if content_type == BINARY_CONTENT_TYPE:
+                topic += BINARY_TOPIC_SUFFIX
+
+        if not self._publish(data, topic, self.config['qos'], self.config['publish_timeout'], properties):
+            timer.cancel()
+            with self._pending_lock:
+                self._pending.pop(correlation_id, None)
+            future.set_exception(MQTTError(f"Failed to publish request {correlation_id}"))
+
+        return future
+
+    def pendingRequests(self) -> int:
+        with self._pending_lock:
+            return len(self._pending)
     
     def getDecision(self):
 
         return (self.msg_payload, self.msg_timestamp)
-
@@ -0,0 +1,168 @@
+"""
+wireFormat.py
+
+Versioned compact binary envelope for access requests and decisions, used
+alongside the JSON messages. A binary request is published to the request
+topic with BINARY_TOPIC_SUFFIX appended and the MQTT v5 content type
+BINARY_CONTENT_TYPE, so the backend can subscribe to either format.
+
+Request (network byte order):
+    magic "AR" | version u8 | cred type u8 | flags u8 | door id length u8 | correlation id length u8 | reserved u8
+    | monotonic timestamp ns u64 | credential length u16 | door id | correlation id | credential bytes
+Decision:
+    magic "AD" | version u8 | status u8 | flags u8 | correlation id length u8 | correlation id
+
+Credentials are carried raw: rfid UIDs as bytes (hex string in JSON), QR text as UTF-8,
+fingerprint eigenvalues as bytes (base64 in JSON). 32 character hex correlation ids
+(uuid4().hex) are packed into 16 bytes.
+"""
+import json
+import struct
+import sys
+import time
+import uuid
+
+WIRE_FORMAT_JSON = "json"
+WIRE_FORMAT_BINARY = "binary"
+
+BINARY_CONTENT_TYPE = "application/vnd.door-access.v1"
+BINARY_TOPIC_SUFFIX = "/bin"
+WIRE_VERSION = 1
+
+REQUEST_MAGIC = b"AR"
+DECISION_MAGIC = b"AD"
+_REQUEST_HEADER = struct.Struct("!2sBBBBBxQH")
+_DECISION_HEADER = struct.Struct("!2sBBBB")
+
+CRED_TYPES = {"rfid": 1, "qr": 2, "fingerprint": 3}
+CRED_NAMES = {code: name for name, code in CRED_TYPES.items()}
+
+STATUS_DENY = 0
+STATUS_ALLOW = 1
+STATUS_NAMES = {STATUS_DENY: "deny", STATUS_ALLOW: "allow"}
+
+FLAG_HEX_CORRELATION = 0x01  # correlation id was a hex string packed into bytes
+
+
+class WireFormatError(ValueError):
+    pass
+
+
+def _pack_correlation(correlation_id: str):
+    if len(correlation_id) == 32:
+        try:
+            return bytes.fromhex(correlation_id), FLAG_HEX_CORRELATION
+        except ValueError:
+            pass
+    return correlation_id.encode("utf-8"), 0
+
+
+def _unpack_correlation(raw: bytes, flags: int) -> str:
+    return raw.hex() if flags & FLAG_HEX_CORRELATION else raw.decode("utf-8")
+
+
+def _credential_bytes(cred_type: str, data) -> bytes:
+    if cred_type == "rfid":
+        return bytes.fromhex(data)
+    if isinstance(data, str):
+        return data.encode("utf-8")
+    return bytes(data)
+
+
+def _credential_value(cred_type: str, raw: bytes):
+    if cred_type == "rfid":
+        return raw.hex()
+    if cred_type == "qr":
+        return raw.decode("utf-8")
+    return raw
+
+
+def encode_request(cred_type: str, data, correlation_id: str, door_id: str, timestamp_ns: int = None) -> bytes:
+    if cred_type not in CRED_TYPES:
+        raise WireFormatError(f"Unknown credential type {cred_type}")
+    correlation, flags = _pack_correlation(correlation_id)
+    door = door_id.encode("utf-8")
+    credential = _credential_bytes(cred_type, data)
+    if timestamp_ns is None:
+        timestamp_ns = time.monotonic_ns()
+    header = _REQUEST_HEADER.pack(REQUEST_MAGIC, WIRE_VERSION, CRED_TYPES[cred_type], flags,
+                                  len(door), len(correlation), timestamp_ns, len(credential))
+    return b"".join((header, door, correlation, credential))
+
+
+def decode_request(payload: bytes) -> dict:
+    """Inverse of encode_request, credential values come back as in the JSON request."""
+    try:
+        magic, version, cred_code, flags, door_len, corr_len, timestamp_ns, cred_len = _REQUEST_HEADER.unpack_from(payload)
+    except struct.error as e:
+        raise WireFormatError(f"Truncated request header: {e}")
+    if magic != REQUEST_MAGIC or version != WIRE_VERSION:
+        raise WireFormatError(f"Unsupported request envelope {magic!r} v{version}")
+    if cred_code not in CRED_NAMES:
+        raise WireFormatError(f"Unknown credential type code {cred_code}")
+    offset = _REQUEST_HEADER.size
+    if len(payload) != offset + door_len + corr_len + cred_len:
+        raise WireFormatError("Request length doesn't match its header")
+
+    view = memoryview(payload)
+    door = bytes(view[offset:offset + door_len]).decode("utf-8")
+    offset += door_len
+    correlation = _unpack_correlation(bytes(view[offset:offset + corr_len]), flags)
+    offset += corr_len
+    cred_type = CRED_NAMES[cred_code]
+    return {"type": cred_type,
+            "data": _credential_value(cred_type, bytes(view[offset:offset + cred_len])),
+            "door_id": door,
+            "request_id": correlation,
+            "timestamp_ns": timestamp_ns}
+
+
+def encode_decision(allowed: bool, correlation_id: str) -> bytes:
+    correlation, flags = _pack_correlation(correlation_id)
+    status = STATUS_ALLOW if allowed else STATUS_DENY
+    return _DECISION_HEADER.pack(DECISION_MAGIC, WIRE_VERSION, status, flags, len(correlation)) + correlation
+
+
+def decode_decision(payload: bytes) -> tuple:
+    """(status name, correlation id) of a binary decision."""
+    try:
+        magic, version, status, flags, corr_len = _DECISION_HEADER.unpack_from(payload)
+    except struct.error as e:
+        raise WireFormatError(f"Truncated decision header: {e}")
+    if magic != DECISION_MAGIC or version != WIRE_VERSION:
+        raise WireFormatError(f"Unsupported decision envelope {magic!r} v{version}")
+    if len(payload) != _DECISION_HEADER.size + corr_len:
+        raise WireFormatError("Decision length doesn't match its header")
+    correlation = _unpack_correlation(bytes(payload[_DECISION_HEADER.size:]), flags)
+    return STATUS_NAMES.get(status, "invalid"), correlation
+
+
+def is_binary_decision(payload: bytes) -> bool:
+    return payload[:2] == DECISION_MAGIC
+
+
+if __name__ == "__main__":
+    # Payload size and serialization time of both formats for every credential type
+    from door_module.accessPipeline import createJSONRequest
+
+    samples = {"rfid": "04a2246f2e5d80",
+               "qr": '{"email":"jemail@gmail.com","token":"417e0c4f9b1d4d2aa0c1a2b3c4d5e6f7"}',
+               "fingerprint": bytes(3) + bytes(range(193))}
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    for cred_type, data in samples.items():
+        request_id = uuid.uuid4().hex
+        json_payload = createJSONRequest(cred_type, data, request_id, door_id="main").encode("utf-8")
+        binary_payload = encode_request(cred_type, data, request_id, "main")
+        start = time.perf_counter()
+        for _ in range(rounds):
+            createJSONRequest(cred_type, data, request_id, door_id="main")
+        json_us = (time.perf_counter() - start) * 1e6 / rounds
+        start = time.perf_counter()
+        for _ in range(rounds):
+            encode_request(cred_type, data, request_id, "main")
+        binary_us = (time.perf_counter() - start) * 1e6 / rounds
+        print(f"{cred_type:>11}: json {len(json_payload):4d} B {json_us:5.2f} us, "
+              f"binary {len(binary_payload):4d} B {binary_us:5.2f} us")
+
+    decision = json.dumps({"status": "allow", "request_id": request_id}).encode("utf-8")
+    print(f"   decision: json {len(decision):4d} B, binary {len(encode_decision(True, request_id)):4d} B")
@@ -2,56 +2,200 @@ from pn532pi import Pn532, pn532
 from pn532pi import Pn532I2c
 import binascii
 import logging
+import queue
+import threading
+import time
+from collections import namedtuple
 
 logger = logging.getLogger(__name__)
 
 # Default I2C bus for Raspberry Pi
 DEFAULT_I2C_BUS = 1
 DEFAULT_ENCODING = "hex" # "base64" | "hex"
+DEFAULT_POLL_TIMEOUT_MS = 100  # InListPassiveTarget budget per poll
+DEFAULT_REMOVAL_MISSES = 2  # empty polls in a row before a resting card counts as removed
+DEFAULT_EVENT_QUEUE_SIZE = 8
+DEFAULT_ACTIVATION_RETRIES = 0x10  # PN532 gives up on an empty field by itself instead of waiting forever
+
+CardEvent = namedtuple("CardEvent", ["uid", "detected_ns", "latency_ms"])
 
 class RFIDError(Exception):
     pass
 
+def _format_hex(data):
+    return binascii.hexlify(data).decode('ascii')
+
+def _format_base64(data):
+    return binascii.b2a_base64(data).decode('ascii').rstrip('\n')
+
+FORMATTING = {"hex" : _format_hex,
+              "base64" : _format_base64}
+
 class RFIDModule:
-    
-    def __init__(self, I2C_BUS: int = DEFAULT_I2C_BUS):
-        PN532_I2C = Pn532I2c(1)
+
+    def __init__(self, I2C_BUS: int = DEFAULT_I2C_BUS, irq_pin: int = None):
+        PN532_I2C = Pn532I2c(I2C_BUS)
         self.nfc = Pn532(PN532_I2C)
+        self.irq_pin = irq_pin
 
         self.nfc.begin()
-        
+
         versiondata = self.nfc.getFirmwareVersion()
         if not versiondata:
             logger.warn("Didn't find a PN53x board")
             raise RFIDError(f"No PN53x board detected")
 
-        logger.debug("Found chip PN5 {:#x} Firmware version {:d}.{:d}".format((versiondata >> 24) & 0xFF, 
-            (versiondata >> 16) & 0xFF, 
+        logger.debug("Found chip PN5 {:#x} Firmware version {:d}.{:d}".format((versiondata >> 24) & 0xFF,
+            (versiondata >> 16) & 0xFF,
             (versiondata >> 8) & 0xFF))
-        
+
         self.nfc.SAMConfig()
+        self.nfc.setPassiveActivationRetries(DEFAULT_ACTIVATION_RETRIES)
 
-    def _format_hex(self, data):
-        return binascii.hexlify(data).decode('ascii')
-    
-    def _format_base64(self, data):
-        return binascii.b2a_base64(data).decode('ascii').rstrip('\n')
+        if irq_pin is not None:
+            import RPi.GPIO as GPIO
+            GPIO.setmode(GPIO.BCM)
+            GPIO.setup(irq_pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
 
-    def readCard(self, format: str = DEFAULT_ENCODING):
-        
-        formatting = {"hex" : self._format_hex,
-                      "base64" : self._format_base64}
+    def _format_hex(self, data):
+        return _format_hex(data)
 
-        logger.info("Waiting for an ISO14443A card...")
+    def _format_base64(self, data):
+        return _format_base64(data)
 
-        success, uid = self.nfc.readPassiveTargetID(pn532.PN532_MIFARE_ISO14443A_106KBPS)
+    def readCard(self, format: str = DEFAULT_ENCODING, timeout: int = DEFAULT_POLL_TIMEOUT_MS):
+        """Single bounded poll, returns the formatted UID or False when no card answered within `timeout` ms."""
+        if self.irq_pin is not None:
+            success, uid = self._read_irq(timeout)
+        else:
+            success, uid = self.nfc.readPassiveTargetID(pn532.PN532_MIFARE_ISO14443A_106KBPS, timeout=timeout)
 
         if (success):
-            logger.info("Found an ISO14443A card")
-            logger.debug("UID Length: {:d}".format(len(uid)))
-            logger.debug("UID Value: {}".format(formatting[format](uid)))
-
-            return str(formatting[format](uid))
+            value = FORMATTING[format](uid)
+            logger.debug("Found an ISO14443A card, UID length %d", len(uid))
+            return str(value)
         else:
-            logger.debug("Couldn't find a compatible card")
             return False
+
+    def _read_irq(self, timeout: int):
+        # Sleep on the IRQ line (pulled low by the PN532 when the response is ready) instead of polling I2C
+        import RPi.GPIO as GPIO
+        interface = self.nfc._interface
+        header = bytearray([pn532.PN532_COMMAND_INLISTPASSIVETARGET,
+                            1,  # max 1 card
+                            pn532.PN532_MIFARE_ISO14443A_106KBPS])
+        if interface.writeCommand(header):
+            return False, None
+        if GPIO.wait_for_edge(self.irq_pin, GPIO.FALLING, timeout=timeout) is None:
+            return False, None
+
+        status, response = interface.readResponse(timeout)
+        # b0 tags found, b1 tag number, b2..3 SENS_RES, b4 SEL_RES, b5 NFCID length, b6.. NFCID
+        if status < 0 or response[0] != 1:
+            return False, None
+        return True, bytearray(response[6:6 + response[5]])
+
+
+class RFIDPoller:
+    """Runs bounded RFID polls in its own thread and queues one CardEvent per card presentation.
+
+    A card resting on the reader is reported once; it has to be missing for
+    `removal_misses` polls in a row before the same UID is reported again.
+    """
+
+    def __init__(self, rfid: RFIDModule,
+                 format: str = DEFAULT_ENCODING,
+                 poll_timeout: int = DEFAULT_POLL_TIMEOUT_MS,
+                 removal_misses: int = DEFAULT_REMOVAL_MISSES,
+                 queue_size: int = DEFAULT_EVENT_QUEUE_SIZE):
+        self.rfid = rfid
+        self.format = format
+        self.poll_timeout = poll_timeout
+        self.removal_misses = removal_misses
+        self.events = queue.Queue(maxsize=queue_size)
+        self.on_event = None  # optional callback(CardEvent) called from the poller thread
+        self.tracer = None  # optional Tracer receiving the card-to-event latency
+
+        self._present_uid = None
+        self._misses = 0
+        self._enabled = threading.Event()
+        self._stopped = False
+        self._thread = None
+        self.stats = {"polls": 0, "events": 0, "suppressed": 0, "dropped": 0, "errors": 0,
+                      "last_latency_ms": 0.0, "max_latency_ms": 0.0, "total_latency_ms": 0.0}
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        self.resume()
+
+    def pause(self):
+        # Presence state is kept, so a card left on the reader isn't reported again after resume
+        self._enabled.clear()
+
+    def resume(self):
+        self._enabled.set()
+
+    def stop(self):
+        self._stopped = True
+        self._enabled.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while True:
+            self._enabled.wait()
+            if self._stopped:
+                return
+            poll_start = time.perf_counter_ns()
+            try:
+                uid = self.rfid.readCard(self.format, timeout=self.poll_timeout)
+            except Exception:
+                self.stats["errors"] += 1
+                logger.exception("RFID poll failed")
+                time.sleep(self.poll_timeout / 1000)
+                continue
+            self.stats["polls"] += 1
+            if self._enabled.is_set():
+                self._update(uid, poll_start)
+
+    def _update(self, uid, poll_start: int):
+        if not uid:
+            if self._present_uid is not None:
+                self._misses += 1
+                if self._misses >= self.removal_misses:
+                    logger.debug("Card %s removed", self._present_uid)
+                    self._present_uid = None
+            return
+
+        self._misses = 0
+        if uid == self._present_uid:
+            self.stats["suppressed"] += 1
+            return
+
+        self._present_uid = uid
+        detected = time.perf_counter_ns()
+        # The card answered at some point during this poll, so the poll duration bounds card-to-event latency
+        latency_ms = (detected - poll_start) / 1000000
+        event = CardEvent(uid, detected, latency_ms)
+        self.stats["events"] += 1
+        self.stats["last_latency_ms"] = latency_ms
+        self.stats["max_latency_ms"] = max(self.stats["max_latency_ms"], latency_ms)
+        self.stats["total_latency_ms"] += latency_ms
+        if self.tracer is not None:
+            self.tracer.record("rfid_poll", detected - poll_start)
+
+        if self.on_event is not None:
+            self.on_event(event)
+            return
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            self.stats["dropped"] += 1
+
+    def getStats(self) -> dict:
+        stats = dict(self.stats)
+        stats["mean_latency_ms"] = stats["total_latency_ms"] / stats["events"] if stats["events"] else 0.0
+        return stats
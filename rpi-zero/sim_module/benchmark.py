@@ -0,0 +1,377 @@
+"""
+benchmark.py
+
+Performance benchmark of the full reader -> orchestrator -> pipeline -> MQTT
+path on simulated hardware. Every modality runs in its own process, so the
+memory high-water mark belongs to that modality only. Reported per modality:
+- credential-to-decision latency p50 / p99 (from presenting the credential
+  to the pipeline returning the decision),
+- CPU time per credential (whole process) and, for the camera, per frame
+  (scan worker thread only),
+- bytes routed by the broker (requests, decisions, telemetry),
+- peak RSS and, with --tracemalloc, the peak of Python allocations,
+- the per-stage breakdown recorded by the Tracer (with --json).
+With --doors N the door count is scaled instead (1, 2, 4 .. N doors, each with
+all three readers, credentials presented at every door at once) and the
+decisions per second of every door and the CPU per credential are reported.
+
+Run `python -m sim_module.benchmark` from rpi-zero, `--json` prints machine readable results.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import multiprocessing
+import resource
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+MODALITIES = ("qr", "fingerprint", "rfid")
+
+DEFAULT_COUNT = 20
+DEFAULT_BROKER_LATENCY = 0.02  # seconds
+DEFAULT_GAP = 0.3  # seconds between taking a credential away and presenting the next one
+DEFAULT_DECISION_TIMEOUT = 10.0  # seconds before a presentation counts as lost
+
+
+def percentile(values: list, p: float) -> float:
+    """Nearest-rank percentile."""
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+class RecordingPipeline:
+    """Wraps AccessPipeline and timestamps the first decision for every presentation."""
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self.presented_ns = None
+        self.latencies_ms = []
+        self.decided = asyncio.Event()
+
+    def present(self):
+        self.decided.clear()
+        self.presented_ns = time.monotonic_ns()
+
+    async def handle(self, cred_type: str, data, read_ns: int = None):
+        allowed = await self.pipeline.handle(cred_type, data, read_ns)
+        # Re-reads of a credential that is still presented are coalesced, only the first one counts
+        if self.presented_ns is not None and not self.decided.is_set():
+            self.latencies_ms.append((time.monotonic_ns() - self.presented_ns) / 1000000)
+            self.decided.set()
+        return allowed
+
+
+def _thread_cpu_time(thread) -> float:
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(thread.ident))
+    except (AttributeError, OSError, TypeError):
+        return float("nan")
+
+
+def run_modality(modality: str, count: int, broker_latency: float, gap: float, trace_memory: bool,
+                 wire_format: str = "json") -> dict:
+    """Benchmark one modality, meant to run in a fresh process."""
+    from sim_module.simHardware import install
+    install()
+    # Readers and the pipeline print on every scan / decision, this process only reports through its result
+    sys.stdout = io.StringIO()
+
+    # Imported after install(), the readers pick up the fake hardware
+    from sim_module.fakeBroker import FakeBroker
+    import mqtt_module.mqttClient as mqttClient
+    from door_module.accessPipeline import AccessPipeline
+    from door_module.admissionControl import AdmissionController
+    from door_module.doorController import DoorController
+    from door_module.readerOrchestrator import ReaderOrchestrator
+    from telemetry_module.latencyTrace import Tracer
+
+    if trace_memory:
+        tracemalloc.start()
+
+    tracer = Tracer()
+    broker = FakeBroker(latency=broker_latency)
+    mqtt = broker.install(mqttClient.MQTTClient())
+    mqtt.tracer = tracer
+    mqtt.connect()
+
+    readers = {}
+    if modality == "qr":
+        from camera_module.frameGate import FrameGate
+        from camera_module.qrDecoders import select_decoder
+        from camera_module.qrRead import CameraModule, create_scan_configuration, DEFAULT_LORES_SIZE, SCAN_MODE_LORES
+        from sim_module.fakeCamera import FakePicamera2, QRFrameSource
+
+        source = QRFrameSource()
+        picam = FakePicamera2(source=source)
+        picam.configure(create_scan_configuration(picam, DEFAULT_LORES_SIZE))
+        picam.start()
+        reader = CameraModule(picam, scan_mode=SCAN_MODE_LORES, gate=FrameGate(), decoder=select_decoder())
+        readers["scanner"] = reader
+        present = lambda i: source.show(f"sim-qr-{i:06d}")
+        withdraw = source.clear
+    elif modality == "fingerprint":
+        from fingerprint_module.fingerprintRead import FingerprintModule
+        from sim_module.fakeFingerprint import FakeFingerprintSensor, make_template
+
+        sensor = FakeFingerprintSensor()
+        reader = FingerprintModule(port=sensor.port, baud=19200, timeout=0)
+        readers["fingerprint"] = reader
+        present = lambda i: sensor.press(make_template(i))
+        withdraw = lambda: None
+    else:
+        from rfid_module.cardRead import RFIDModule
+        from sim_module.fakePn532 import default_field
+
+        reader = RFIDModule()
+        readers["rfid"] = reader
+        present = lambda i: default_field.place(bytes([0x04, (i >> 8) & 0xFF, i & 0xFF, 0xA5]))
+        withdraw = default_field.remove
+
+    reader.tracer = tracer
+    # fingerprintRead configures DEBUG logging on import, keep the reader logs out of the measurements
+    logging.getLogger().setLevel(logging.WARNING)
+
+    async def session():
+        pipeline = RecordingPipeline(AccessPipeline(mqtt, door=DoorController(), admission=AdmissionController(),
+                                                    tracer=tracer, wire_format=wire_format))
+        orchestrator = ReaderOrchestrator(pipeline, tracer=tracer, concurrent=True, **readers)
+        task = asyncio.create_task(orchestrator.run())
+        lost = 0
+        await asyncio.sleep(gap)
+
+        cpu_start = time.process_time()
+        for i in range(count):
+            pipeline.present()
+            present(i)
+            try:
+                await asyncio.wait_for(pipeline.decided.wait(), DEFAULT_DECISION_TIMEOUT)
+            except asyncio.TimeoutError:
+                lost += 1
+            withdraw()
+            await asyncio.sleep(gap)
+        cpu = time.process_time() - cpu_start
+
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+        return pipeline.latencies_ms, lost, cpu
+
+    latencies, lost, cpu = asyncio.run(session())
+    if modality == "qr":
+        frames = reader.stats["frames"]
+        frame_cpu = _thread_cpu_time(reader._thread)
+        reader.cleanup()
+
+    result = {
+        "modality": modality,
+        "wire_format": wire_format,
+        "credentials": count,
+        "lost": lost,
+        "p50_ms": percentile(latencies, 50),
+        "p99_ms": percentile(latencies, 99),
+        "max_ms": max(latencies) if latencies else float("nan"),
+        "cpu_ms_per_credential": cpu * 1000 / count,
+        "broker_bytes": broker.stats["bytes"],
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        # Per-stage breakdown from the Tracer, microseconds
+        "stages": {name: {"p50_us": stats["quantiles"][0.5], "p99_us": stats["quantiles"][0.99]}
+                   for name, stats in tracer.snapshot().items() if stats["count"]},
+    }
+    if modality == "qr":
+        result["frames"] = frames
+        result["cpu_ms_per_frame"] = frame_cpu * 1000 / max(frames, 1)
+    if trace_memory:
+        result["peak_traced_kb"] = tracemalloc.get_traced_memory()[1] // 1024
+        tracemalloc.stop()
+    return result
+
+
+def run_doors(doors: int, count: int, broker_latency: float, gap: float, wire_format: str = "json") -> dict:
+    """`doors` doors with all three readers in one process, credentials presented at every door at once."""
+    from sim_module.simHardware import install
+    install()
+    sys.stdout = io.StringIO()
+
+    from sim_module.fakeBroker import FakeBroker
+    import mqtt_module.mqttClient as mqttClient
+    from camera_module.frameGate import FrameGate
+    from camera_module.qrDecoders import select_decoder
+    from camera_module.qrRead import CameraModule, create_scan_configuration, DEFAULT_LORES_SIZE, SCAN_MODE_LORES
+    from concurrent.futures import ThreadPoolExecutor
+    from door_module.doorTopology import DoorConfig, build_doors
+    from sim_module.fakeCamera import FakePicamera2, source_for
+    from sim_module.fakeFingerprint import FakeFingerprintSensor, make_template
+    from sim_module.fakePn532 import field_for
+    from telemetry_module.latencyTrace import Tracer
+    from telemetry_module.startupTimeline import StartupTimeline
+
+    timeline = StartupTimeline()
+    timeline.since_start("interpreter + imports")
+    broker = FakeBroker(latency=broker_latency)
+    mqtt = broker.install(mqttClient.MQTTClient())
+    mqtt.tracer = Tracer()
+
+    def camera_factory(camera_num):
+        picam = FakePicamera2(camera_num)
+        picam.configure(create_scan_configuration(picam, DEFAULT_LORES_SIZE))
+        picam.start()
+        return CameraModule(picam, scan_mode=SCAN_MODE_LORES, gate=FrameGate(), decoder=select_decoder())
+
+    sensors = [FakeFingerprintSensor() for _ in range(doors)]
+    # Sim GPIO numbers, far apart so relay and reset lines never collide
+    topology = [DoorConfig(f"door{i}", relay_pin=100 + i, rfid={"i2c_bus": i + 1},
+                           fingerprint={"port": sensors[i].port, "baud": 19200, "reset_pin": 200 + i},
+                           camera={"camera_num": i})
+                for i in range(doors)]
+    # Same startup as main.py: broker connection and every reader opened at once
+    with ThreadPoolExecutor(max_workers=3 * doors + 1, thread_name_prefix="startup") as startup:
+        connected = startup.submit(timeline.timed("mqtt connect", mqtt.connect))
+        built = build_doors(topology, mqtt, camera_factory=camera_factory, executor=startup, timeline=timeline,
+                            wire_format=wire_format)
+        connected.result()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    def presenter(i: int, j: int):
+        modality = MODALITIES[j % len(MODALITIES)]
+        if modality == "qr":
+            return lambda: source_for(i).show(f"sim-qr-{i:02d}-{j:06d}"), source_for(i).clear
+        if modality == "fingerprint":
+            return lambda: sensors[i].press(make_template(i * 100000 + j)), lambda: None
+        field = field_for(i + 1)
+        return lambda: field.place(bytes([0x04, i & 0xFF, (j >> 8) & 0xFF, j & 0xFF])), field.remove
+
+    async def drive(i: int, pipeline: RecordingPipeline):
+        lost = 0
+        await asyncio.sleep(gap)
+        for j in range(count):
+            present, withdraw = presenter(i, j)
+            pipeline.present()
+            present()
+            try:
+                await asyncio.wait_for(pipeline.decided.wait(), DEFAULT_DECISION_TIMEOUT)
+            except asyncio.TimeoutError:
+                lost += 1
+            withdraw()
+            await asyncio.sleep(gap)
+        return lost
+
+    async def session():
+        pipelines = []
+        for door in built:
+            pipeline = RecordingPipeline(door.pipeline)
+            door.orchestrator.pipeline = pipeline
+            pipelines.append(pipeline)
+        tasks = [asyncio.create_task(door.run()) for door in built]
+        wall_start = time.monotonic()
+        cpu_start = time.process_time()
+        lost = await asyncio.gather(*(drive(i, pipeline) for i, pipeline in enumerate(pipelines)))
+        cpu = time.process_time() - cpu_start
+        wall = time.monotonic() - wall_start
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return pipelines, lost, cpu, wall
+
+    pipelines, lost, cpu, wall = asyncio.run(session())
+    per_door = [{"door": door.door_id,
+                 "lost": lost[i],
+                 "p50_ms": percentile(pipelines[i].latencies_ms, 50),
+                 "p99_ms": percentile(pipelines[i].latencies_ms, 99),
+                 "decisions_per_s": len(pipelines[i].latencies_ms) / wall}
+                for i, door in enumerate(built)]
+    for door in built:
+        door.close()
+    for sensor in sensors:
+        sensor.close()
+    return {"doors": doors,
+            "credentials": count * doors,
+            "cpu_ms_per_credential": cpu * 1000 / (count * doors),
+            "cpu_percent": cpu * 100 / wall,
+            "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "startup_ms": timeline.total() * 1000,
+            "startup": timeline.report(),
+            "per_door": per_door}
+
+
+def run_scaling(max_doors: int, count: int = DEFAULT_COUNT, broker_latency: float = DEFAULT_BROKER_LATENCY,
+                gap: float = DEFAULT_GAP, wire_format: str = "json") -> list:
+    """run_doors for 1, 2, 4, ... up to max_doors doors, every topology in a fresh process."""
+    sizes = sorted({min(1 << k, max_doors) for k in range(max_doors.bit_length() + 1)})
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for doors in sizes:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            results.append(pool.submit(run_doors, doors, count, broker_latency, gap, wire_format).result())
+    return results
+
+
+def run(modalities=MODALITIES, count: int = DEFAULT_COUNT, broker_latency: float = DEFAULT_BROKER_LATENCY,
+        gap: float = DEFAULT_GAP, trace_memory: bool = False, wire_format: str = "json") -> list:
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for modality in modalities:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            results.append(pool.submit(run_modality, modality, count, broker_latency, gap, trace_memory,
+                                       wire_format).result())
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Credential-to-decision benchmark on simulated hardware")
+    parser.add_argument("--modality", choices=MODALITIES, action="append",
+                        help="Modality to benchmark, can be repeated (default: all)")
+    parser.add_argument("--count", type=int, default=DEFAULT_COUNT, help=f"Credentials per modality (default: {DEFAULT_COUNT})")
+    parser.add_argument("--latency", type=float, default=DEFAULT_BROKER_LATENCY * 1000,
+                        help=f"Broker decision latency in ms (default: {DEFAULT_BROKER_LATENCY * 1000:.0f})")
+    parser.add_argument("--gap", type=float, default=DEFAULT_GAP, help=f"Seconds between credentials (default: {DEFAULT_GAP})")
+    parser.add_argument("--wire-format", choices=("json", "binary"), default="json",
+                        help="Request / decision encoding (default: json)")
+    parser.add_argument("--tracemalloc", action="store_true", help="Also report the peak of Python allocations")
+    parser.add_argument("--doors", type=int, default=0,
+                        help="Scale the door count up to this many doors (all readers per door) instead of the per modality run")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.doors:
+        results = run_scaling(args.doors, args.count, args.latency / 1000, args.gap, args.wire_format)
+        if args.json:
+            json.dump(results, sys.stdout, indent=2)
+            print()
+        else:
+            for r in results:
+                logger.info(f"{r['doors']:2d} doors: cpu {r['cpu_ms_per_credential']:6.1f} ms/credential, "
+                            f"{r['cpu_percent']:5.1f} % cpu, peak rss {r['peak_rss_kb'] / 1024:6.1f} MiB")
+                for d in r["per_door"]:
+                    line = (f"    {d['door']}: {d['decisions_per_s']:5.2f} decisions/s, "
+                            f"p50 {d['p50_ms']:7.1f} ms, p99 {d['p99_ms']:7.1f} ms")
+                    if d["lost"]:
+                        line += f", {d['lost']} lost"
+                    logger.info(line)
+        sys.exit(0)
+    results = run(args.modality or MODALITIES, args.count, args.latency / 1000, args.gap, args.tracemalloc, args.wire_format)
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        for r in results:
+            line = (f"{r['modality']:>11}: p50 {r['p50_ms']:7.1f} ms, p99 {r['p99_ms']:7.1f} ms, "
+                    f"cpu {r['cpu_ms_per_credential']:6.1f} ms/credential, broker {r['broker_bytes']} B, peak rss {r['peak_rss_kb'] / 1024:6.1f} MiB")
+            if "cpu_ms_per_frame" in r:
+                line += f", cpu {r['cpu_ms_per_frame']:.2f} ms/frame ({r['frames']} frames)"
+            if "peak_traced_kb" in r:
+                line += f", peak traced {r['peak_traced_kb'] / 1024:.1f} MiB"
+            if r["lost"]:
+                line += f", {r['lost']} lost"
+            logger.info(line)
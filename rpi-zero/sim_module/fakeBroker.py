@@ -0,0 +1,261 @@
+"""
+fakeBroker.py
+
+In-process stand-in for the MQTT broker and the access service behind it.
+FakeBroker.client() returns an object with the subset of the paho Client API
+used by MQTTClient, messages are routed between clients with topic filters.
+The built-in responder answers every request published to `request_topic`
+on its ResponseTopic (with the same CorrelationData) after `latency` seconds,
+binary envelope requests (request_topic + BINARY_TOPIC_SUFFIX) get binary decisions.
+With decide=None the responder is off and requests are left to other subscribers,
+e.g. AccessBridge instances on a shared ($share/<group>/...) subscription, where
+every message goes to one member of the group.
+"""
+import json
+import logging
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
+
+from mqtt_module.wireFormat import (BINARY_CONTENT_TYPE, BINARY_TOPIC_SUFFIX, WireFormatError,
+                                    decode_request, encode_decision)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REQUEST_TOPIC = "access/door/+/request"
+DEFAULT_LATENCY = 0.02  # seconds between a request and its decision
+DEFAULT_PUBLISH_LATENCY = 0.001  # seconds until a publish counts as acknowledged
+
+
+def split_shared(subscription: str) -> tuple:
+    """(group, topic filter) of a $share/<group>/<filter> subscription, group is None for plain ones."""
+    if subscription.startswith("$share/"):
+        _, group, topic_filter = subscription.split("/", 2)
+        return group, topic_filter
+    return None, subscription
+
+
+def allow_all(request: dict) -> str:
+    return "allow"
+
+
+class FakeMessage:
+
+    def __init__(self, topic: str, payload: bytes, qos: int = 0, properties: Properties = None):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.properties = properties
+        self.timestamp = time.monotonic()
+
+
+class FakeMessageInfo:
+
+    def __init__(self, mid: int):
+        self.mid = mid
+        self.rc = mqtt.MQTT_ERR_SUCCESS
+        self._published = threading.Event()
+
+    def wait_for_publish(self, timeout: float = None):
+        if not self._published.wait(timeout):
+            raise RuntimeError("Publish not acknowledged in time")
+
+    def is_published(self) -> bool:
+        return self._published.is_set()
+
+
+class FakeClient:
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.on_connect = None
+        self.on_message = None
+        self.on_disconnect = None
+        self.subscriptions = {}
+        self.userdata = None
+        self._connected = False
+        self._mid = 0
+
+    def username_pw_set(self, username, password=None):
+        pass
+
+    def tls_set(self, *args, **kwargs):
+        pass
+
+    def tls_insecure_set(self, value):
+        pass
+
+    def tls_set_context(self, context=None):
+        pass
+
+    def user_data_set(self, userdata):
+        self.userdata = userdata
+
+    def socket(self):
+        return None
+
+    def connect(self, host, port=1883, keepalive=60, **kwargs):
+        self._connected = True
+        self.broker.attach(self)
+        if self.on_connect is not None:
+            self.on_connect(self, self.userdata, {}, mqtt.ReasonCode(PacketTypes.CONNACK, "Success"), None)
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def disconnect(self, *args, **kwargs):
+        was_connected = self._connected
+        self._connected = False
+        self.broker.detach(self)
+        if was_connected and self.on_disconnect is not None:
+            self.on_disconnect(self, self.userdata, {}, mqtt.ReasonCode(PacketTypes.DISCONNECT, "Normal disconnection"), None)
+
+    def is_connected(self) -> bool:
+        return self._connected
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+    def subscribe(self, topic, qos=0, **kwargs):
+        self.subscriptions[topic] = qos
+        return mqtt.MQTT_ERR_SUCCESS, 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        self._mid += 1
+        info = FakeMessageInfo(self._mid)
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        self.broker.route(FakeMessage(topic, payload, qos, properties), info)
+        return info
+
+    def deliver(self, message: FakeMessage):
+        if self.on_message is not None:
+            self.on_message(self, None, message)
+
+
+class FakeBroker:
+
+    def __init__(self, latency: float = DEFAULT_LATENCY, decide=allow_all,
+                 request_topic: str = DEFAULT_REQUEST_TOPIC,
+                 publish_latency: float = DEFAULT_PUBLISH_LATENCY):
+        self.latency = latency
+        self.decide = decide  # callable(request dict) -> "allow" / "deny" / None (unanswered), None disables the responder
+        self.request_topic = request_topic
+        self.publish_latency = publish_latency
+        self.clients = []
+        self.stats = {"published": 0, "delivered": 0, "requests": 0, "decisions": 0, "bytes": 0}
+        self._share_turns = {}
+        self._lock = threading.Lock()
+
+    def client(self) -> FakeClient:
+        return FakeClient(self)
+
+    def install(self, mqtt_client):
+        """Point an MQTTClient at this broker. Call after MQTTClient.setup(), which recreates the client."""
+        mqtt_client.mqttc = self.client()
+        # Every connection attempt (and reconnect) gets a fake client as well, without TLS
+        mqtt_client._create_client = self.client
+        mqtt_client._create_tls_context = lambda: None
+        return mqtt_client
+
+    def restart(self):
+        """Drop every client connection, like a broker restart."""
+        with self._lock:
+            clients = list(self.clients)
+        for client in clients:
+            client.disconnect()
+
+    def attach(self, client: FakeClient):
+        with self._lock:
+            if client not in self.clients:
+                self.clients.append(client)
+
+    def detach(self, client: FakeClient):
+        with self._lock:
+            if client in self.clients:
+                self.clients.remove(client)
+
+    def route(self, message: FakeMessage, info: FakeMessageInfo):
+        self.stats["published"] += 1
+        self.stats["bytes"] += len(message.payload or b"")
+        self._later(self.publish_latency, info._published.set)
+
+        if self.decide is not None and (mqtt.topic_matches_sub(self.request_topic, message.topic)
+                or mqtt.topic_matches_sub(self.request_topic + BINARY_TOPIC_SUFFIX, message.topic)):
+            self.stats["requests"] += 1
+            self._later(self.latency, self._respond, message)
+
+        for client in self._receivers(message.topic):
+            self.stats["delivered"] += 1
+            self._later(self.publish_latency, client.deliver, message)
+
+    def _receivers(self, topic: str) -> list:
+        """Clients a message on `topic` goes to: every plain subscriber and one member of every shared group."""
+        receivers = []
+        groups = {}
+        with self._lock:
+            for client in self.clients:
+                plain = False
+                for sub in client.subscriptions:
+                    group, topic_filter = split_shared(sub)
+                    if not mqtt.topic_matches_sub(topic_filter, topic):
+                        continue
+                    if group is None:
+                        plain = True
+                    elif client not in groups.setdefault(group, []):
+                        groups[group].append(client)
+                if plain:
+                    receivers.append(client)
+            for group, members in groups.items():
+                # Round robin between the members, like the common brokers do
+                turn = self._share_turns.get(group, 0)
+                self._share_turns[group] = turn + 1
+                member = members[turn % len(members)]
+                if member not in receivers:
+                    receivers.append(member)
+        return receivers
+
+    def _respond(self, request: FakeMessage):
+        properties = getattr(request, "properties", None)
+        binary = getattr(properties, "ContentType", None) == BINARY_CONTENT_TYPE
+        try:
+            body = decode_request(request.payload) if binary else json.loads(request.payload)
+        except (ValueError, WireFormatError):
+            logger.warning(f"Fake broker got a request it can't parse: {request.payload!r}")
+            return
+        status = self.decide(body)
+        if status is None:
+            return
+
+        response_topic = getattr(properties, "ResponseTopic", None)
+        if not response_topic:
+            logger.warning("Request without ResponseTopic left unanswered")
+            return
+        response = Properties(PacketTypes.PUBLISH)
+        correlation = getattr(properties, "CorrelationData", None)
+        if correlation:
+            response.CorrelationData = correlation
+
+        if binary:
+            response.ContentType = BINARY_CONTENT_TYPE
+            payload = encode_decision(status == "allow", body["request_id"])
+        else:
+            decision = {"status": status}
+            if "request_id" in body:
+                decision["request_id"] = body["request_id"]
+            payload = json.dumps(decision).encode("utf-8")
+        self.stats["decisions"] += 1
+        self.route(FakeMessage(response_topic, payload, 1, response), FakeMessageInfo(0))
+
+    @staticmethod
+    def _later(delay: float, callback, *args):
+        if delay <= 0:
+            callback(*args)
+            return
+        timer = threading.Timer(delay, callback, args=args)
+        timer.daemon = True
+        timer.start()
@@ -0,0 +1,236 @@
+"""
+fakeCamera.py
+
+Stand-in for picamera2 (Picamera2 and MappedArray) replaying QR frames at a set frame rate.
+Frames come from a frame source:
+- QRFrameSource renders synthetic codes on demand (show(text) / clear()),
+- RecordedFrameSource cycles through recorded grayscale frames.
+Only the parts of the API used by CameraModule are implemented.
+"""
+import threading
+import time
+
+import cv2
+import numpy as np
+
+DEFAULT_SIM_FRAME_RATE = 30.0
+DEFAULT_BACKGROUND = 128
+DEFAULT_NOISE = 4  # amplitude of the sensor noise added to every frame
+DEFAULT_CODE_FRACTION = 0.5  # code size relative to the shorter frame side
+NOISE_FRAMES = 4  # pre-rendered noise patterns, so rendering adds little CPU to the measurements
+
+
+class QRFrameSource:
+    """Synthetic scene: flat background with sensor noise and, while shown, one QR code."""
+
+    def __init__(self, background: int = DEFAULT_BACKGROUND, noise: int = DEFAULT_NOISE,
+                 code_fraction: float = DEFAULT_CODE_FRACTION):
+        self.background = background
+        self.noise = noise
+        self.code_fraction = code_fraction
+        self.shown_ns = None  # monotonic time the current code appeared
+        self._code = None
+        self._scaled = {}  # side -> code scaled for the current text
+        self._backgrounds = {}  # (height, width) -> noise patterns
+        self._frame_index = 0
+        self._lock = threading.Lock()
+        self._encoder = cv2.QRCodeEncoder.create()
+        self._rng = np.random.default_rng(0)
+
+    def show(self, text: str):
+        code = self._encoder.encode(text)
+        # Quiet zone around the modules, like a printed code
+        code = cv2.copyMakeBorder(code, 4, 4, 4, 4, cv2.BORDER_CONSTANT, value=255)
+        with self._lock:
+            self._code = code
+            self._scaled = {}
+            self.shown_ns = time.monotonic_ns()
+
+    def clear(self):
+        with self._lock:
+            self._code = None
+            self._scaled = {}
+            self.shown_ns = None
+
+    def _background(self, height: int, width: int):
+        patterns = self._backgrounds.get((height, width))
+        if patterns is None:
+            patterns = []
+            for _ in range(NOISE_FRAMES):
+                frame = np.full((height, width), self.background, dtype=np.uint8)
+                if self.noise:
+                    frame += self._rng.integers(0, self.noise, size=(height, width), dtype=np.uint8)
+                patterns.append(frame)
+            self._backgrounds[(height, width)] = patterns
+        self._frame_index += 1
+        return patterns[self._frame_index % NOISE_FRAMES].copy()
+
+    def render(self, height: int, width: int):
+        frame = self._background(height, width)
+        side = int(min(height, width) * self.code_fraction)
+        with self._lock:
+            code = self._code
+            if code is not None and side not in self._scaled:
+                self._scaled[side] = cv2.resize(code, (side, side), interpolation=cv2.INTER_NEAREST)
+            scaled = self._scaled.get(side)
+        if scaled is not None:
+            y = (height - side) // 2
+            x = (width - side) // 2
+            frame[y:y + side, x:x + side] = scaled
+        return frame
+
+
+class RecordedFrameSource:
+    """Cycles through recorded grayscale frames (e.g. from load_calibration_frames)."""
+
+    def __init__(self, frames: list):
+        self.frames = frames
+        self.shown_ns = None
+        self._index = 0
+
+    def render(self, height: int, width: int):
+        frame = self.frames[self._index % len(self.frames)]
+        self._index += 1
+        if frame.shape != (height, width):
+            frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+        return frame
+
+
+# Frame source used by Picamera2() created without arguments (e.g. in main.py)
+default_source = QRFrameSource()
+_camera_sources = {0: default_source}
+
+
+def source_for(camera_num: int):
+    """Frame source of the camera `camera_num`, camera 0 is default_source."""
+    if camera_num not in _camera_sources:
+        _camera_sources[camera_num] = QRFrameSource()
+    return _camera_sources[camera_num]
+
+
+class FakeRequest:
+
+    def __init__(self, camera, luma, arrays: dict):
+        self.camera = camera
+        self.luma = luma
+        self.arrays = arrays
+        self.released = False
+
+    def array(self, name: str):
+        # The main stream is only built when asked for, like a buffer the ISP filled without CPU cost
+        if name not in self.arrays and name == "main":
+            self.arrays[name] = self.camera._main_array(self.luma)
+        return self.arrays[name]
+
+    def make_array(self, name: str):
+        return self.array(name).copy()
+
+    def release(self):
+        self.released = True
+
+
+class FakeMappedArray:
+    """MappedArray(request, stream) context manager giving a view of the stream buffer."""
+
+    def __init__(self, request: FakeRequest, stream: str):
+        self.request = request
+        self.stream = stream
+        self.array = None
+
+    def __enter__(self):
+        self.array = self.request.array(self.stream)
+        return self
+
+    def __exit__(self, *exc):
+        self.array = None
+        return False
+
+
+class FakePicamera2:
+
+    def __init__(self, camera_num: int = 0, source=None, frame_rate: float = DEFAULT_SIM_FRAME_RATE):
+        self.camera_num = camera_num
+        self.source = source if source is not None else source_for(camera_num)
+        self.frame_rate = frame_rate
+        self.started = False
+        self.closed = False
+        self.frames_captured = 0
+        self._config = None
+        self._next_frame = 0.0
+
+    def create_video_configuration(self, main=None, lores=None, buffer_count=4, controls=None, **kwargs):
+        config = {"main": dict(main or {"size": (640, 480), "format": "RGB888"}),
+                  "lores": dict(lores) if lores else None,
+                  "buffer_count": buffer_count,
+                  "controls": dict(controls or {})}
+        return config
+
+    create_preview_configuration = create_video_configuration
+    create_still_configuration = create_video_configuration
+
+    def configure(self, config: dict):
+        self._config = config
+        if config["lores"] is not None:
+            width, height = config["lores"]["size"]
+            # The ISP pads lores rows to a multiple of 64 bytes
+            config["lores"]["stride"] = (width + 63) // 64 * 64
+        frame_rate = config["controls"].get("FrameRate")
+        if frame_rate:
+            self.frame_rate = min(self.frame_rate, frame_rate) if self.frame_rate else frame_rate
+
+    def camera_configuration(self) -> dict:
+        return self._config
+
+    def start(self):
+        self.started = True
+        self._next_frame = time.monotonic()
+
+    def stop(self):
+        self.started = False
+
+    def close(self):
+        self.closed = True
+
+    def _wait_frame(self):
+        if not self.started:
+            raise RuntimeError("Camera not started")
+        now = time.monotonic()
+        if self._next_frame > now:
+            time.sleep(self._next_frame - now)
+        self._next_frame = max(self._next_frame, now) + 1 / self.frame_rate
+        self.frames_captured += 1
+
+    def _main_array(self, luma):
+        width, height = self._config["main"]["size"]
+        if luma.shape != (height, width):
+            luma = cv2.resize(luma, (width, height), interpolation=cv2.INTER_LINEAR)
+        return cv2.cvtColor(luma, cv2.COLOR_GRAY2RGB)
+
+    def _lores_array(self, luma):
+        lores = self._config["lores"]
+        width, height = lores["size"]
+        stride = lores["stride"]
+        # YUV420: Y plane followed by the quarter size U and V planes, rows padded to the stride
+        buffer = np.full((height * 3 // 2, stride), 128, dtype=np.uint8)
+        buffer[:height, :width] = luma
+        return buffer
+
+    def capture_array(self, name: str = "main"):
+        self._wait_frame()
+        if name == "lores":
+            width, height = self._config["lores"]["size"]
+            return self._lores_array(self.source.render(height, width))
+        width, height = self._config["main"]["size"]
+        return self._main_array(self.source.render(height, width))
+
+    def capture_request(self):
+        self._wait_frame()
+        arrays = {}
+        if self._config["lores"] is not None:
+            width, height = self._config["lores"]["size"]
+            luma = self.source.render(height, width)
+            arrays["lores"] = self._lores_array(luma)
+        else:
+            width, height = self._config["main"]["size"]
+            luma = self.source.render(height, width)
+        return FakeRequest(self, luma, arrays)
@@ -0,0 +1,158 @@
+"""
+fakeFingerprint.py
+
+Fake UART fingerprint sensor behind a pseudo terminal, speaking the 0xF5 protocol.
+FingerprintModule opens `sensor.port` like the real /dev/serial0, so the serial
+driver, select() wake-ups and the incremental frame parser all run for real.
+
+Supported commands:
+- 0x23 (upload eigenvalues): answered when a finger is pressed with an ACK header
+  and a data packet, or with ACK_TIMEOUT when no finger arrives within capture_timeout,
+- 0x2C (sleep): ACK, further captures are ignored until reset() (the RST line),
+- anything else: ACK_SUCCESS header without data.
+"""
+import logging
+import os
+import pty
+import queue
+import select
+import termios
+import threading
+import time
+import tty
+
+logger = logging.getLogger(__name__)
+
+FRAME_MARK = 0xF5
+CMD_GET_EIGENVALUES = 0x23
+CMD_SLEEP = 0x2C
+ACK_SUCCESS = 0x00
+ACK_TIMEOUT = 0x08
+
+DEFAULT_CAPTURE_TIMEOUT = 10.0  # seconds the sensor waits for a finger before answering ACK_TIMEOUT
+DEFAULT_TEMPLATE_SIZE = 196  # 3 header bytes + 193 eigenvalue bytes
+DEFAULT_BAUD = 19200
+UART_CHUNK = 32  # bytes written at once, so the host sees responses arrive in pieces like on the real UART
+
+
+def _checksum(data) -> int:
+    chk = 0
+    for b in data:
+        chk ^= b
+    return chk
+
+
+def build_response(cmd: int, p1: int, p2: int, p3: int, data: bytes = None) -> bytes:
+    header = bytes([cmd, p1, p2, p3, 0])
+    packet = bytes([FRAME_MARK]) + header + bytes([_checksum(header), FRAME_MARK])
+    if data:
+        packet += bytes([FRAME_MARK]) + data + bytes([_checksum(data), FRAME_MARK])
+    return packet
+
+
+def make_template(seed: int, size: int = DEFAULT_TEMPLATE_SIZE) -> bytes:
+    """Deterministic fake eigenvalues, different seeds give templates far apart in Hamming distance."""
+    body = bytearray(size - 3)
+    state = (seed * 2654435761 + 1) & 0xFFFFFFFF
+    for i in range(len(body)):
+        state = (state * 1103515245 + 12345) & 0x7FFFFFFF
+        body[i] = state >> 16 & 0xFF
+    return bytes(3) + bytes(body)
+
+
+class FakeFingerprintSensor:
+
+    def __init__(self, capture_timeout: float = DEFAULT_CAPTURE_TIMEOUT, baud: int = DEFAULT_BAUD):
+        self.capture_timeout = capture_timeout
+        # Byte time on the wire, responses are paced like the real UART
+        self.byte_time = 10 / baud if baud else 0
+
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.master)
+        attrs = termios.tcgetattr(self.slave)
+        attrs[3] &= ~termios.ECHO
+        termios.tcsetattr(self.slave, termios.TCSANOW, attrs)
+        self.port = os.ttyname(self.slave)
+
+        self.pressed_ns = None  # monotonic time the finger answering the current capture was pressed
+        self.stats = {"commands": 0, "captures": 0, "timeouts": 0}
+        self._fingers = queue.Queue()
+        self._capture_deadline = None
+        self._asleep = False
+        self._stopped = threading.Event()
+        self._rx = bytearray()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def press(self, template: bytes):
+        """Put a finger on the sensor, answered by the pending (or next) 0x23 capture."""
+        self._fingers.put((template, time.monotonic_ns()))
+
+    def reset(self):
+        self._asleep = False
+        self._capture_deadline = None
+
+    def close(self):
+        self._stopped.set()
+        self._thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            readable, _, _ = select.select([self.master], [], [], 0.01)
+            if readable:
+                self._rx += os.read(self.master, 256)
+                self._handle_commands()
+            self._serve_capture()
+
+    def _handle_commands(self):
+        while len(self._rx) >= 8:
+            start = self._rx.find(FRAME_MARK)
+            if start < 0:
+                self._rx.clear()
+                return
+            del self._rx[:start]
+            if len(self._rx) < 8:
+                return
+            packet = bytes(self._rx[:8])
+            del self._rx[:8]
+            if packet[7] != FRAME_MARK or _checksum(packet[1:6]) != packet[6]:
+                logger.warning(f"Fake sensor got a corrupted command {packet.hex()}")
+                continue
+            self._handle(packet[1])
+
+    def _handle(self, cmd: int):
+        self.stats["commands"] += 1
+        if cmd == CMD_GET_EIGENVALUES:
+            if not self._asleep:
+                self._capture_deadline = time.monotonic() + self.capture_timeout
+            return
+        if cmd == CMD_SLEEP:
+            self._asleep = True
+            self._capture_deadline = None
+        self._write(build_response(cmd, 0, 0, ACK_SUCCESS))
+
+    def _serve_capture(self):
+        if self._capture_deadline is None:
+            return
+        try:
+            template, pressed_ns = self._fingers.get_nowait()
+        except queue.Empty:
+            if time.monotonic() > self._capture_deadline:
+                self._capture_deadline = None
+                self.stats["timeouts"] += 1
+                self._write(build_response(CMD_GET_EIGENVALUES, 0, 0, ACK_TIMEOUT))
+            return
+        self._capture_deadline = None
+        self.pressed_ns = pressed_ns
+        self.stats["captures"] += 1
+        length = len(template)
+        self._write(build_response(CMD_GET_EIGENVALUES, length >> 8, length & 0xFF, ACK_SUCCESS, template))
+
+    def _write(self, packet: bytes):
+        for i in range(0, len(packet), UART_CHUNK):
+            chunk = packet[i:i + UART_CHUNK]
+            os.write(self.master, chunk)
+            if self.byte_time:
+                time.sleep(len(chunk) * self.byte_time)
@@ -0,0 +1,78 @@
+"""
+fakeGPIO.py
+
+Stand-in for RPi.GPIO. Pin levels are kept in memory, so the door relay and
+the fingerprint reset line can be inspected by the simulation and benchmarks.
+"""
+import threading
+import time
+from collections import deque
+
+BCM = 11
+BOARD = 10
+OUT = 0
+IN = 1
+LOW = 0
+HIGH = 1
+PUD_OFF = 20
+PUD_DOWN = 21
+PUD_UP = 22
+RISING = 31
+FALLING = 32
+BOTH = 33
+
+levels = {}  # pin -> current level
+modes = {}  # pin -> IN / OUT
+history = deque(maxlen=1024)  # (monotonic time, pin, level) of the latest output changes
+_lock = threading.Lock()
+_mode = None
+
+
+def setwarnings(flag):
+    pass
+
+
+def setmode(mode):
+    global _mode
+    _mode = mode
+
+
+def getmode():
+    return _mode
+
+
+def setup(pin, direction, pull_up_down=PUD_OFF, initial=None):
+    with _lock:
+        modes[pin] = direction
+        if direction == OUT:
+            levels[pin] = LOW if initial is None else initial
+        else:
+            levels.setdefault(pin, HIGH if pull_up_down == PUD_UP else LOW)
+
+
+def output(pin, level):
+    with _lock:
+        levels[pin] = HIGH if level else LOW
+        history.append((time.monotonic(), pin, levels[pin]))
+
+
+def input(pin):
+    return levels.get(pin, LOW)
+
+
+def wait_for_edge(pin, edge, timeout=None):
+    # Nothing drives input pins in the simulation, readers fall back to their timeout
+    if timeout is not None:
+        time.sleep(timeout / 1000)
+    return None
+
+
+def cleanup(pins=None):
+    with _lock:
+        if pins is None:
+            levels.clear()
+            modes.clear()
+            return
+        for pin in pins if isinstance(pins, (list, tuple)) else (pins,):
+            levels.pop(pin, None)
+            modes.pop(pin, None)
@@ -0,0 +1,111 @@
+"""
+fakePn532.py
+
+Stand-in for pn532pi (Pn532, Pn532I2c and the pn532 constants) used by RFIDModule.
+Cards are placed on a CardField, either by hand (place / remove) or from a
+schedule of (delay_s, uid, hold_s) entries. readPassiveTargetID honours its
+timeout like the real chip with passive activation retries set.
+Every I2C bus has its own field (field_for), so several readers can be simulated.
+"""
+import threading
+import time
+import types
+
+# Subset of pn532pi.nfc.pn532 used by RFIDModule
+pn532 = types.SimpleNamespace(PN532_MIFARE_ISO14443A_106KBPS=0x00,
+                              PN532_COMMAND_INLISTPASSIVETARGET=0x4A)
+
+DEFAULT_FIRMWARE_VERSION = 0x32010607  # PN532, firmware 1.6
+DEFAULT_READ_TIME = 0.005  # seconds the chip needs to answer when a card is in the field
+
+
+class CardField:
+    """RF field in front of the reader, holds at most one card."""
+
+    def __init__(self):
+        self.placed_ns = None  # monotonic time the current card was placed
+        self._uid = None
+        self._changed = threading.Condition()
+        self._timers = []
+
+    def place(self, uid: bytes):
+        with self._changed:
+            self._uid = bytes(uid)
+            self.placed_ns = time.monotonic_ns()
+            self._changed.notify_all()
+
+    def remove(self):
+        with self._changed:
+            self._uid = None
+            self.placed_ns = None
+
+    def run_schedule(self, schedule: list):
+        """Place every (delay_s, uid, hold_s) card `delay_s` seconds from now for `hold_s` seconds."""
+        for delay, uid, hold in schedule:
+            place = threading.Timer(delay, self.place, args=(uid,))
+            remove = threading.Timer(delay + hold, self.remove)
+            for timer in (place, remove):
+                timer.daemon = True
+                timer.start()
+                self._timers.append(timer)
+
+    def cancel_schedule(self):
+        for timer in self._timers:
+            timer.cancel()
+        self._timers = []
+
+    def wait_card(self, timeout: float):
+        """UID of the card in the field, waiting up to `timeout` seconds for one to be placed."""
+        with self._changed:
+            if self._uid is None:
+                self._changed.wait(timeout)
+            return self._uid
+
+
+# Field used by readers created without an explicit one (e.g. RFIDModule in main.py)
+default_field = CardField()
+_bus_fields = {1: default_field}
+
+
+def field_for(bus: int) -> CardField:
+    """Field in front of the reader on I2C `bus`, bus 1 is default_field."""
+    if bus not in _bus_fields:
+        _bus_fields[bus] = CardField()
+    return _bus_fields[bus]
+
+
+class FakePn532I2c:
+
+    def __init__(self, bus: int = 1, field: CardField = None):
+        self.bus = bus
+        self.field = field if field is not None else field_for(bus)
+
+
+class FakePn532:
+
+    def __init__(self, interface: FakePn532I2c):
+        self._interface = interface
+        self.field = interface.field
+        self.read_time = DEFAULT_READ_TIME
+        self.stats = {"polls": 0, "reads": 0}
+
+    def begin(self):
+        pass
+
+    def getFirmwareVersion(self) -> int:
+        return DEFAULT_FIRMWARE_VERSION
+
+    def SAMConfig(self) -> bool:
+        return True
+
+    def setPassiveActivationRetries(self, retries: int) -> bool:
+        return True
+
+    def readPassiveTargetID(self, cardbaudrate: int, timeout: int = 1000, inlist: bool = False):
+        self.stats["polls"] += 1
+        uid = self.field.wait_card(timeout / 1000 if timeout else None)
+        if uid is None:
+            return False, None
+        time.sleep(self.read_time)
+        self.stats["reads"] += 1
+        return True, bytearray(uid)
@@ -0,0 +1,36 @@
+"""
+simHardware.py
+
+Registers the fake hardware modules in place of picamera2, RPi.GPIO and pn532pi,
+so CameraModule, FingerprintModule, RFIDModule and main.py import and run on a
+machine without a Pi. install() has to be called before the readers are imported:
+
+    from sim_module.simHardware import install
+    install()
+    from rfid_module.cardRead import RFIDModule
+"""
+import sys
+import types
+
+from sim_module import fakeGPIO
+from sim_module.fakeCamera import FakePicamera2, FakeMappedArray
+from sim_module.fakePn532 import FakePn532, FakePn532I2c, pn532
+
+
+def install():
+    picamera2 = types.ModuleType("picamera2")
+    picamera2.Picamera2 = FakePicamera2
+    picamera2.MappedArray = FakeMappedArray
+
+    rpi = types.ModuleType("RPi")
+    rpi.GPIO = fakeGPIO
+
+    pn532pi = types.ModuleType("pn532pi")
+    pn532pi.Pn532 = FakePn532
+    pn532pi.Pn532I2c = FakePn532I2c
+    pn532pi.pn532 = pn532
+
+    sys.modules["picamera2"] = picamera2
+    sys.modules["RPi"] = rpi
+    sys.modules["RPi.GPIO"] = fakeGPIO
+    sys.modules["pn532pi"] = pn532pi
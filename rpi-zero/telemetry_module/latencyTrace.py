@@ -0,0 +1,152 @@
+"""
+latencyTrace.py
+
+Lightweight per-stage latency instrumentation, cheap enough to stay on in production.
+- Histogram: fixed-size HDR-style (log-linear) histogram of durations in microseconds,
+  every bucket is at most 1/16 (~6%) wide relative to its value, 1 us .. ~70 min,
+- Trace: one access attempt, its trace id and a monotonic timestamp per stage,
+- Tracer: histograms per stage, fed by finished traces (durations between
+  consecutive stages and the total) and by record() calls from the readers
+  (frame capture, QR decode, serial framing, MQTT publish, broker round trip).
+"""
+import threading
+import time
+import uuid
+from collections import deque
+
+SUB_BUCKET_BITS = 5
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS  # linear buckets below 32 us, then 16 per power of two
+HALF_SUB_BUCKETS = SUB_BUCKETS // 2
+MAX_EXPONENT = 28  # ~2^32 us
+BUCKET_COUNT = (MAX_EXPONENT + 2) * HALF_SUB_BUCKETS
+DEFAULT_QUANTILES = (0.5, 0.9, 0.99)
+DEFAULT_SLOW_TRACE_MS = 2000  # total latency above which the whole trace is kept for inspection
+DEFAULT_SLOW_TRACES = 8
+
+# Access attempt stages, in order
+STAGE_READ = "read"  # credential handed over by the reader
+STAGE_ADMITTED = "admitted"  # passed admission control
+STAGE_PUBLISHED = "published"  # request acknowledged by the broker
+STAGE_DECIDED = "decided"  # decision delivered to the event loop
+STAGE_TIMED_OUT = "timed_out"  # no decision (timeout / broker error), replaces STAGE_DECIDED
+STAGE_ACTUATED = "actuated"  # door / feedback commanded
+
+
+def bucket_index(value: int) -> int:
+    if value < SUB_BUCKETS:
+        return max(value, 0)
+    exponent = value.bit_length() - SUB_BUCKET_BITS
+    index = exponent * HALF_SUB_BUCKETS + (value >> exponent)
+    return min(index, BUCKET_COUNT - 1)
+
+
+def bucket_upper(index: int) -> int:
+    """Largest value counted in bucket `index`."""
+    if index < SUB_BUCKETS:
+        return index
+    exponent = index // HALF_SUB_BUCKETS - 1
+    mantissa = index - exponent * HALF_SUB_BUCKETS
+    return ((mantissa + 1) << exponent) - 1
+
+
+class Histogram:
+
+    def __init__(self):
+        self.counts = [0] * BUCKET_COUNT
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self._lock = threading.Lock()
+
+    def record(self, value_us: int):
+        index = bucket_index(value_us)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += value_us
+            if value_us > self.max:
+                self.max = value_us
+
+    def percentile(self, quantile: float) -> int:
+        with self._lock:
+            if not self.count:
+                return 0
+            target = max(1, int(quantile * self.count + 0.5))
+            seen = 0
+            for index, n in enumerate(self.counts):
+                seen += n
+                if seen >= target:
+                    return min(bucket_upper(index), self.max)
+        return self.max
+
+    def snapshot(self, quantiles=DEFAULT_QUANTILES) -> dict:
+        return {"count": self.count,
+                "sum_us": self.total,
+                "max_us": self.max,
+                "quantiles": {q: self.percentile(q) for q in quantiles}}
+
+    def reset(self):
+        with self._lock:
+            self.counts = [0] * BUCKET_COUNT
+            self.count = 0
+            self.total = 0
+            self.max = 0
+
+
+class Trace:
+    """Timestamps of one access attempt, stages are marked in the order they happen."""
+
+    __slots__ = ("trace_id", "cred_type", "marks")
+
+    def __init__(self, cred_type: str, start_ns: int = None, trace_id: str = None):
+        self.trace_id = trace_id if trace_id is not None else uuid.uuid4().hex
+        self.cred_type = cred_type
+        self.marks = [(STAGE_READ, start_ns if start_ns is not None else time.monotonic_ns())]
+
+    def mark(self, stage: str):
+        self.marks.append((stage, time.monotonic_ns()))
+
+    def durations(self) -> list:
+        """(stage, microseconds since the previous stage) for every stage after the first."""
+        return [(stage, (ns - self.marks[i][1]) // 1000) for i, (stage, ns) in enumerate(self.marks[1:])]
+
+    def total_us(self) -> int:
+        return (self.marks[-1][1] - self.marks[0][1]) // 1000
+
+
+class Tracer:
+
+    def __init__(self, slow_trace_ms: float = DEFAULT_SLOW_TRACE_MS, slow_traces: int = DEFAULT_SLOW_TRACES):
+        self.histograms = {}
+        self.slow_trace_us = slow_trace_ms * 1000
+        self.slow = deque(maxlen=slow_traces)  # latest traces slower than slow_trace_ms
+        self._lock = threading.Lock()
+
+    def histogram(self, name: str) -> Histogram:
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(name, Histogram())
+        return histogram
+
+    def record(self, name: str, duration_ns: int):
+        self.histogram(name).record(duration_ns // 1000)
+
+    def start(self, cred_type: str, start_ns: int = None, trace_id: str = None) -> Trace:
+        return Trace(cred_type, start_ns, trace_id)
+
+    def finish(self, trace: Trace):
+        for stage, duration_us in trace.durations():
+            self.histogram(stage).record(duration_us)
+        total_us = trace.total_us()
+        self.histogram(f"total_{trace.cred_type}").record(total_us)
+        if total_us > self.slow_trace_us:
+            self.slow.append((trace.trace_id, trace.cred_type, trace.durations()))
+
+    def snapshot(self, quantiles=DEFAULT_QUANTILES) -> dict:
+        return {name: histogram.snapshot(quantiles) for name, histogram in list(self.histograms.items())}
+
+    def reset(self):
+        for histogram in list(self.histograms.values()):
+            histogram.reset()
+        self.slow.clear()
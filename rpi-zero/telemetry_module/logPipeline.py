@@ -0,0 +1,346 @@
+"""
+logPipeline.py
+
+Logging that stays off the hot path:
+- the root logger only gets a queue handler, a logging call creates the record
+  and puts it on a queue, formatting and writing happen in a background thread
+  (logging.handlers.QueueListener). When the writer falls behind, new records
+  are dropped and counted instead of blocking a reader or the event loop,
+- repeated records of one call site (a reader failing on every frame, a broker
+  that keeps timing out) are rate limited, the first record after a quiet
+  period reports how many were suppressed,
+- records below the output level (debug detail) aren't written at all, the last
+  N of them are kept in a ring that is written out when an ERROR record arrives
+  or on demand (dump(), SIGUSR1), so a failure comes with the context that led to it,
+- written records (and ring dumps) can be shipped over MQTT in zlib compressed
+  JSON batches, like the event journal uploads.
+Forked children (the reader workers) start a queue and writer thread of their own
+and write to the same output, their records aren't shipped (MQTT is the parent's).
+
+Message arguments are formatted by the writer thread, pass them as logging
+arguments (logger.debug("Request %s", request)) instead of f-strings, so a
+record that ends up in the ring costs no formatting at all.
+"""
+import asyncio
+import json
+import logging
+import logging.handlers
+import multiprocessing.util
+import os
+import queue
+import signal
+import socket
+import sys
+import threading
+import time
+import zlib
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LEVEL = logging.INFO  # records written to the output and shipped
+DEFAULT_CAPTURE_LEVEL = logging.DEBUG  # records created at all, the ones below DEFAULT_LEVEL only go to the ring
+DEFAULT_QUEUE_SIZE = 10000  # records waiting for the writer thread
+DEFAULT_RING_SIZE = 2000  # debug records kept for a dump
+DEFAULT_RATE_LIMIT = 20  # records per call site and period
+DEFAULT_RATE_PERIOD = 10.0  # seconds
+DEFAULT_SHIP_INTERVAL = 30.0  # seconds between log uploads
+DEFAULT_SHIP_BATCH = 500  # records per uploaded message
+DEFAULT_SHIP_BUFFER = 20000  # records waiting for an upload, the oldest are dropped beyond that
+DEFAULT_LOG_TOPIC = "device/logs"
+LOGS_CONTENT_TYPE = "application/vnd.door-logs+zlib"
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+RING_DUMP = "ring_dump"  # attribute (the reason) of the record that asks the ring for a dump
+
+
+def level_number(level) -> int:
+    """Level from its number or name ("DEBUG", "info")."""
+    if isinstance(level, int):
+        return level
+    number = logging.getLevelName(str(level).upper())
+    if not isinstance(number, int):
+        raise ValueError(f"Unknown log level {level}")
+    return number
+
+
+class RecordQueueHandler(logging.handlers.QueueHandler):
+    """Puts the records on the queue as they are, never blocks the caller."""
+
+    def __init__(self, record_queue, max_size: int = DEFAULT_QUEUE_SIZE):
+        super().__init__(record_queue)
+        self.max_size = max_size
+        self.dropped = 0
+
+    def prepare(self, record):
+        # The listener runs in this process, the record is formatted there instead of in the caller
+        return record
+
+    def enqueue(self, record):
+        if self.queue.qsize() >= self.max_size:
+            self.dropped += 1
+            return
+        self.queue.put_nowait(record)
+
+
+class RateLimitFilter(logging.Filter):
+    """At most `limit` records per call site (file, line) and `period` seconds."""
+
+    def __init__(self, limit: int = DEFAULT_RATE_LIMIT, period: float = DEFAULT_RATE_PERIOD):
+        super().__init__()
+        self.limit = limit
+        self.period = period
+        self.suppressed = 0
+        self._sites = {}  # (pathname, lineno) -> [window start, records in window, suppressed in window]
+        self._lock = threading.Lock()
+
+    def filter(self, record) -> bool:
+        if hasattr(record, RING_DUMP):
+            return True
+        key = (record.pathname, record.lineno)
+        with self._lock:
+            site = self._sites.get(key)
+            if site is None:
+                self._sites[key] = [record.created, 1, 0]
+                return True
+            if record.created - site[0] >= self.period:
+                suppressed = site[2]
+                site[0], site[1], site[2] = record.created, 1, 0
+                if suppressed:
+                    # Rare, the message is formatted here so the count can be appended
+                    record.msg = "%s (%d similar messages suppressed)"
+                    record.args = (record.getMessage(), suppressed)
+                return True
+            site[1] += 1
+            if site[1] <= self.limit:
+                return True
+            site[2] += 1
+            self.suppressed += 1
+            return False
+
+
+class RingBuffer(logging.Handler):
+    """Keeps the records below `output_level`, writes them to the targets on an error or a dump request."""
+
+    def __init__(self, capacity: int = DEFAULT_RING_SIZE, output_level=DEFAULT_LEVEL,
+                 dump_level=logging.ERROR, targets=()):
+        super().__init__(logging.NOTSET)
+        self.records = deque(maxlen=capacity)
+        self.output_level = level_number(output_level)
+        self.dump_level = level_number(dump_level)
+        self.targets = list(targets)
+        self.dumps = 0
+
+    def emit(self, record):
+        reason = getattr(record, RING_DUMP, None)
+        if reason is not None:
+            self.dump(reason)
+        elif record.levelno < self.output_level:
+            self.records.append(record)
+        elif record.levelno >= self.dump_level:
+            self.dump(f"{record.levelname} in {record.name}")
+
+    def dump(self, reason: str):
+        """Writes the kept records to every target (ignoring their levels) and forgets them."""
+        if not self.records:
+            return
+        records = list(self.records)
+        self.records.clear()
+        self.dumps += 1
+        header = logging.makeLogRecord({"name": __name__, "levelno": logging.INFO, "levelname": "INFO",
+                                        "msg": "Ring dump (%s), %d records:", "args": (reason, len(records))})
+        for target in self.targets:
+            target.acquire()
+            try:
+                for dumped in [header] + records:
+                    target.emit(dumped)
+                target.flush()
+            finally:
+                target.release()
+
+
+class MQTTLogShipper(logging.Handler):
+    """Collects the written records, upload() publishes them in compressed batches."""
+
+    def __init__(self, mqtt, topic: str = DEFAULT_LOG_TOPIC, level=DEFAULT_LEVEL,
+                 interval: float = DEFAULT_SHIP_INTERVAL, batch_size: int = DEFAULT_SHIP_BATCH,
+                 max_buffered: int = DEFAULT_SHIP_BUFFER, device_id: str = None):
+        super().__init__(level_number(level))
+        self.setFormatter(logging.Formatter("%(message)s"))
+        self.mqtt = mqtt
+        self.topic = topic
+        self.interval = interval
+        self.batch_size = batch_size
+        self.device_id = device_id or socket.gethostname()
+        self.buffer = deque(maxlen=max_buffered)
+        self.stats = {"shipped": 0, "messages": 0, "dropped": 0}
+        self._upload_lock = threading.Lock()
+
+    def emit(self, record):
+        if len(self.buffer) == self.buffer.maxlen:
+            self.stats["dropped"] += 1
+        self.buffer.append([round(record.created, 3), record.levelname, record.name, self.format(record)])
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await loop.run_in_executor(None, self.upload)
+            except Exception:
+                logger.exception("Log upload failed")
+
+    def upload(self) -> int:
+        """Publish the buffered records until the buffer is empty or the broker stops acknowledging."""
+        if not self.mqtt.isConnected():
+            return 0
+        uploaded = 0
+        with self._upload_lock:
+            while self.buffer:
+                batch = []
+                while self.buffer and len(batch) < self.batch_size:
+                    batch.append(self.buffer.popleft())
+                message = {"device": self.device_id, "records": batch}
+                payload = zlib.compress(json.dumps(message, separators=(",", ":")).encode("utf-8"))
+                if not self.mqtt.publish(self.topic, payload, content_type=LOGS_CONTENT_TYPE):
+                    # Retried on the next upload, newer records are dropped first if the buffer overflows meanwhile
+                    self.buffer.extendleft(reversed(batch))
+                    break
+                uploaded += len(batch)
+                self.stats["shipped"] += len(batch)
+                self.stats["messages"] += 1
+        return uploaded
+
+
+class LogPipeline:
+    """Queue handler on the root logger, writer thread with the ring, the output and the optional MQTT shipper."""
+
+    def __init__(self, level=DEFAULT_LEVEL, capture_level=DEFAULT_CAPTURE_LEVEL,
+                 ring_size: int = DEFAULT_RING_SIZE,
+                 rate_limit: int = DEFAULT_RATE_LIMIT, rate_period: float = DEFAULT_RATE_PERIOD,
+                 queue_size: int = DEFAULT_QUEUE_SIZE, path: str = None, stream=None):
+        self.level = level_number(level)
+        self.capture_level = min(level_number(capture_level), self.level)
+        self.queue = queue.SimpleQueue()  # put() is safe in a signal handler
+        self.handler = RecordQueueHandler(self.queue, queue_size)
+        self.rate_limiter = None
+        if rate_limit:
+            self.rate_limiter = RateLimitFilter(rate_limit, rate_period)
+            self.handler.addFilter(self.rate_limiter)
+
+        if path:
+            # Reopened after logrotate moved the file
+            self.output = logging.handlers.WatchedFileHandler(path, encoding="utf-8")
+        else:
+            self.output = logging.StreamHandler(stream or sys.stderr)
+        self.output.setLevel(self.level)
+        self.output.setFormatter(logging.Formatter(LOG_FORMAT))
+        self.ring = RingBuffer(ring_size, output_level=self.level, targets=[self.output])
+        self.shipper = None
+        # The ring goes first, the context of an error is written before the error itself
+        self.listener = logging.handlers.QueueListener(self.queue, self.ring, self.output, respect_handler_level=True)
+        self._root_level = None
+        self._fork_hook = False
+
+    def attach_mqtt(self, mqtt, topic: str = DEFAULT_LOG_TOPIC, interval: float = DEFAULT_SHIP_INTERVAL):
+        """Ship the written records (and ring dumps) over MQTT, run shipper.run() in the event loop."""
+        self.shipper = MQTTLogShipper(mqtt, topic, level=self.level, interval=interval)
+        self.ring.targets.append(self.shipper)
+        self.listener.handlers = self.listener.handlers + (self.shipper,)
+        return self.shipper
+
+    def install(self, dump_signal=signal.SIGUSR1):
+        """Replace the root logger handlers with the queue and start the writer, call it from the main thread."""
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        self._root_level = root.level
+        root.setLevel(self.capture_level)
+        root.addHandler(self.handler)
+        self.listener.start()
+        if dump_signal is not None:
+            signal.signal(dump_signal, lambda signum, frame: self.dump(signal.Signals(signum).name))
+        if not self._fork_hook:
+            os.register_at_fork(after_in_child=self._after_fork_in_child)
+            multiprocessing.util.register_after_fork(self, LogPipeline._stop_at_child_exit)
+            self._fork_hook = True
+        return self
+
+    def _after_fork_in_child(self):
+        # A forked child (reader worker) inherits the queue handler but not the writer thread,
+        # it gets a queue and a writer of its own. Shipping stays with the parent, which owns MQTT.
+        if self._root_level is None:
+            return  # closed
+        self.queue = queue.SimpleQueue()
+        self.handler.queue = self.queue
+        if self.rate_limiter is not None:
+            self.rate_limiter._lock = threading.Lock()
+        self.ring.records.clear()
+        self.ring.targets = [self.output]
+        self.shipper = None
+        self.listener = logging.handlers.QueueListener(self.queue, self.ring, self.output, respect_handler_level=True)
+        self.listener.start()
+
+    def _stop_at_child_exit(self):
+        # multiprocessing children end with os._exit, their exit finalizers are the last chance to write out
+        # the queue. Registered after multiprocessing cleared the finalizers inherited from the parent.
+        if self._root_level is not None:
+            multiprocessing.util.Finalize(self, self.listener.stop, exitpriority=0)
+
+    def dump(self, reason: str = "on demand"):
+        """Ask the writer thread to write out the ring."""
+        logger.warning("Ring dump requested (%s)", reason, extra={RING_DUMP: reason})
+
+    def getStats(self) -> dict:
+        stats = {"queued": self.queue.qsize(), "dropped": self.handler.dropped,
+                 "suppressed": self.rate_limiter.suppressed if self.rate_limiter is not None else 0,
+                 "ring": len(self.ring.records), "dumps": self.ring.dumps}
+        if self.shipper is not None:
+            stats.update({f"ship_{key}": value for key, value in self.shipper.stats.items()})
+        return stats
+
+    def close(self):
+        """Write out what is queued and make a last upload attempt."""
+        root = logging.getLogger()
+        root.removeHandler(self.handler)
+        if self._root_level is not None:
+            root.setLevel(self._root_level)
+            self._root_level = None
+        self.listener.stop()
+        if self.shipper is not None:
+            try:
+                self.shipper.upload()
+            except Exception:
+                pass  # broker gone, nothing left to log to
+        self.output.close()
+
+
+if __name__ == "__main__":
+    # Cost of a logging call on the calling thread, direct StreamHandler vs the queue
+    import os
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    bench = logging.getLogger("bench")
+    request = {"type": "rfid", "data": "04A1B2C3D4", "request_id": "0" * 32, "door": "main"}
+
+    with open(os.devnull, "w") as devnull:
+        logging.basicConfig(level=logging.DEBUG, stream=devnull, format=LOG_FORMAT)
+        start = time.perf_counter_ns()
+        for i in range(count):
+            bench.debug(f"Json request: {request}")
+        direct_ns = (time.perf_counter_ns() - start) / count
+
+        pipeline = LogPipeline(level=logging.INFO, stream=devnull, rate_limit=0).install(dump_signal=None)
+        start = time.perf_counter_ns()
+        for i in range(count):
+            bench.debug("Json request: %s", request)
+        queued_ns = (time.perf_counter_ns() - start) / count
+        start = time.perf_counter_ns()
+        for i in range(count):
+            bench.info("Json request: %s", request)
+        written_ns = (time.perf_counter_ns() - start) / count
+        pipeline.close()
+
+    print(f"direct debug: {direct_ns / 1000:.2f} us, ring debug: {queued_ns / 1000:.2f} us, "
+          f"queued info: {written_ns / 1000:.2f} us per call")
+    print(pipeline.getStats())
@@ -0,0 +1,119 @@
+"""
+telemetryExport.py
+
+Periodic export of the Tracer histograms:
+- compact JSON telemetry message published over MQTT, one per door
+  {"door": "main", "ts": 1700000000, "stages": {"decided": [count, p50, p90, p99, max], ...},
+   "counts": {"requests": 12, "allowed": 10, ...}}
+  (all latencies in microseconds, counts are totals since start),
+- Prometheus text format file for the node_exporter textfile collector.
+Every door is a source with its own Tracer and optional counters (AccessPipeline.stats).
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+
+from telemetry_module.latencyTrace import DEFAULT_QUANTILES
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_EXPORT_INTERVAL = 60  # seconds
+DEFAULT_DOOR_ID = "main"
+METRIC_NAME = "door_stage_latency_seconds"
+COUNTER_METRIC_NAME = "door_access_total"
+
+
+def telemetry_message(snapshot: dict, door_id: str = DEFAULT_DOOR_ID, quantiles=DEFAULT_QUANTILES,
+                      counts: dict = None) -> str:
+    stages = {}
+    for name, stats in snapshot.items():
+        if stats["count"]:
+            stages[name] = [stats["count"]] + [stats["quantiles"][q] for q in quantiles] + [stats["max_us"]]
+    message = {"door": door_id, "ts": int(time.time()), "stages": stages}
+    if counts is not None:
+        message["counts"] = counts
+    return json.dumps(message, separators=(",", ":"))
+
+
+def prometheus_text(snapshot: dict, door_id: str = DEFAULT_DOOR_ID, header: bool = True) -> str:
+    lines = []
+    if header:
+        lines = [f"# HELP {METRIC_NAME} Latency of the access attempt stages.",
+                 f"# TYPE {METRIC_NAME} summary"]
+    for name, stats in sorted(snapshot.items()):
+        labels = f'door="{door_id}",stage="{name}"'
+        for quantile, value_us in stats["quantiles"].items():
+            lines.append(f'{METRIC_NAME}{{{labels},quantile="{quantile}"}} {value_us / 1e6:.6f}')
+        lines.append(f"{METRIC_NAME}_sum{{{labels}}} {stats['sum_us'] / 1e6:.6f}")
+        lines.append(f"{METRIC_NAME}_count{{{labels}}} {stats['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def prometheus_counters(counts_by_door: dict) -> str:
+    """door_access_total{door, result} from {door_id: {"requests": n, "allowed": n, ...}}."""
+    lines = [f"# HELP {COUNTER_METRIC_NAME} Access attempts per door and result.",
+             f"# TYPE {COUNTER_METRIC_NAME} counter"]
+    for door_id, counts in sorted(counts_by_door.items()):
+        for result, value in sorted(counts.items()):
+            lines.append(f'{COUNTER_METRIC_NAME}{{door="{door_id}",result="{result}"}} {value}')
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus_file(path: str, text: str):
+    # Written next to the target and renamed, so the collector never reads a partial file
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+class TelemetryExporter:
+
+    def __init__(self, tracer, mqtt=None, topic: str = None, prometheus_path: str = None,
+                 interval: float = DEFAULT_EXPORT_INTERVAL, door_id: str = DEFAULT_DOOR_ID, counts: dict = None):
+        self.tracer = tracer
+        self.mqtt = mqtt
+        self.topic = topic
+        self.prometheus_path = prometheus_path
+        self.interval = interval
+        self.door_id = door_id
+        self.sources = [(door_id, tracer, counts)]
+        self._last_requests = {}
+
+    def addSource(self, door_id: str, tracer, counts: dict = None):
+        """Export another door's Tracer (and its counters, e.g. AccessPipeline.stats) as well."""
+        self.sources.append((door_id, tracer, counts))
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await loop.run_in_executor(None, self.export)
+            except Exception:
+                logger.exception("Telemetry export failed")
+
+    def export(self):
+        texts = []
+        counts_by_door = {}
+        for index, (door_id, tracer, counts) in enumerate(self.sources):
+            snapshot = tracer.snapshot()
+            counts = dict(counts) if counts is not None else None
+            texts.append(prometheus_text(snapshot, door_id, header=index == 0))
+            if self.mqtt is not None and self.topic:
+                self.mqtt.publish(self.topic, telemetry_message(snapshot, door_id, counts=counts))
+            if counts is not None:
+                counts_by_door[door_id] = counts
+                requests = counts.get("requests", 0)
+                logger.info(f"Door {door_id}: {requests - self._last_requests.get(door_id, 0)} requests "
+                            f"in the last {self.interval:.0f} s, {counts}")
+                self._last_requests[door_id] = requests
+            for trace_id, cred_type, durations in list(tracer.slow):
+                logger.info(f"Slow {cred_type} access {trace_id} at door {door_id}: {durations}")
+            tracer.slow.clear()
+        if self.prometheus_path:
+            if counts_by_door:
+                texts.append(prometheus_counters(counts_by_door))
+            write_prometheus_file(self.prometheus_path, "".join(texts))